@@ -0,0 +1,39 @@
+###import-time benchmark: time lobbylinks imports in fresh interpreters
+# usage: python import_benchmark.py [n_runs]
+#	reports the median wall time of each import statement and the heavy
+#	dependencies (spacy, tensorflow, networkx, ...) it loaded; these should
+#	only be imported when the graph is built or visualized
+import sys
+import subprocess
+from statistics import median
+
+statements = [ 'from lobbylinks import LobbyData',
+               'from lobbylinks import LobbyLinks',
+               'import lobbylinks' ]
+
+heavy_modules = [ 'spacy', 'tensorflow', 'networkx', 'pyvis', 'wordninja', 'nltk',
+                  'wordfreq', 'pywordsegment', 'pluralizer', 'pycrfsuite',
+                  'lobbylinks.resources.probablepeople_mod' ]
+
+probe = '''import sys, time
+t = time.perf_counter()
+%s
+elapsed = time.perf_counter() - t
+print(elapsed)
+print(','.join(m for m in %r if m in sys.modules))'''
+
+def time_import(statement, n_runs=5):
+  #(median seconds, heavy modules loaded) of statement, each run in a new interpreter
+  times = []
+  for _ in range(n_runs):
+    out = subprocess.run([ sys.executable, '-c', probe % (statement, heavy_modules) ], \
+                         capture_output=True, text=True, check=True).stdout.split('\n')
+    times.append(float(out[-3]))
+    loaded = out[-2]
+  return median(times), loaded
+
+if __name__ == '__main__':
+  n_runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  for statement in statements:
+    seconds, loaded = time_import(statement, n_runs=n_runs)
+    print('%-36s %.3fs   heavy modules loaded: %s' % (statement, seconds, loaded or 'none'))
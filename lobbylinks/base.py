@@ -2,24 +2,34 @@
 
 from .resources.handlers import AttrDict, Legislators, \
                                 IssueCodes, lobby_namesort, \
-                                LegislatorExtractor, CompanyMatcher
+                                LegislatorExtractor, CompanyMatcher, \
+                                matcher_fingerprint, legacy_cascade
 
 #basic imports
 import re, os, json
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import requests #for calls to API
 import pickle #for saving LobbyData objects
 from tqdm import tqdm
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from functools import cmp_to_key
 import time
+from .fetch import PageFetcher
+from .journal import PageJournal
+from .store import FilingStore, ColumnsNotLoaded, lobby_schema, contributions_schema
+from .cache import ExtractionCache, namespace_key
+from . import persist
 
 #custom utilities
-from .utils import TimeOutHandler, DummyTimeout, build_queries, \
-                   exact_search_filter, _is_initials, \
+from .utils import Deadline, TimedOut, TimeOutHandler, ThreadTimeout, DummyTimeout, \
+                   build_queries, exact_search_filter, _is_initials, \
                    _has_numerical_suffix, proc_name, \
                    get_filing_summary, get_activity_summary, \
-                   get_feca_filing_summary, get_contribution_summary
+                   get_feca_filing_summary, get_contribution_summary, \
+                   filing_summary_frame, activity_summary_frame, \
+                   feca_filing_summary_frame, contributions_summary_frame, \
+                   lobbyist_frame, watermark_key, parse_dt
 
 #minimize tensorflow printouts
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
@@ -27,40 +37,77 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 #data processing inputs
 import numpy as np
 import pandas as pd
-import networkx as nx
-from pyvis.network import Network
+#networkx, pyvis and wordninja are imported on first use (see visualize, _wordninja)
 
-try: import wordninja
-except ModuleNotFoundError: print('do \'pip install wordninja\' for extra postprocessing or set ninja_postproc=False')
+def _wordninja():
+  #wordninja loads its word list when imported
+  try: import wordninja
+  except ModuleNotFoundError:
+    raise ModuleNotFoundError('do \'pip install wordninja\' for extra postprocessing or set ninja_postproc=False')
+  return wordninja
 
 def get_results(r_data, filt):
   try:
-    new_results = [ AttrDict(filing) for filing in 
+    #raw dicts; LobbyData keeps them in a columnar FilingStore
+    new_results = [ filing for filing in 
                         r_data['results'] if filt(filing) ]
   except KeyError: 
     new_results = []
   return new_results
 
-def load(fname):
+def load(fname, columns=None, memory_map=True):
+  #loads a LobbyData, ContributionsData or LobbyLinks object saved with .save()
+  #	fname is either a save directory (feather/parquet) or a legacy pickle file
+  #	columns - for save directories, the filings columns to load (e.g. 
+  #	          ['income', 'client.name']); other tables are read when first used
+  if persist.is_saved_dir(fname):
+    manifest = persist.read_manifest(fname)
+    classes = { 'LobbyData': LobbyData, 'ContributionsData': ContributionsData, 
+                'LobbyLinks': LobbyLinks }
+    return classes[manifest['class']].load(fname, columns=columns, memory_map=memory_map)
   with open(fname, 'rb') as f:
     return pickle.load(f)
 
+company_memo_file = 'company_memo.json' #CompanyMatcher memo in a save directory
+
+def _save_format(save_file, format):
+  #legacy pickles for .pkl/.pickle file names, feather save directories otherwise
+  if format is None:
+    format = 'pickle' if os.path.splitext(save_file)[1] in ('.pkl', '.pickle') else 'feather'
+  assert format in ('pickle', 'feather', 'parquet')
+  return format
+
 
 class LobbyData(object):
   """wrapper for queries to the LDA REST database API\n"""\
   """Performs query upon initialization. All keywords are passed to the API call.\n"""\
   """See lobby_query_parameters.odt or LDA API documentation for guide to valid kwargs."""
   """Supports slicing, addition (filing concatenation), and inplace addition."""
+  """Pages are fetched concurrently by max_workers threads; paginate_wait sets the"""
+  """initial interval between requests until the API reports its rate limit."""
+  """Pass journal=path to write every received page to an append-only journal, """
+  """so that an interrupted scrape resumes where it stopped and update() only """
+  """requests pages that can contain new filings."""
+  """Filings are held column-wise in self.filings (a store.FilingStore); iterating """
+  """or indexing it yields lazy views with the usual attribute access."""
+  endpoint = 'filings/'
+  schema = lobby_schema
   def __init__(self, save_file=None, query_auth=None, \
                      load_from_save=False, _filings=None, 
-                     paginate_wait=3, **kwargs):
+                     paginate_wait=3, max_workers=8, journal=None, **kwargs):
     self.save_file = save_file
     assert paginate_wait is None or isinstance(paginate_wait, (int,float))
     self.paginate_wait = paginate_wait
+    self.max_workers = max_workers
+    if isinstance(journal, str):
+      journal = PageJournal(journal)
+    self.journal = journal
+    self.query_kwargs = kwargs
+    self.watermarks = {}
+    self._amendments_merged = False
     if save_file is not None and load_from_save:
       try:
-        with open(save_file, 'rb') as pkl_file:
-          self = pickle.load(pkl_file)
+        vars(self).update(vars(load(save_file)))
         print('loaded LobbyData from %s' % save_file)
         loaded = True
       except FileNotFoundError:
@@ -78,98 +125,145 @@ class LobbyData(object):
       #print('filings', self.filings)
       #self.summary = self.compile_summary()
       self._strip_duplicates()
-    self.companyMatcher = CompanyMatcher()
+    if not loaded or not hasattr(self, 'companyMatcher'):
+      #a loaded object keeps its matcher and memo
+      self.companyMatcher = CompanyMatcher()
     
   def query_LDAdb(self, query_auth=None, **kwargs):
-    #self.save_file = None
     #query_auth is a tuple (username, password) for registered LDA API users
     print('querying https://lda.senate.gov API')
-    kwargs['page_size'] = 25
+    return self._query_server(query_auth, **kwargs)
+  
+  def _query_server(self, query_auth=None, since_watermark=False, **kwargs):
+    #fans out over the cross product of query terms (build_queries) and over
+    #	the pages of each query, at the rate allowed by the server's quota
+    #	paginate_wait sets the initial request interval until the server reports its quota
+    kwargs['page_size'] = min(int(kwargs.get('page_size', 25)), 25) #25 is the API max
+    if self.journal is not None and 'ordering' not in kwargs:
+      #journaled pages stay valid only if new filings are appended at the end
+      kwargs['ordering'] = 'dt_posted'
+    rate = None if not self.paginate_wait else 1./self.paginate_wait
+    fetcher = PageFetcher(endpoint=self.endpoint, query_auth=query_auth, \
+                          max_workers=self.max_workers, rate=rate, \
+                          page_size=kwargs['page_size'])
+    queries = build_queries(kwargs)
+    if since_watermark:
+      #only ask for filings posted since each query's high-water mark
+      for kwargs_ in queries:
+        after = self.watermarks.get(watermark_key(kwargs_))
+        if after is not None:
+          kwargs_['filing_dt_posted_after'] = after
+    for kwargs_ in queries:
+      print('current query', kwargs_)
     try:
-      year_range = kwargs['filing_year']
-      if type(year_range) in [list, tuple]:
-        year_range = range(int(min(year_range)), 
-                           int(max(year_range)+1))
-      elif type(year_range) in [int, str]:
-        year_range = [year_range]
-    except KeyError: year_range = ['']
-    filings_server = 'https://lda.senate.gov/api/v1/filings/' #main dir for filings
-    query = lambda q_parameters: requests.get(filings_server, \
-                   auth=query_auth, params=q_parameters)
-    #print('query parameters', kwargs)
+      query_pages = fetcher.fetch(queries, journal=self.journal)
+    finally:
+      fetcher.close()
     all_results = []
-    #for filing_year in year_range:
-    for kwargs_ in build_queries(kwargs):
-      #kwargs_ = kwargs.copy()
-      #kwargs_['filing_year'] = filing_year
-      print('\ncurrent query', kwargs_, '\n')
-      r = query(kwargs_) #initial query
-      r_data = r.json()
-      filt = exact_search_filter(kwargs_)
-     
-      new_results = get_results(r_data, filt)
-      #try:
-      #  new_results = [ AttrDict(filing) for filing in 
-      #                      r_data['results'] if filt(filing) ]
-      #except KeyError: 
-      #  new_results = []
-      
-      #iterate on 'next' to get all results matching the query
-      while len(new_results) > 0:
-        all_results += new_results
-        print('%i results received\r' % len(all_results), end='')
-        if self.paginate_wait is not None:
-            time.sleep(self.paginate_wait)
-        
-        new_results = get_results(r_data, filt)
-        try:
-          if r_data['next'] is None:
-            break
-        except KeyError:
-          break
-        r_ = requests.get(r_data['next'], auth=query_auth)
-        try:
-          r_data = r_.json()
-        except: # json.decoder.JSONDecodeError:
-          #print(r_data)
-          #break
-          #raise json.decoder.JSONDecodeError
-          pass
-        #new_results = [ AttrDict(filing) for filing 
-        #                    in r_data['results'] if filt(filing) ]
+    for kwargs_, pages in zip(queries, query_pages):
       #filter for any exact string searches
+      filt = exact_search_filter(kwargs_)
+      new_results = []
+      for url, r_data in pages:
+        new_results += get_results(r_data, filt)
+      self._update_watermark(kwargs_, new_results)
+      all_results += new_results
     return all_results
   
-  def update(self, **kwargs):
+  def _update_watermark(self, query, filings):
+    #per-query high-water mark on dt_posted, used by self.sync()
+    posted = [ filing['dt_posted'] for filing in filings if filing.get('dt_posted') ]
+    if len(posted) == 0: return
+    key = watermark_key(query)
+    if key in self.watermarks:
+      posted.append(self.watermarks[key])
+    self.watermarks[key] = max(posted, key=parse_dt)
+  
+  def update(self, query_auth=None, **kwargs):
+      #re-runs the original query by default; with a journal, only pages
+      #	that can hold newly posted filings are requested
+      if len(kwargs) == 0:
+        kwargs = dict(self.query_kwargs)
+      self._check_writable('update')
       print('current filings', len(self.filings))
-      new_filings = self.query_LDAdb(**kwargs)
+      new_filings = self.query_LDAdb(query_auth, **kwargs)
       print('found %i results for this query' % len(new_filings))
       self.filings += new_filings
+      self._strip_duplicates()
       print('updated filings', len(self.filings))
       #self.summary = self.compile_summary()
       if self.save_file is not None:
         self.save()
   
-  def merge_names(self, companyMatcher=CompanyMatcher(), inplace=True):
-    #merges company names using companyMatcher object, using the
-    #	heuristics in resources.match_heuristics by default
-    #take the shortest name in the list of reduced names that actually occurred in the dataset
-    #merged_filings = []
-    merges = {}; merge_count = 0
-    for filing in tqdm(self.filings):
+  def sync(self, query_auth=None, **kwargs):
+    #incremental refresh: asks the API only for filings posted or amended since
+    #	each query's dt_posted high-water mark, merges them in by filing_uuid and
+    #	re-resolves amendments only for the (registrant, year, period, client) 
+    #	groups that received new filings
+    if len(kwargs) == 0:
+      kwargs = dict(self.query_kwargs)
+    self._check_writable('sync')
+    print('syncing filings posted since last query')
+    new_filings = FilingStore.from_records(self._query_server(query_auth, \
+                                           since_watermark=True, **kwargs), \
+                                           schema=self.schema)
+    if hasattr(self, 'merges'):
+      self._merge_filing_names(new_filings, self.companyMatcher, self.merges)
+    uuid2idx = { filing.filing_uuid: i for i, filing in enumerate(self.filings) }
+    affected = set(); replaced = set()
+    for filing in new_filings:
+      affected.add(self._criteria(filing))
+      i = uuid2idx.get(filing.filing_uuid)
+      if i is not None:
+        affected.add(self._criteria(self.filings[i]))
+        replaced.add(i)
+    #updated filings are dropped and re-appended with the new ones
+    keep = [ i for i in range(len(self.filings)) if i not in replaced ]
+    self.filings = self.filings.take(keep) + new_filings
+    print('%i new and %i updated filings' % (len(new_filings) - len(replaced), len(replaced)))
+    if self._amendments_merged and len(affected) > 0:
+      self.merge_amended(groups=affected)
+    if self.save_file is not None:
+      self.save()
+    return affected
+  
+  def _merge_filing_names(self, filings, companyMatcher, merges, verbose=False):
+    if hasattr(companyMatcher, 'prime'):
+      companyMatcher.prime([ filing.client.name for filing in filings \
+                                                if filing.client.name not in merges ])
+    for filing in (tqdm(filings) if verbose else filings):
       #new_filing = filing.copy()
       client_name = filing.client.name
       filing.client.name__merged_from_ = client_name
       
-      try: #if client_name in merges:
+      try: #names merged earlier (e.g. before a sync)
           merged_name = merges[client_name]
       except KeyError:
-          merged_name = companyMatcher.reduce(client_name)
+          merged_name = companyMatcher.reduce(client_name) #memoized by companyMatcher
           merges[client_name] = merged_name
       if client_name != merged_name: #merge_count += 1
         filing.client.name = merged_name
-        merges[client_name] = merged_name
+    if getattr(companyMatcher, 'memo_file', None) is not None:
+      companyMatcher.save()
+  
+  def _company_matcher(self, companyMatcher=None):
+    #companyMatcher if given, else this object's own matcher (and memo), which is
+    #	never shared with other objects
+    if companyMatcher is None: companyMatcher = getattr(self, 'companyMatcher', None)
+    return CompanyMatcher() if companyMatcher is None else companyMatcher
+  
+  def merge_names(self, companyMatcher=None, inplace=True):
+    #merges company names using companyMatcher object, using the
+    #	heuristics in resources.match_heuristics by default
+    #	(companyMatcher memoizes reduced names; pass CompanyMatcher(memo_file=...) to
+    #	keep them across runs)
+    companyMatcher = self._company_matcher(companyMatcher)
+    #take the shortest name in the list of reduced names that actually occurred in the dataset
+    #merged_filings = []
+    merges = {}; merge_count = 0
+    self._merge_filing_names(self.filings, companyMatcher, merges, verbose=True)
     self.merges = merges
+    self.companyMatcher = companyMatcher
     n_pre_merge = len(set([ filing.client.name__merged_from_ \
                                                 for filing in self.filings ]))
     n_post_merge = len(set([ filing.client.name for filing in self.filings ]))
@@ -195,7 +289,30 @@ class LobbyData(object):
     for i, filing in enumerate(self):
       criteria2idx[ tuple( filing[crit] for crit in criteria) ].append(i)
     
-    self.filings = [ self[dupl[-1]] for dupl in criteria2idx.values() ]
+    self.filings = self.filings.take([ dupl[-1] for dupl in criteria2idx.values() ])
+  
+  @property
+  def filings(self):
+    return self._store
+  
+  @filings.setter
+  def filings(self, filings):
+    #accepts a FilingStore or any list of filings (dicts, AttrDicts or views)
+    self._store = FilingStore.from_records(filings, schema=self.schema)
+    self._summaries = {}
+  
+  def _cached_summary(self, name, build):
+    #summary frames are rebuilt only after self.filings is replaced or written to
+    store = self.filings
+    try:
+      cached_store, version, frame = self._summaries[name]
+      if cached_store is store and version == store.version:
+        return frame.copy()
+    except (KeyError, AttributeError):
+      if not hasattr(self, '_summaries'): self._summaries = {}
+    frame = build()
+    self._summaries[name] = (store, store.version, frame)
+    return frame.copy()
     
   def __len__(self):
     return len(self.filings)
@@ -215,48 +332,34 @@ class LobbyData(object):
   def apply_filter(self, boolean_function, inplace=False):
     #filter out all filings (in-place) such that
     #	boolean_function(filings) != True
-    new_filings = []
-    for filing in self:
-      if boolean_function(filing):
-        new_filings.append(filing)
+    keep = [ i for i, filing in enumerate(self) if boolean_function(filing) ]
+    new_filings = self.filings.take(keep)
     if inplace:
       self.filings = new_filings
     else: 
       return type(self)(_filings = new_filings)
   
+  def _filing_summary(self):
+    summary = filing_summary_frame(self.filings)
+    summary['filing_index'] = np.arange(len(summary))
+    return summary
+  
   @property
   def summary(self):
-    #compute summary dataframe per-filing
-    summary_data = defaultdict(list)
-    for N, filing in enumerate(self):
-      for key, val in get_filing_summary(filing).items():
-        summary_data[key].append(val)
-      
-      summary_data['filing_index'].append(N)
-      #add an entry for income (lobby firm) + expenses (in-house)
-      #income = float(filing.income) if filing.income is not None else 0
-      #expenses = float(filing.expenses if filing.expenses is not None else 0
-      #summary_data['total_spend'].append(income+expenses)
-    ###add functionality to summarize each lobbying activity, with topics etc?
-    return pd.DataFrame(summary_data)
+    #summary dataframe per-filing (columns as in utils.get_filing_summary)
+    #	built column-wise from the filing store and cached until filings change
+    return self._cached_summary('summary', self._filing_summary)
   
   @property
   def activity_summary(self):
-    #compute summary dataframe per-lobby activity (intra-filing)
-    summary_data = defaultdict(list)
-    for N, filing in enumerate(self):
-      if hasattr(filing, 'lobbying_activities'):
-        filing_summary = get_filing_summary(filing)
-        activities = filing.lobbying_activities
-        #add an entry for income (lobby firm) + expenses (in-house)
-        for entry in activities:
-          activity_summary = get_activity_summary(entry)
-          for key, val in filing_summary.items():
-            summary_data[key].append(val)
-          for key, val in activity_summary.items():
-            summary_data[key].append(val)
-          summary_data['filing_index'].append(N)
-    return pd.DataFrame(summary_data)
+    #summary dataframe per-lobby activity (intra-filing)
+    def build():
+      summary = activity_summary_frame(self.filings)
+      if len(summary) > 0:
+        summary['filing_index'] = self.filings.tables['activities'].columns['_parent']
+      else: summary['filing_index'] = []
+      return summary
+    return self._cached_summary('activity_summary', build)
   
   def _filing_priority(self, filing1, filing2):
     #defines priority for filings; amendments > original 
@@ -270,38 +373,57 @@ class LobbyData(object):
     else:
        return False
   
+  def _criteria(self, filing):
+    return (filing.registrant.name, \
+            filing.filing_year, \
+            filing.filing_period, \
+            filing.client.name, \
+            #tuple(filing.affiliated_organizations)
+            )
+  
   @property
   def _criteria2idx(self):
     criteria2idx = defaultdict(list)
     for i, filing in enumerate(self):
-      criteria2idx[filing.registrant.name, \
-                   filing.filing_year, \
-                   filing.filing_period, \
-                   filing.client.name, \
-                   #tuple(filing.affiliated_organizations)
-                   ].append((filing.filing_type, i))
+      criteria2idx[self._criteria(filing)].append((filing.filing_type, i))
     return criteria2idx
   
-  def merge_amended(self, inplace=True):
+  def merge_amended(self, inplace=True, groups=None):
     #aggregate merge criteria: registrant, filing_year, filing_period
+    #	if groups (a set of criteria tuples) is passed, only those groups 
+    #	are re-resolved and all other filings are kept as they are
     
     criteria2idx = self._criteria2idx
     #take the last-posted amended version of each filing that is
     #	identical according to the criteria in criteria2idx
     #	with self._filing_priority as mapping function for sorted
     key = cmp_to_key(self._filing_priority)
+    keep = []
+    for criteria, filing_idx_ in criteria2idx.items():
+      if groups is None or criteria in groups:
+        keep.append(sorted([ idx for type_, idx in filing_idx_ ], \
+                           key=lambda idx: key(self[idx]))[-1])
+      else:
+        keep += [ idx for type_, idx in filing_idx_ ]
+    _filings = self.filings.take(keep)
     if inplace:
-      self.filings = [ sorted([ self[idx] for type_, idx in filing_idx_ ], \
-                       key=key)[-1] for filing_idx_ in criteria2idx.values() ]
+      self.filings = _filings
+      self._amendments_merged = True
     else: 
-      _filings = [ sorted([ self[idx] for type_, idx in filing_idx_ ], \
-                   key=key)[-1] for filing_idx_ in criteria2idx.values() ]
       return type(self)(_filings=_filings)
   
   def __getstate__(self):
-    return vars(self)
+    state = dict(vars(self))
+    state.pop('_summaries', None) #cached frames are rebuilt on demand
+    return state
   
   def __setstate__(self, state):
+    #defaults for attributes missing from objects saved by older versions
+    vars(self).update({ 'journal': None, 'query_kwargs': {}, 'watermarks': {}, 
+                        '_amendments_merged': False, '_summaries': {} })
+    if 'filings' in state: #list of AttrDicts in older versions
+      state = dict(state)
+      state['_store'] = FilingStore.from_records(state.pop('filings'), schema=self.schema)
     vars(self).update(state)
   
   def __iadd__(self, b):
@@ -317,11 +439,62 @@ class LobbyData(object):
     _cat_filings = self.filings + b.filings
     return LobbyData(_filings=_cat_filings)
   
-  def save(self, save_file=None):
+  #attributes written to the manifest of a save directory
+  _saved_attrs = ('save_file', 'paginate_wait', 'max_workers', 'query_kwargs', 
+                  '_amendments_merged', 'merges')
+  
+  def _check_writable(self, action):
+    #objects loaded with a subset of columns are read-only: writing them would
+    #	drop every column that was not loaded
+    unloaded = self.filings.unloaded()
+    if len(unloaded) > 0:
+      table_name = sorted(unloaded)[0]
+      raise ColumnsNotLoaded(table_name, unloaded[table_name], action=action)
+  
+  def save(self, save_file=None, format=None):
+    #format: 'feather' (default; memory-mappable), 'parquet', or 'pickle'
+    #	save files named *.pkl or *.pickle are pickled unless format is given
+    self._check_writable('save')
     assert save_file is not None or self.save_file is not None
     save_file = self.save_file if save_file is None else save_file
-    with open(save_file, 'wb') as out_file:
-      pickle.dump(self, out_file, pickle.HIGHEST_PROTOCOL) 
+    format = _save_format(save_file, format)
+    if format == 'pickle':
+      with open(save_file, 'wb') as out_file:
+        pickle.dump(self, out_file, pickle.HIGHEST_PROTOCOL) 
+      return
+    manifest = { 'class': type(self).__name__, 
+                 'store': persist.save_store(self.filings, save_file, format=format),
+                 'attrs': { attr: getattr(self, attr) for attr in self._saved_attrs \
+                                                      if hasattr(self, attr) },
+                 'journal': None if self.journal is None else self.journal.path, 
+                 'watermarks': [ [ list(map(list, key)), val ] for key, val in \
+                                                               self.watermarks.items() ] }
+    companyMatcher = getattr(self, 'companyMatcher', None)
+    if isinstance(companyMatcher, CompanyMatcher):
+      #the memo of reduced client names is kept next to the store
+      companyMatcher.save(os.path.join(save_file, company_memo_file))
+      manifest['company_matcher'] = { 'memo_file': companyMatcher.memo_file, 
+                                      'max_size': companyMatcher.max_size }
+    persist.write_manifest(save_file, manifest)
+  
+  @classmethod
+  def load(cls, save_file, columns=None, memory_map=True):
+    #loads a save directory written by self.save(); see lobbylinks.base.load
+    manifest = persist.read_manifest(save_file)
+    state = dict(manifest['attrs'])
+    state['_store'] = persist.load_store(save_file, manifest['store'], \
+                                         columns=columns, memory_map=memory_map)
+    state['journal'] = None if manifest['journal'] is None else \
+                       PageJournal(manifest['journal'])
+    state['watermarks'] = { tuple(map(tuple, key)): val for key, val in \
+                                                    manifest['watermarks'] }
+    data = cls.__new__(cls)
+    data.__setstate__(state)
+    data.issue_codes = IssueCodes()
+    data.companyMatcher = CompanyMatcher(**manifest.get('company_matcher', {}))
+    memo_file = os.path.join(save_file, company_memo_file)
+    if os.path.exists(memo_file): data.companyMatcher.load(memo_file)
+    return data
 
 
 class ContributionsData(LobbyData):
@@ -329,6 +502,9 @@ class ContributionsData(LobbyData):
   """Performs query upon initialization. All keywords are passed to the API call.\n"""\
   """See lobby_query_parameters.odt or LDA API documentation for guide to valid kwargs."""
   """Supports slicing, addition (filing concatenation), and inplace addition."""
+  endpoint = 'contributions/'
+  schema = contributions_schema
+  _saved_attrs = LobbyData._saved_attrs + ('contributor_merges',)
   def __init__(self, save_file=None, query_auth=None, \
                      load_from_save=False, _filings=None, **kwargs):
     super(ContributionsData, self).__init__(save_file=save_file, query_auth=query_auth, 
@@ -336,61 +512,44 @@ class ContributionsData(LobbyData):
                                             _filings=_filings,
                                             **kwargs)
   def query_LDAdb(self, query_auth=None, **kwargs):
-    #self.save_file = None
     #query_auth is a tuple (username, password) for registered LDA API users
     print('querying https://lda.senate.gov FECA Contributions API')
-    kwargs['page_size'] = 25 # max
-    try:
-      year_range = kwargs['filing_year']
-      if type(year_range) in [list, tuple]:
-        year_range = range(int(min(year_range)), 
-                           int(max(year_range)+1))
-      elif type(year_range) in [int, str]:
-        year_range = [year_range]
-    except KeyError: year_range = ['']
-    filings_server = 'https://lda.senate.gov/api/v1/contributions/' #main dir for filings
-    query = lambda q_parameters: requests.get(filings_server, \
-                   auth=query_auth, params=q_parameters)
-    all_results = []
-    #for filing_year in year_range:
-    for kwargs_ in build_queries(kwargs):
-      #kwargs_ = kwargs.copy()
-      #kwargs_['filing_year'] = filing_year
-      print('\ncurrent query', kwargs_, '\n')
-      r = query(kwargs_) #initial query
-      r_data = r.json()
-      filt = exact_search_filter(kwargs_)
-      
-      new_results = get_results(r_data, filt)
-      #iterate on 'next' to get all results matching the query
-      while len(new_results) > 0:
-        all_results += new_results
-        print('%i results received\r' % len(all_results), end='')
-        if self.paginate_wait is not None:
-            time.sleep(self.paginate_wait)
-        
-        new_results = get_results(r_data, filt)
-        try:
-          if r_data['next'] is None:
-            break
-        except KeyError:
-          break
-        r_ = requests.get(r_data['next'], auth=query_auth)
-        r_data = r_.json()
-        #new_results = [ AttrDict(filing) for filing 
-        #                    in r_data['results'] if filt(filing) ]
-      #filter for any exact string searches
-    return all_results
+    return self._query_server(query_auth, **kwargs)
   
-  def merge_names(self, companyMatcher=CompanyMatcher(), inplace=True):
+  def merge_names(self, companyMatcher=None, inplace=True):
     #merges company names using companyMatcher object, using the
     #	heuristics in resources.match_heuristics by default
+    #	(companyMatcher memoizes reduced names; pass CompanyMatcher(memo_file=...) to
+    #	keep them across runs)
+    companyMatcher = self._company_matcher(companyMatcher)
     #take the shortest name in the list of reduced names that actually occurred in the dataset
     #merged_filings = []
     merges = {};
     contributor_merges = {}
-    all_contributors = set()
-    for filing in self.filings:
+    self._merge_filing_names(self.filings, companyMatcher, merges, \
+                             contributor_merges=contributor_merges)
+    all_contributors = set([ contribution.contributor_name__merged_from_ for \
+                             filing in self.filings for contribution in \
+                             filing.contribution_items ])
+    self.merges = merges
+    self.contributor_merges = contributor_merges
+    self.companyMatcher = companyMatcher
+    n_pre_merge = len(set([ filing.registrant.name__merged_from_ \
+                                                for filing in self.filings ]))
+    n_post_merge = len(set([ filing.registrant.name for filing in self.filings ]))
+    print('merged %i registrants to %i registrants' % (n_pre_merge, n_post_merge))
+    print('merged %i contributors to %i contributors' % \
+                     (len(all_contributors), len(all_contributors) \
+                                                 - len(contributor_merges)))
+  
+  def _merge_filing_names(self, filings, companyMatcher, merges, contributor_merges=None):
+    if contributor_merges is None:
+      contributor_merges = self.contributor_merges
+    if hasattr(companyMatcher, 'prime'):
+      companyMatcher.prime([ filing.registrant.name for filing in filings ] + \
+                           [ contribution.contributor_name for filing in filings \
+                                            for contribution in filing.contribution_items ])
+    for filing in filings:
       #new_filing = filing.copy()
       registrant_name = filing.registrant.name
       filing.registrant.name__merged_from_ = registrant_name
@@ -400,21 +559,13 @@ class ContributionsData(LobbyData):
         merges[registrant_name] = merged_name
       for contribution in filing.contribution_items:
         contributor = contribution.contributor_name
-        all_contributors.add(contributor)
         contribution.contributor_name__merged_from_ = contributor
         merged_name = companyMatcher.reduce(contributor)
         if contributor != merged_name:
           contribution.contributor_name = merged_name
           contributor_merges[contributor] = merged_name
-    self.merges = merges
-    self.contributor_merges = contributor_merges
-    n_pre_merge = len(set([ filing.registrant.name__merged_from_ \
-                                                for filing in self.filings ]))
-    n_post_merge = len(set([ filing.registrant.name for filing in self.filings ]))
-    print('merged %i registrants to %i registrants' % (n_pre_merge, n_post_merge))
-    print('merged %i contributors to %i contributors' % \
-                     (len(all_contributors), len(all_contributors) \
-                                                 - len(contributor_merges)))
+    if getattr(companyMatcher, 'memo_file', None) is not None:
+      companyMatcher.save()
   
   def reset_names(self):
     for filing in self.filings:
@@ -435,42 +586,28 @@ class ContributionsData(LobbyData):
   
   @property
   def summary(self):
-    #compute summary dataframe per-filing
-    summary_data = defaultdict(list)
-    for filing in self:
-      for key, val in get_feca_filing_summary(filing).items():
-        summary_data[key].append(val)
-    return pd.DataFrame(summary_data)
+    #summary dataframe per-filing (columns as in utils.get_feca_filing_summary)
+    return self._cached_summary('summary', \
+                                lambda: feca_filing_summary_frame(self.filings))
   
   @property
   def contributions_summary(self):
-    #compute summary dataframe per-lobby activity (intra-filing)
-    summary_data = defaultdict(list)
-    for filing in self:
-      if hasattr(filing, 'contribution_items'):
-        filing_summary = get_feca_filing_summary(filing)
-        contributions = filing.contribution_items
-        for entry in contributions:
-          contribution_summary = get_contribution_summary(entry)
-          for key, val in filing_summary.items():
-            summary_data[key].append(val)
-          for key, val in contribution_summary.items():
-            summary_data[key].append(val)
-    return pd.DataFrame(summary_data)
+    #summary dataframe per contribution item (intra-filing)
+    def build():
+      filing_summary = self._cached_summary('summary', \
+                                   lambda: feca_filing_summary_frame(self.filings))
+      return contributions_summary_frame(self.filings, filing_summary=filing_summary)
+    return self._cached_summary('contributions_summary', build)
   
-  @property
-  def _criteria2idx(self):
-    criteria2idx = defaultdict(list)
-    for i, filing in enumerate(self):
-      criteria2idx[filing.registrant.name, \
-                   filing.filing_year, \
-                   filing.filing_period, \
-                   filing.filer_type, \
-                   tuple(filing.pacs), \
-                   (filing.lobbyist.id if filing.lobbyist \
-                                       is not None else None), \
-                   ].append((filing.filing_type, i))
-    return criteria2idx
+  def _criteria(self, filing):
+    return (filing.registrant.name, \
+            filing.filing_year, \
+            filing.filing_period, \
+            filing.filer_type, \
+            tuple(filing.pacs), \
+            (filing.lobbyist.id if filing.lobbyist \
+                                is not None else None), \
+            )
   
   def __iadd__(self, b):
     assert isinstance(b, ContributionsData)
@@ -487,6 +624,178 @@ class ContributionsData(LobbyData):
 
 othtitles_ = [ 'Chairman', 'Chair', 'Chrmn', 'Chr', 'Chairwoman', 'Chrwm', 'Chrwmn' ]
 
+#columns of a LobbyLinks graph
+graph_fields = [ 'client_name', 'legislator', 'edge_type', 'title', 'party', \
+                 'confidence', 'client_industry', 'contract_value', \
+                 'issue_name', 'issue_description', 'issue_code', 'lobbyist_id', \
+                 'lobbyist_name', 'currently_in_office', 'link_source_text', 
+                 'legislator_icpsr', 'legislator_govtrack', 'legislator_bioguide', 
+                 'legislator_thomas', 'filing_year', 'client_name_unmerged_',
+                 'income_per_lobbyist', 'registrant_id', ]
+_legislator_fields = [ 'legislator', 'edge_type', 'title', 'party', 'currently_in_office', 
+                       'legislator_icpsr', 'legislator_govtrack', 'legislator_bioguide', 
+                       'legislator_thomas' ]
+_in_office = { 'True': 1., 'False': 0. }
+
+def _legislator_columns(match):
+  #graph columns describing a matched legislator
+  title = 'Sen. ' if match.was_senate else \
+         ('Rep. ' if match.was_house else '') #title of highest office
+  return { 'legislator': title + match.full_name,
+           'edge_type': 'ClientOfLobbyistLinkedTo', #edge from client of lobbyist to
+                                                    #lobbyist's links via covered_positions
+           'title': title,
+           'party': match.terms[-1].party, #political party in most recent term
+           'currently_in_office': _in_office.get(match.currently_in_office, np.nan),
+           'legislator_icpsr': match.id.icpsr if hasattr(match.id, 'icpsr') else None,
+           'legislator_govtrack': match.id.govtrack if hasattr(match.id, 'govtrack') else None,
+           'legislator_bioguide': match.id.bioguide if hasattr(match.id, 'bioguide') else None,
+           'legislator_thomas': match.id.thomas if hasattr(match.id, 'thomas') else None }
+
+class NameResolver(object):
+  """matches the names extracted from covered positions to legislators, for
+  LobbyLinks.make_graph (and each of its worker processes).
+  args:
+  \tlegislators - handlers.Legislators object
+  \textractor - handlers.LegislatorExtractor (re-extracts wordninja splits)
+  \ttimeout - resources.timeouts.Deadline for proc_name, best_match and wordninja splits
+  kwargs:
+  \tninja - retry unmatched names split into words by wordninja
+  \tcache - cache.ExtractionCache consulted before matching
+  \tverbose - prints matching results
+  \tmax_matches - matches kept in memory, least recently used dropped first"""
+  def __init__(self, legislators, extractor, timeout, ninja=True, cache=None, verbose=False, \
+               max_matches=100000):
+    self.legislators = legislators
+    self.extractor = extractor
+    self.timeout = timeout
+    self.ninja = ninja
+    self.cache = cache
+    self.verbose = verbose
+    self.max_matches = max_matches
+    self.matches = OrderedDict()	#(name, branch, length, filing_year) -> (legislator index, score) or None
+    self.new_matches = {}	#matches scored here, not yet written to the cache
+  
+  def resolve(self, linked_names, filing_year):
+    #(legislator index, score) of each name in linked_names (from
+    #	LegislatorExtractor.extract) that matches a legislator
+    links = []
+    for name, (branch, length) in linked_names.items():
+      if self.verbose:
+        print('scoring %s %s' % (branch, name))
+      _proc_name = lambda: proc_name(name, length)
+      #	wraps name processing to enable timeout
+      processed_name = self.timeout.wrap(_proc_name, label=name)
+      if self.verbose: print(name, branch, length, processed_name)
+      #	fixes some common errors with NER output
+      if processed_name is None:
+        if self.verbose: print('timed out 2')
+        continue
+      name, length = processed_name
+      match_output = self.match(name, branch, length, filing_year)
+      if match_output is not None:
+        if self.verbose:
+          print('matched', self.legislators[match_output[0]].full_name)
+        links.append(match_output)
+      elif self.verbose: print('no match 1')
+    return links
+  
+  def match(self, name, branch, length, filing_year):
+    #(legislator index, score), or None if no legislator matched (or matching timed out)
+    key = (name, branch, length, filing_year)
+    if key in self.matches:
+      self.matches.move_to_end(key)
+      return self.matches[key]
+    if self.cache is not None:
+      try: return self._remember(key, self.cache.match(key))
+      except KeyError: pass
+    statuses = set()
+    match_output = self._best_match(name, branch, length, filing_year, statuses)
+    if match_output is not None and match_output[0] is not None:
+      match, score = match_output
+      match_output = (match.index, score)
+    else:
+      match_output = None # store no match
+    #no match and timed-out matches are cached as failures; errors are not cached
+    if match_output is not None or 'error' not in statuses:
+      self.new_matches[key] = match_output
+    return self._remember(key, match_output)
+  
+  def _remember(self, key, match_output):
+    #adds a match to the in-memory LRU, dropping the oldest past max_matches
+    self.matches[key] = match_output
+    if len(self.matches) > self.max_matches:
+      self.matches.popitem(last=False)
+    return match_output
+  
+  def _attempt(self, func, label, statuses):
+    #func() under the deadline, or None on timeout/error; adds 'ok', 'timeout' or 'error' to statuses
+    try:
+      output = self.timeout.run(func, label=label)
+      statuses.add('ok')
+      return output
+    except TimedOut:
+      statuses.add('timeout')
+    except Exception as exc:
+      statuses.add('error')
+      if self.verbose: print('error matching %s: %r' % (label, exc))
+  
+  def _best_match(self, name, branch, length, filing_year, statuses):
+    #try to find a match among legislators, else pass
+    last_name = True if length < 2 else False
+    match_fn = lambda: self.legislators.best_match(name, \
+                            last_name=last_name, \
+                            branch=branch, return_score=True, \
+                            filing_year=filing_year, \
+                            verbose=self.verbose)
+    match_output = self._attempt(match_fn, name, statuses)
+    
+    for oth in othtitles_:
+      if match_output is None or match_output[0] is None:
+        name_ = re.sub(r'^'+oth, '', name, flags=re.IGNORECASE)
+        if name_ != name:
+          match_output = self._attempt(match_fn, name, statuses)
+    
+    # if no results are returned, try a wordninja string split
+    if self.ninja and (match_output is None or match_output[0] is None):
+      ninja_fn = lambda: self.extractor.extract(' '.join(_wordninja().split(name)))
+      ninja_names_ = self._attempt(ninja_fn, name, statuses)
+      for name, (_, length) in (ninja_names_ or {}).items():
+        #try to find a match among legislators, else pass
+        last_name = True if length < 2 else False
+        match_fn = lambda: self.legislators.best_match(name, \
+                                last_name=last_name, \
+                                branch=branch, return_score=True, \
+                                filing_year=filing_year, \
+                                verbose=self.verbose)
+        match_output = self._attempt(match_fn, name, statuses)
+        if match_output is not None and match_output[0] is not None:
+          if self.verbose > 1:
+            print(f'\tninja matched \"{name}\" substring')
+          break
+    return match_output
+
+#graph-build worker processes (LobbyLinks(n_jobs > 1))
+_resolver = None
+
+def _init_resolver(legislators, spacy_model, ninja, timeout, cache, verbose):
+  #loads spaCy (and, on import, the name matchers) once per worker
+  global _resolver
+  _resolver = NameResolver(legislators, LegislatorExtractor(spacy_model=spacy_model), \
+                           ThreadTimeout(timeout=timeout), ninja=ninja, cache=cache, \
+                           verbose=verbose)
+
+def _resolve_task(task):
+  linked_names, filing_year = task
+  links = _resolver.resolve(linked_names, filing_year)
+  new_matches, _resolver.new_matches = _resolver.new_matches, {}
+  stats = _resolver.timeout.stats()
+  _resolver.timeout.reset()
+  cascade_stats = _resolver.legislators.cascade_stats.stats()
+  _resolver.legislators.cascade_stats.reset()
+  return links, new_matches, stats, cascade_stats
+
+
 class LobbyLinks(object):
   """main object for building client-congress links\n"""
   """arg:\n"""
@@ -497,12 +806,21 @@ class LobbyLinks(object):
   """LobbyLinks(legislators_handler=Legislators(min_year=2008)). Retrieves"""
   """legislators from min_year up to the present.\n"""
   """\tverbose_build - Boolean, False by default. Prints name extraction and"""
-  """matching results. Good for spot-checking extraction outputs."""
+  """matching results. Good for spot-checking extraction outputs.\n"""
+  """\tnlp_batch_size - covered positions per spaCy batch (nlp.pipe) during the build\n"""
+  """\tn_process - spaCy worker processes for name extraction\n"""
+  """\tn_jobs - number of worker processes matching names to legislators (1: no workers)\n"""
+  """\tcache - path of a sqlite file (or a cache.ExtractionCache) keeping extracted """
+  """names and legislator matches across builds, so that re-running on new filings """
+  """only processes text that has not been seen before\n"""
+  """\tmatch_timeout - seconds allowed for each name-processing/matching step. Steps that """
+  """time out are counted in self.timeout.counts (inputs in self.timeout.timed_out)"""
   def __init__(self, data=None, save_file=None, legislators_handler=None, 
                            issue_codes=None, verbose_build=False, 
                            merge_names=True, spacy_model='en_core_web_trf', 
                            companyMatcher=CompanyMatcher, ninja_postproc=True, 
-                           graph=None):
+                           graph=None, nlp_batch_size=64, n_process=1, n_jobs=1, 
+                           cache=None, match_timeout=5):
     assert isinstance(data, LobbyData) or data == None, "input must be a LobbyData object"
     if data is None:
         assert graph is not None, "either input a LobbyData object or the pre-built graph as a pandas dataframe (kwarg `graph`)"
@@ -516,7 +834,7 @@ class LobbyLinks(object):
     self.incl_codes = issue_codes
     
     #self.timeout = DummyTimeout()
-    self.timeout = TimeOutHandler(timeout=5) #sets 5-second timeout for name-matching step
+    self.timeout = Deadline(timeout=match_timeout) #timeout for each name-matching step
     
     if legislators_handler is None: 
       #default settings: only legislators who were in office in 1990
@@ -527,168 +845,248 @@ class LobbyLinks(object):
     #  self.filing_data.merge_names(companyMatcher=companyMatcher)
     self.issue_codes = IssueCodes()
     #self.name_extractor = NEExtractor()
+    self.spacy_model = spacy_model
+    self.nlp_batch_size = nlp_batch_size
+    self.n_process = n_process
+    self.n_jobs = n_jobs
     self.legislator_extractor = LegislatorExtractor(spacy_model=spacy_model)
     self.legislators = legislators_handler
+    if isinstance(cache, str):
+      cache = ExtractionCache(cache, namespace=self.cache_namespace())
+    self.cache = cache
     if graph is None:
       self.graph = self.make_graph(verbose_build=verbose_build)
     else: self.graph = graph
   
   def make_graph(self, verbose_build=False):
-    graph_data = defaultdict(list)
-    graph_fields = [ 'client_name', 'legislator', 'edge_type', 'title', 'party', \
-                     'confidence', 'client_industry', 'contract_value', \
-                     'issue_name', 'issue_description', 'issue_code', 'lobbyist_id', \
-                     'lobbyist_name', 'currently_in_office', 'link_source_text', 
-                     'legislator_icpsr', 'legislator_govtrack', 'legislator_bioguide', 
-                     'legislator_thomas', 'filing_year', 'client_name_unmerged_',
-                     'income_per_lobbyist', 'registrant_id', ]
-                     #later runs eval(name) on each varname
-    
     print('building lobby network')
-    # speed things up by tracking already identified text
-    text2legislator_idx = {}
-    covered_position2names = {}
-    
-    for N, filing in enumerate(tqdm(self.filing_data.filings)):
-      client_name = filing.client.name
-      
-      #lobbyist_id = filing.registrant.id
-      client_industry = str(filing.client.general_description)
-      contract_value = (float(filing.income) if filing.income is not None else 0)
-      activities = filing.lobbying_activities
-      filing_year = filing.filing_year
-      registrant_id = filing.registrant.id
-      if hasattr(filing.client, 'name__merged_from_'):
-          client_name_unmerged_ = filing.client.name__merged_from_
-      else:
-          client_name_unmerged_ = filing.client.name
-      for activity in activities:
-        issue_description = activity.description
-        issue_code = activity.general_issue_code
-        issue_name = self.issue_codes[issue_code]
-        lobbyists = activity.lobbyists
-        lobbyist_ids_ = set([ l.lobbyist.id for l in lobbyists ])
-        if self.incl_codes is None or issue_code in self.incl_codes:
-          for lobbyist in lobbyists:
-            lobbyist_id = lobbyist.lobbyist.id
-            lobbyist_name = ' '.join([ lobbyist.lobbyist[k] for k in \
-                                lobby_namesort(lobbyist.lobbyist) if \
-                                lobbyist.lobbyist[k] is not None ])
-            covered_position = lobbyist.covered_position
-            link_source_text = covered_position
-            income_per_lobbyist = contract_value/len(lobbyist_ids_)
-            if covered_position is not None:
-              try:
-                  linked_names = covered_position2names[covered_position]
-              except KeyError:
-                  linked_names = self.legislator_extractor.extract(covered_position)
-                  covered_position2names[covered_position] = linked_names
-              for name, (branch, length) in linked_names.items():
-                if verbose_build:
-                  print('scoring %s %s' % (branch, name))
-                _proc_name = lambda: proc_name(name, length)
-                #	wraps name processing to enable timeout
-                processed_name = self.timeout.wrap(_proc_name)
-                print(name, branch, length, processed_name)
-                #	fixes some common errors with NER output
-                if processed_name is not None:
-                  name, length = processed_name
-                  try:
-                    # try to retrieve match output if it already exists
-                    #leg_id, score_ = text2legislator_idx[(name, branch, length)]
-                    match_output = text2legislator_idx[(name, branch, length)]
-                    if match_output is not None:
-                      leg_id, score_ = match_output
-                      match_output = (self.legislators[leg_id], score_)
-                    
-                    #match_output = text2legislator_idx[(name, branch length)]
-                  except KeyError:
-                    #try to find a match among legislators, else pass
-                    last_name = True if length < 2 else False
-                    match_fn = lambda: self.legislators.best_match(name, \
-                                            last_name=last_name, \
-                                            branch=branch, return_score=True, \
-                                            filing_year=filing_year, \
-                                            verbose=verbose_build)
-                    match_output = self.timeout.wrap(match_fn)
-                    
-                    for oth in othtitles_:
-                      if match_output is None or match_output[0] is None:
-                        name_ = re.sub(r'^'+oth, '', name, flags=re.IGNORECASE)
-                        if name_ != name:
-                          match_output = self.timeout.wrap(match_fn)
-                    
-                    # if no results are returned, try a wordninja string split
-                    if self.ninja and (match_output is None or match_output[0] is None):
-                      ninja_name = ' '.join(wordninja.split(name))
-                      ninja_names_ = self.legislator_extractor.extract(ninja_name)
-                      #print('ninja', ninja_name, ninja_names_)
-                      for name, (_, length) in ninja_names_.items():
-                        #try to find a match among legislators, else pass
-                        last_name = True if length < 2 else False
-                        match_fn = lambda: self.legislators.best_match(name, \
-                                                last_name=last_name, \
-                                                branch=branch, return_score=True, \
-                                                filing_year=filing_year, \
-                                                verbose=verbose_build)
-                        match_output = self.timeout.wrap(match_fn)
-                        if match_output is not None and match_output[0] is not None:
-                          if verbose_build > 1:
-                            print(f'\tninja matched \"{name}\" substring')
-                          break
-                    
-                    if match_output is not None:
-                      match, score = match_output
-                      if match is not None:
-                        text2legislator_idx[(name, branch, length)] = (match.index, score)
-                      else:
-                        text2legislator_idx[(name, branch, length)] = None
-                    else:
-                      text2legislator_idx[(name, branch, length)] = None # store no match
-                  
-                  if match_output is not None:
-                    match, score = match_output
-                    #print(match)
-                    #
-                    if match is not None:
-                      title = 'Sen. ' if match.was_senate else \
-                             ('Rep. ' if match.was_house else '') 
-                                          #title of highest office
-                      legislator = title + match.full_name
-                      confidence = score
-                      currently_in_office = float(eval(match.currently_in_office))
-                      legislator_icpsr = match.id.icpsr if hasattr( \
-                                         match.id, 'icpsr') else None
-                      legislator_govtrack = match.id.govtrack if hasattr( \
-                                            match.id, 'govtrack') else None
-                      legislator_bioguide = match.id.bioguide if hasattr( \
-                                            match.id, 'bioguide') else None
-                      legislator_thomas = match.id.thomas if hasattr( \
-                                          match.id, 'thomas') else None
-                      
-                      edge_type = 'ClientOfLobbyistLinkedTo' #edge from client of 
-                                                             #lobbyist to lobbyist's links 
-                                                             #via covered_positions
-                      party = match.terms[-1].party #political party in most recent term
-                      #add an entry to the graph_data dict
-                      if verbose_build:
-                        print('matched', match.full_name)
-                      for field in graph_fields:
-                        graph_data[field].append(eval(field)) #append the extracted values
-                      graph_data['filing_index'].append(N)
-                  else:
-                    if verbose_build: print('no match 1')
-                else:
-                  if verbose_build: print('timed out 2')
-                if verbose_build > 1: print('source text:', covered_position)
-    GraphData = pd.DataFrame(graph_data)
-    return GraphData
-  
-  def save(self, save_file=None):
+    batches = list(self.iter_graph(batch_size=None, verbose_build=verbose_build))
+    if len(batches) == 0:
+      return pd.DataFrame({ field: [] for field in graph_fields + ['filing_index'] })
+    return pd.concat(batches, ignore_index=True)
+  
+  def iter_graph(self, batch_size=5000, start=0, verbose_build=False):
+    """yields the graph as DataFrames holding the edges of `batch_size` filings at a time
+    (None for all filings at once), starting at filing index `start`.
+    Within each batch, phase one matches each distinct (covered_position, filing_year)
+    to legislators, and phase two joins the flattened lobbyist table to those matches,
+    giving one row per (lobbyist, matched legislator) in filing order."""
+    store = self.filing_data.filings
+    batch_size = len(store) if batch_size is None else batch_size
+    resolver = NameResolver(self.legislators, self.legislator_extractor, self.timeout, \
+                            ninja=self.ninja, cache=self.cache, verbose=verbose_build)
+    pool = None
+    if getattr(self, 'n_jobs', 1) > 1:
+      #workers load spaCy/the name matchers once, and use a thread-based timeout
+      pool = ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_resolver, \
+                                 initargs=(self.legislators, self.spacy_model, self.ninja, \
+                                           self.timeout.timeout, self.cache, verbose_build))
+    try:
+      for begin in range(start, len(store), max(batch_size, 1)):
+        end = min(begin + batch_size, len(store))
+        batch = store if (begin, end) == (0, len(store)) else store.take(np.arange(begin, end))
+        covered_position2names = self._extract_covered_positions(batch)
+        links = self._resolve_links(batch, covered_position2names, resolver, pool=pool)
+        lobbyists = lobbyist_frame(batch, self.issue_codes, incl_codes=self.incl_codes)
+        lobbyists['filing_index'] += begin
+        edges = lobbyists.merge(self._link_table(links), how='inner', \
+                                on=['link_source_text', 'filing_year'])
+        edges = edges.sort_values(['_row', '_link'], kind='stable')
+        #only this batch's extractions are held and matches are a bounded LRU
+        #	(max_matches), so memory stays flat across batches; the cache, if
+        #	any, only saves recomputing earlier results
+        if self.cache is not None: self.cache.put_matches(resolver.new_matches)
+        resolver.new_matches = {}; covered_position2names = links = None
+        yield edges[graph_fields + ['filing_index']].reset_index(drop=True)
+    finally:
+      if pool is not None: pool.shutdown()
+      if self.cache is not None: self.cache.put_matches(resolver.new_matches)
+      counts = getattr(self.timeout, 'counts', {})
+      if counts.get('timeout', 0) + counts.get('error', 0) > 0:
+        print('name matching: ' + self.timeout.summary())
+  
+  def write_graph(self, path, format='parquet', batch_size=5000, resume=True, \
+                        verbose_build=False):
+    """builds the graph batch by batch into directory `path`, partitioned by filing year
+    (path/filing_year=<year>/part-<first filing index>.<format>). Progress is recorded
+    after each batch, so an interrupted build restarts from the last completed batch
+    (pass resume=False to start over). Read the result with LobbyLinks.read_graph(path).
+    kwargs:
+    \tformat - 'parquet', 'feather' or 'csv'
+    \tbatch_size - filings per batch"""
+    n_filings = len(self.filing_data.filings)
+    progress = persist.read_graph_progress(path) if resume else None
+    if progress is not None:
+      assert progress['n_filings'] == n_filings and progress['format'] == format, \
+        'the graph in %s was built from other filings or in another format; ' % path + \
+        'pass resume=False to rebuild it'
+      start, parts = progress['next_filing'], progress['parts']
+      print('resuming graph build at filing %i of %i' % (start, n_filings))
+    else:
+      start, parts = 0, []
+    #drop output of a batch that was being written when an earlier build stopped
+    persist.remove_graph_parts(path, min_part=start)
+    persist.write_graph_progress(path, { 'n_filings': n_filings, 'format': format, \
+                                         'next_filing': start, 'parts': parts })
+    for i, edges in enumerate(self.iter_graph(batch_size=batch_size, start=start, \
+                                              verbose_build=verbose_build)):
+      begin = start + i*batch_size
+      parts = parts + persist.write_graph_part(edges, path, begin, format=format)
+      persist.write_graph_progress(path, { 'n_filings': n_filings, 'format': format, \
+                                           'next_filing': min(begin + batch_size, n_filings), \
+                                           'parts': parts })
+    return path
+  
+  @staticmethod
+  def read_graph(path, columns=None):
+    """graph DataFrame written by write_graph, in filing order"""
+    return persist.load_graph_parts(path, persist.read_graph_progress(path)['parts'], \
+                                    columns=columns)
+  
+  def _link_table(self, links):
+    #resolution table: one row per (covered_position, filing_year, matched legislator)
+    table = defaultdict(list)
+    legislator_columns = {}
+    for (covered_position, filing_year), matches in links.items():
+      for i, (leg_id, score) in enumerate(matches):
+        if leg_id not in legislator_columns:
+          legislator_columns[leg_id] = _legislator_columns(self.legislators[leg_id])
+        table['link_source_text'].append(covered_position)
+        table['filing_year'].append(filing_year)
+        table['_link'].append(i)
+        table['confidence'].append(score)
+        for field, value in legislator_columns[leg_id].items():
+          table[field].append(value)
+    columns = [ 'link_source_text', 'filing_year', '_link', 'confidence' ] + _legislator_fields
+    return pd.DataFrame({ field: table[field] for field in columns })
+  
+  def _link_items(self, store):
+    #distinct (covered_position, filing_year) pairs of the lobbyists in (included)
+    #	activities, in order of first appearance
+    lobbyists = store.tables['lobbyists']
+    if len(lobbyists) == 0: return []
+    ids = lobbyists.columns['covered_position']
+    filing_years = store.tables['filings'].columns['filing_year'][lobbyists.columns['_filing']]
+    keep = ids >= 0
+    if self.incl_codes is not None:
+      codes = store.tables['activities'].columns['general_issue_code'][lobbyists.columns['_parent']]
+      keep &= np.isin(codes, self.incl_codes)
+    texts = store.texts('covered_positions')
+    return list(dict.fromkeys( (texts[i], year) for i, year in \
+                               zip(ids[keep], filing_years[keep].tolist()) ))
+  
+  def _resolve_links(self, store, covered_position2names, resolver, pool=None):
+    #(covered_position, filing_year) -> [ (legislator index, score), ... ] for each
+    #	name in the covered position that matches a legislator
+    items = self._link_items(store)
+    tasks = [ (covered_position2names[covered_position], filing_year) \
+              for covered_position, filing_year in items ]
+    print('matching names for %i distinct covered positions and filing years' % len(items))
+    if pool is not None and len(tasks) > 1:
+      #pool.map keeps results in task order, so the graph matches a serial build
+      chunksize = max(1, len(tasks)//(8*self.n_jobs))
+      results = list(tqdm(pool.map(_resolve_task, tasks, chunksize=chunksize), total=len(tasks)))
+      resolutions = [ links for links, _, _, _ in results ]
+      for _, matches, stats, cascade_stats in results:
+        resolver.new_matches.update(matches)
+        self.timeout.add_stats(stats)
+        self.legislators.cascade_stats.add_stats(cascade_stats)
+    else:
+      resolutions = []
+      for linked_names, filing_year in tqdm(tasks):
+        resolutions.append(resolver.resolve(linked_names, filing_year))
+        if self.cache is not None and len(resolver.new_matches) >= 1000:
+          self.cache.put_matches(resolver.new_matches); resolver.new_matches = {}
+    return dict(zip(items, resolutions))
+  
+  def cache_namespace(self):
+    #key of everything cached extraction/match results depend on
+    return namespace_key(spacy_model=self.spacy_model, matcher=matcher_fingerprint(self.legislators), \
+                         legislators=self.legislators.fingerprint, \
+                         blocking=getattr(self.legislators, 'blocking', False), ninja=self.ninja, \
+                         cascade=getattr(self.legislators, 'cascade', legacy_cascade))
+  
+  def _covered_positions(self, store):
+    #distinct covered_position texts of the lobbyists in (included) activities
+    lobbyists = store.tables['lobbyists']
+    if len(lobbyists) == 0: return []
+    ids = lobbyists.columns['covered_position']
+    if self.incl_codes is not None:
+      codes = store.tables['activities'].columns['general_issue_code'][lobbyists.columns['_parent']]
+      ids = ids[np.isin(codes, self.incl_codes)]
+    texts = store.texts('covered_positions')
+    return [ texts[i] for i in np.unique(ids) if i >= 0 ]
+  
+  def _extract_covered_positions(self, store):
+    #extracts names from every distinct covered position ahead of
+    #	matching, streaming them through spaCy in batches, so that the legislator
+    #	name scorer can also embed all of them in batches
+    print('extracting names from covered positions')
+    extractor = self.legislator_extractor
+    covered_positions = self._covered_positions(store)
+    if self.cache is None:
+      covered_position2names = extractor.extract_batch(covered_positions, \
+                                  batch_size=self.nlp_batch_size, n_process=self.n_process)
+    else:
+      #only text not seen in earlier builds goes through spaCy
+      normalized = { text: extractor.normalize(text) for text in covered_positions }
+      cached = self.cache.names(normalized.values())
+      new_texts = [ text for text in covered_positions if normalized[text] not in cached ]
+      extracted = extractor.extract_batch(new_texts, batch_size=self.nlp_batch_size, \
+                                          n_process=self.n_process)
+      self.cache.put_names({ normalized[text]: names for text, names in extracted.items() })
+      print('%i of %i covered positions found in cache' % \
+            (len(covered_positions) - len(new_texts), len(covered_positions)))
+      covered_position2names = { text: cached[normalized[text]] if text not in extracted \
+                                       else extracted[text] for text in covered_positions }
+    names_ = []
+    for linked_names in covered_position2names.values():
+      for name, (branch, length) in linked_names.items():
+        processed_name = self.timeout.wrap(lambda: proc_name(name, length))
+        if processed_name is not None and processed_name[1] > 1:
+          names_.append(processed_name[0])
+    self.legislators.prime(names_)
+    return covered_position2names
+  
+  def save(self, save_file=None, format=None):
+    #format: 'feather' (default), 'parquet', or 'pickle' (*.pkl/*.pickle names)
+    #	the graph and the filing data are written as tables of a save directory
     assert save_file is not None or self.save_file is not None
     save_file = self.save_file if save_file is None else save_file
-    with open(save_file, 'wb') as out_file:
-      pickle.dump(self, out_file, pickle.HIGHEST_PROTOCOL) 
+    format = _save_format(save_file, format)
+    if format == 'pickle':
+      with open(save_file, 'wb') as out_file:
+        pickle.dump(self, out_file, pickle.HIGHEST_PROTOCOL) 
+      return
+    os.makedirs(save_file, exist_ok=True)
+    manifest = { 'class': type(self).__name__, 
+                 'graph': persist.save_frame(self.graph, save_file, 'graph', format=format),
+                 'filing_data': None, 
+                 'attrs': { 'save_file': self.save_file, 'ninja': self.ninja, 
+                            'incl_codes': self.incl_codes, 
+                            'spacy_model': getattr(self, 'spacy_model', 'en_core_web_trf'),
+                            'min_year': self.legislators.min_year, 
+                            'max_year': self.legislators.max_year } }
+    if self.filing_data is not None:
+      self.filing_data.save(os.path.join(save_file, 'filing_data'), format=format)
+      manifest['filing_data'] = 'filing_data'
+    persist.write_manifest(save_file, manifest)
+  
+  @classmethod
+  def load(cls, save_file, columns=None, memory_map=True):
+    #loads a save directory written by self.save(); columns selects graph columns
+    manifest = persist.read_manifest(save_file)
+    attrs = manifest['attrs']
+    graph = persist.load_frame(save_file, manifest['graph'], columns=columns, \
+                               memory_map=memory_map)
+    data = None if manifest['filing_data'] is None else \
+           load(os.path.join(save_file, manifest['filing_data']), memory_map=memory_map)
+    legislators = Legislators(min_year=int(attrs['min_year']), \
+                              max_year=int(attrs['max_year']))
+    links = cls(data, graph=graph, save_file=attrs['save_file'], 
+                legislators_handler=legislators, issue_codes=attrs['incl_codes'], 
+                spacy_model=attrs['spacy_model'], ninja_postproc=attrs['ninja'])
+    return links
   
   def extrapolate_links_from_identifier(self, id_field='lobbyist_id'):
     graph = self.graph.copy()
@@ -792,6 +1190,8 @@ class LobbyLinks(object):
     #graph_summed = graph.groupby(['legislator', 'edge_type', \
     #                              group_by, 'currently_in_office', \
     #                              'title' ]).sum().reset_index()
+    import networkx as nx
+    from pyvis.network import Network
     G = nx.from_pandas_edgelist(graph, source=group_by, \
                                 target='legislator', edge_attr='confidence')
     graph_viz_net = Network(height, width, notebook=True, directed=False)
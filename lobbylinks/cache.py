@@ -0,0 +1,97 @@
+#persistent cache of graph-build results, shared across LobbyLinks.make_graph runs
+#	covered_position text (normalized) -> names extracted by LegislatorExtractor, and
+#	(name, branch, length, filing_year) -> matched legislator index and score.
+#	Entries live in a namespace keyed by the spaCy model, the name-matching model
+#	and the legislator list, so changing any of them starts from an empty cache.
+
+import json
+import sqlite3
+import hashlib
+import threading
+
+_chunk_size = 500	#keys per sqlite IN (...) query
+
+
+def namespace_key(**parts):
+  #short, order-independent key for the settings results depend on
+  return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _match_key(key):
+  #sqlite-friendly (name, branch, length, filing_year); numpy scalars are not
+  name, branch, length, filing_year = key
+  return (str(name), str(branch), int(length), None if filing_year is None else int(filing_year))
+
+
+class ExtractionCache(object):
+  """sqlite cache of extracted names and legislator matches.
+  arg:
+  \tpath - sqlite file; created if it does not exist
+  kwargs:
+  \tnamespace - key of the models/legislators the results depend on (see namespace_key)"""
+  def __init__(self, path, namespace=''):
+    self.path = path
+    self.namespace = namespace
+    self.lock = threading.Lock()
+    self._connect()
+
+  def _connect(self):
+    self.conn = sqlite3.connect(self.path, check_same_thread=False)
+    with self.conn:
+      self.conn.execute('CREATE TABLE IF NOT EXISTS names (namespace TEXT, text TEXT, '
+                        'names TEXT, PRIMARY KEY (namespace, text))')
+      self.conn.execute('CREATE TABLE IF NOT EXISTS matches (namespace TEXT, name TEXT, '
+                        'branch TEXT, length INTEGER, filing_year INTEGER, legislator INTEGER, '
+                        'score REAL, PRIMARY KEY (namespace, name, branch, length, filing_year))')
+
+  def names(self, texts):
+    #cached extraction results for texts, as dict text -> { name: (branch, length) }
+    texts = list(dict.fromkeys(texts))
+    out = {}
+    with self.lock:
+      for i in range(0, len(texts), _chunk_size):
+        chunk = texts[i:i+_chunk_size]
+        rows = self.conn.execute('SELECT text, names FROM names WHERE namespace = ? AND text IN '
+                                 '(%s)' % ','.join('?'*len(chunk)), [ self.namespace ] + chunk)
+        for text, names in rows:
+          out[text] = { name: tuple(value) for name, value in json.loads(names).items() }
+    return out
+
+  def put_names(self, text2names):
+    with self.lock, self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO names VALUES (?, ?, ?)', \
+                            [ (self.namespace, text, json.dumps(names)) \
+                              for text, names in text2names.items() ])
+
+  def match(self, key):
+    #(legislator index, score) for key = (name, branch, length, filing_year), None if
+    #	no legislator matched, and KeyError if the key was never scored
+    with self.lock:
+      row = self.conn.execute('SELECT legislator, score FROM matches WHERE namespace = ? AND '
+                              'name = ? AND branch = ? AND length = ? AND filing_year IS ?', \
+                              (self.namespace,) + _match_key(key)).fetchone()
+    if row is None: raise KeyError(key)
+    return None if row[0] is None else (row[0], row[1])
+
+  def put_matches(self, key2match):
+    #key2match - dict (name, branch, length, filing_year) -> (legislator index, score) or None
+    with self.lock, self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO matches VALUES (?, ?, ?, ?, ?, ?, ?)', \
+                            [ (self.namespace,) + _match_key(key) + \
+                              ((None, None) if match is None else (int(match[0]), float(match[1]))) \
+                              for key, match in key2match.items() ])
+
+  def __len__(self):
+    with self.lock:
+      return sum(self.conn.execute('SELECT COUNT(*) FROM %s WHERE namespace = ?' % table, \
+                                   (self.namespace,)).fetchone()[0] for table in ('names', 'matches'))
+
+  def close(self):
+    self.conn.close()
+
+  def __getstate__(self):
+    #only the path and namespace are pickled; the database is reopened
+    return { 'path': self.path, 'namespace': self.namespace }
+
+  def __setstate__(self, state):
+    self.__init__(state['path'], namespace=state['namespace'])
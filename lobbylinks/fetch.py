@@ -0,0 +1,254 @@
+#concurrent, rate-limit-aware pagination over the LDA REST API
+#	pages of each query are addressed by number (`page`/`page_size`), so once the
+#	first page reports the result count every remaining page can be fetched in parallel
+
+import time
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+lda_server = 'https://lda.senate.gov/api/v1/'
+
+#headers used by the LDA API (and most DRF deployments) to report quotas
+limit_headers = ('X-RateLimit-Limit', 'RateLimit-Limit')
+remaining_headers = ('X-RateLimit-Remaining', 'RateLimit-Remaining')
+reset_headers = ('X-RateLimit-Reset', 'RateLimit-Reset')
+retry_statuses = { 429, 500, 502, 503, 504 }
+
+
+def _header_value(headers, keys):
+  for key in keys:
+    try: return float(headers[key])
+    except (KeyError, TypeError, ValueError): pass
+  return None
+
+def _retry_after(headers):
+  #Retry-After is either a number of seconds or an HTTP date
+  value = headers.get('Retry-After')
+  if value is None: return None
+  try: return max(0., float(value))
+  except ValueError: pass
+  try: return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError): return None
+
+
+class TokenBucket(object):
+  """Thread-safe token bucket shared by all fetch workers.
+  kwargs:
+  \trate - tokens (requests) per second; None disables client-side limiting
+  \tcapacity - maximum burst size
+  The refill rate is re-estimated from the server's rate-limit headers with
+  self.update(headers), and self.block(seconds) pauses every worker (e.g. on 429)."""
+  def __init__(self, rate=None, capacity=1):
+    self.rate = None if rate is None else float(rate)
+    self.capacity = float(capacity)
+    self.tokens = float(capacity)
+    self.updated = time.monotonic()
+    self.blocked_until = 0.
+    self.lock = threading.Lock()
+
+  def _refill(self, now):
+    if self.rate is not None:
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+    self.updated = now
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self._refill(now)
+        if now >= self.blocked_until:
+          if self.rate is None:
+            return
+          if self.tokens >= 1:
+            self.tokens -= 1
+            return
+          wait = (1 - self.tokens)/self.rate
+        else:
+          wait = self.blocked_until - now
+      time.sleep(wait)
+
+  def block(self, seconds):
+    with self.lock:
+      self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+      self.tokens = 0.
+
+  def update(self, headers):
+    #re-estimate the refill rate so the remaining quota is spread over the
+    #	remainder of the server's rate-limit window
+    remaining = _header_value(headers, remaining_headers)
+    reset = _header_value(headers, reset_headers)
+    if remaining is None or reset is None:
+      return
+    if reset > 1e9: #epoch timestamp rather than seconds-until-reset
+      reset = reset - time.time()
+    reset = max(reset, 1.)
+    if remaining < 1:
+      self.block(reset)
+    else:
+      with self.lock:
+        self.rate = remaining/reset
+        limit = _header_value(headers, limit_headers)
+        if limit is not None:
+          self.capacity = max(1., min(self.capacity, limit))
+
+
+class PageFetcher(object):
+  """Fetches every page of a set of LDA API queries with a pool of worker threads.
+  args:
+  \tendpoint - API endpoint relative to lda_server, e.g. 'filings/'
+  kwargs:
+  \tquery_auth - (username, api_key) tuple for registered LDA API users
+  \tmax_workers - number of concurrent requests
+  \trate - initial requests/second, until the server reports its quota
+  \tpage_size - results per page (25 is the API maximum)
+  \tmax_retries - attempts per page before giving up (429/5xx/connection errors)"""
+  def __init__(self, endpoint='filings/', query_auth=None, max_workers=8,
+                     rate=None, page_size=25, max_retries=8, backoff=2.,
+                     timeout=60, verbose=True):
+    self.server = endpoint if endpoint.startswith('http') else lda_server + endpoint
+    self.max_workers = max_workers
+    self.page_size = page_size
+    if max_retries < 1: raise ValueError('max_retries must be at least 1, got %r' % (max_retries,))
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.verbose = verbose
+    self.limiter = TokenBucket(rate=rate, capacity=max(1, max_workers))
+    self.session = requests.Session()
+    self.session.auth = query_auth
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+
+  def page_url(self, params):
+    return requests.Request('GET', self.server, params=params).prepare().url
+
+  def get(self, url):
+    #rate-limited GET with backoff; returns the decoded json payload
+    for attempt in range(self.max_retries):
+      self.limiter.acquire()
+      try:
+        r = self.session.get(url, timeout=self.timeout)
+      except requests.RequestException as exc:
+        error = exc
+        time.sleep(self.backoff**attempt)
+        continue
+      self.limiter.update(r.headers)
+      if r.status_code in retry_statuses:
+        wait = _retry_after(r.headers)
+        if wait is None: wait = self.backoff**attempt
+        if r.status_code == 429:
+          self.limiter.block(wait)	#every worker waits out the quota
+        else:
+          time.sleep(wait)
+        error = requests.HTTPError('%i response for %s' % (r.status_code, url))
+        continue
+      r.raise_for_status()
+      try:
+        return r.json()
+      except ValueError as exc: #truncated or malformed payload, retry
+        error = exc
+        time.sleep(self.backoff**attempt)
+    raise error
+
+  def _page_params(self, query, page):
+    params = dict(query)
+    params['page_size'] = self.page_size
+    params['page'] = page
+    return params
+
+  def _fetch_page(self, query, page, journal=None):
+    params = self._page_params(query, page)
+    url = self.page_url(params)
+    r_data = self.get(url)
+    if journal is not None:
+      journal.record(params, page, url, r_data)
+    return url, r_data
+
+  def _probe(self, query, page, journal=None):
+    #(page, (url, page_data)) of the first page not complete in the journal; when the
+    #	journal holds every page of a result set that fills its last page, that page
+    #	is past the end (404), so the last journaled page is requested again instead
+    try:
+      return page, self._fetch_page(query, page, journal)
+    except requests.HTTPError as exc:
+      if page == 1 or exc.response is None or exc.response.status_code != 404: raise
+      return page - 1, self._fetch_page(query, page - 1, journal)
+
+  def _follow_next(self, query, page, r_data, journal=None):
+    #fallback for responses that don't report a result count
+    pages = []
+    while r_data.get('next') is not None:
+      page += 1
+      url = r_data['next']
+      r_data = self.get(url)
+      if journal is not None:
+        journal.record(self._page_params(query, page), page, url, r_data)
+      pages.append((url, r_data))
+    return pages
+
+  def _final_pages(self, query, journal):
+    #journaled pages that are complete; the last (partial) page of a query is
+    #	always requested again, since it is where newly posted results appear
+    if journal is None: return {}
+    return { page: (url, r_data) for page, url, r_data in \
+                   journal.pages_of(self._page_params(query, 1)) \
+                   if len(r_data.get('results', [])) >= self.page_size }
+
+  def fetch(self, queries, journal=None):
+    """Fetches all pages for each query dict in `queries`.
+    Returns a list (one entry per query, in order) of lists of (page_url, page_data),
+    in page order. With a PageJournal, complete pages already in the journal are not
+    requested again and every received page is appended to the journal."""
+    queries = list(queries)
+    pages = [ self._final_pages(q, journal) for q in queries ]
+    n_pages = [ None for q in queries ]
+    if journal is not None:
+      n_final = sum(len(q_pages) for q_pages in pages)
+      if n_final > 0 and self.verbose:
+        print('resuming from journal: %i complete pages' % n_final)
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      #the first missing page of each query reports its result count
+      futures = {}
+      for i, q in enumerate(queries):
+        probe = 1
+        while probe in pages[i]: probe += 1
+        futures[pool.submit(self._probe, q, probe, journal)] = i
+      followups = {}
+      for future in as_completed(futures):
+        i = futures[future]
+        page, (url, r_data) = future.result()
+        pages[i][page] = (url, r_data)
+        count = r_data.get('count')
+        if count is None:
+          followups[pool.submit(self._follow_next, queries[i], page, \
+                                r_data, journal)] = (i, page)
+          continue
+        n_pages[i] = int(math.ceil(count/float(self.page_size)))
+        for page_ in range(1, n_pages[i]+1):
+          if page_ not in pages[i]:
+            followups[pool.submit(self._fetch_page, queries[i], \
+                                  page_, journal)] = (i, page_)
+
+      if self.verbose and len(followups) > 0:
+        print('fetching %i pages for %i queries' % (len(followups)+len(queries), len(queries)))
+      for future in tqdm(as_completed(followups), total=len(followups), disable=not self.verbose):
+        i, page = followups[future]
+        if n_pages[i] is None:
+          for page_, result in enumerate(future.result(), page+1):
+            pages[i][page_] = result
+        else:
+          pages[i][page] = future.result()
+    #drop journaled pages past the end of a result set that has shrunk
+    return [ [ q_pages[page] for page in sorted(q_pages) if \
+                         n_pages_ is None or page <= n_pages_ ] \
+                         for q_pages, n_pages_ in zip(pages, n_pages) ]
+
+  def close(self):
+    self.session.close()
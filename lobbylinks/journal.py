@@ -0,0 +1,83 @@
+#append-only on-disk journal of LDA API pages
+#	every page received by a PageFetcher is written as one json line keyed by its
+#	query dict and page url, so an interrupted scrape restarts from the journal
+#	and repeat runs only request the pages that can have changed
+
+import os
+import json
+import threading
+from collections import defaultdict
+
+
+def query_key(query):
+  #canonical, order-independent key for a query dict (page number excluded)
+  return json.dumps({ k: v for k, v in query.items() if k != 'page' },
+                    sort_keys=True, default=str)
+
+
+class PageJournal(object):
+  """append-only journal of received API pages.
+  arg:
+  \tpath - journal file (json lines); created if it does not exist
+  Each record holds the query key, page number, page url and the decoded page."""
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self._load()
+
+  def _load(self):
+    self.pages = defaultdict(dict)	#query key -> { page: (url, page_data) }
+    if not os.path.exists(self.path):
+      return
+    with open(self.path, 'r') as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          #a crash mid-write leaves at most one truncated trailing record
+          continue
+        self.pages[record['query']][record['page']] = (record['url'], record['data'])
+
+  def record(self, query, page, url, r_data):
+    key = query_key(query)
+    line = json.dumps({ 'query': key, 'page': page, 'url': url, 'data': r_data })
+    with self.lock:
+      with open(self.path, 'a') as f:
+        f.write(line + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+      self.pages[key][page] = (url, r_data)
+
+  def get(self, query, page):
+    try: return self.pages[query_key(query)][page]
+    except KeyError: return None
+
+  def pages_of(self, query):
+    #journaled pages of a query, in page order, as (page, url, page_data)
+    q_pages = self.pages.get(query_key(query), {})
+    return [ (page, url, r_data) for page, (url, r_data) in sorted(q_pages.items()) ]
+
+  def __contains__(self, query):
+    return query_key(query) in self.pages
+
+  def __len__(self):
+    return sum(len(q_pages) for q_pages in self.pages.values())
+
+  def compact(self):
+    #rewrite the journal with only the latest record of each page
+    with self.lock:
+      tmp_path = self.path + '.tmp'
+      with open(tmp_path, 'w') as f:
+        for key, q_pages in self.pages.items():
+          for page, (url, r_data) in sorted(q_pages.items()):
+            f.write(json.dumps({ 'query': key, 'page': page, 'url': url, 'data': r_data }) + '\n')
+      os.replace(tmp_path, self.path)
+
+  def __getstate__(self):
+    #only the path is pickled; pages are reloaded from disk
+    return { 'path': self.path }
+
+  def __setstate__(self, state):
+    self.path = state['path']
+    self.lock = threading.Lock()
+    self._load()
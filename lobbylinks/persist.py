@@ -0,0 +1,250 @@
+#binary save format for LobbyData / ContributionsData / LobbyLinks
+#	a save is a directory holding one Feather (or Parquet) file per table of the
+#	filing store (filings, activities, lobbyists, covered_positions), the graph of
+#	a LobbyLinks object, and a small json manifest describing the columns.
+#	Feather files are written uncompressed so that numeric columns can be
+#	memory-mapped, and loading can be restricted to a subset of columns.
+
+import os
+import re
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+from .store import FilingStore, Table
+
+try:
+  import pyarrow as pa
+  import pyarrow.feather as feather
+  import pyarrow.parquet as pq
+except ModuleNotFoundError:
+  pa = None
+
+manifest_file = 'manifest.json'
+format_version = 1
+_formats = { 'feather': '.feather', 'parquet': '.parquet' }
+_absent_prefix = '__absent__:'	#boolean columns marking rows where a key is missing
+
+
+def _require_arrow():
+  if pa is None:
+    raise ModuleNotFoundError('do \'pip install pyarrow\' to save in feather/parquet format ' + \
+                              'or save with format=\'pickle\'')
+
+def is_saved_dir(path):
+  return os.path.isdir(path) and os.path.exists(os.path.join(path, manifest_file))
+
+def read_manifest(path):
+  with open(os.path.join(path, manifest_file), 'r') as f:
+    return json.load(f)
+
+def write_manifest(path, manifest):
+  manifest = dict(manifest, format_version=format_version)
+  tmp_file = os.path.join(path, manifest_file + '.tmp')
+  with open(tmp_file, 'w') as f:
+    json.dump(manifest, f, indent=1, default=str)
+  os.replace(tmp_file, os.path.join(path, manifest_file))
+
+def _write_arrow(table, fname, format):
+  if format == 'feather':
+    feather.write_feather(table, fname, compression='uncompressed')
+  else:
+    pq.write_table(table, fname)
+
+def _read_arrow(fname, format, columns=None, memory_map=True):
+  if format == 'feather':
+    return feather.read_table(fname, columns=columns, memory_map=memory_map)
+  return pq.read_table(fname, columns=columns, memory_map=memory_map)
+
+def _arrow_column(arr):
+  #typed columns are written as-is; object columns are written as arrow
+  #	scalars where possible and json-encoded otherwise (mixed types)
+  if arr.dtype != object:
+    return pa.array(arr), 'arrow'
+  try:
+    return pa.array(list(arr)), 'arrow'
+  except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+    return pa.array([ json.dumps(v) for v in arr ]), 'json'
+
+def _numpy_column(column, dtype, encoding):
+  if dtype != 'object':
+    #zero-copy (read-only) when memory-mapped; Table.set copies on write
+    return column.to_numpy()
+  values = column.to_pylist()
+  if encoding == 'json':
+    values = [ json.loads(v) for v in values ]
+  arr = np.empty(len(values), dtype=object)
+  for i, v in enumerate(values):
+    arr[i] = sys.intern(v) if type(v) is str else v
+  return arr
+
+def save_table(table, fname, format='feather'):
+  """writes a store.Table; returns its manifest entry"""
+  _require_arrow()
+  arrays, names, columns = [], [], {}
+  for name, arr in table.columns.items():
+    column, encoding = _arrow_column(arr)
+    arrays.append(column); names.append(name)
+    columns[name] = { 'dtype': str(arr.dtype), 'encoding': encoding }
+  for name, mask in table.absent.items():
+    arrays.append(pa.array(mask)); names.append(_absent_prefix + name)
+  _write_arrow(pa.Table.from_arrays(arrays, names=names), fname, format)
+  return { 'file': os.path.basename(fname), 'n_rows': len(table), 'columns': columns,
+           'absent': list(table.absent), 'json_columns': sorted(table.json_columns) }
+
+def load_table(path, entry, format='feather', columns=None, memory_map=True):
+  """reads a store.Table from its manifest entry, optionally only some columns.
+  Dotted prefixes select nested columns (e.g. 'client' loads every 'client.*' column)."""
+  names = list(entry['columns'])
+  if columns is not None:
+    names = [ name for name in names if any( name == col or name.startswith(col + '.') \
+                                             for col in columns ) or name.startswith('_') ]
+  absent = [ name for name in entry['absent'] if name in names ]
+  arrow_table = _read_arrow(os.path.join(path, entry['file']), format, \
+                            columns=names + [ _absent_prefix + name for name in absent ], \
+                            memory_map=memory_map)
+  table = Table(n_rows=entry['n_rows'], \
+                json_columns=[ c for c in entry['json_columns'] if c in names ])
+  for name in names:
+    info = entry['columns'][name]
+    table.columns[name] = _numpy_column(arrow_table.column(name), info['dtype'], info['encoding'])
+  for name in absent:
+    table.absent[name] = arrow_table.column(_absent_prefix + name).to_numpy().copy()
+  table.unloaded = frozenset(entry['columns']).difference(names)
+  return table
+
+
+class _LazyTables(dict):
+  #tables of a saved store, read from disk on first access
+  def __init__(self, loader, names):
+    super(_LazyTables, self).__init__()
+    self.loader = loader
+    self.pending = set(names)
+  def __missing__(self, name):
+    if name not in self.pending: raise KeyError(name)
+    table = self.loader(name)
+    self.pending.discard(name)
+    self[name] = table
+    return table
+  def __contains__(self, name):
+    return dict.__contains__(self, name) or name in self.pending
+  def __reduce__(self):
+    #pickles as a plain dict of every table
+    return (dict, ({ name: self[name] for name in set(self.keys()) | self.pending },))
+
+
+def save_store(store, path, format='feather'):
+  """writes every table of a FilingStore into directory `path`; returns the manifest entry"""
+  assert format in _formats, 'format must be one of %s' % list(_formats)
+  os.makedirs(path, exist_ok=True)
+  tables = {}
+  for name in store.table_names:
+    tables[name] = save_table(store.tables[name], \
+                              os.path.join(path, name + _formats[format]), format=format)
+  return { 'schema': store.schema, 'format': format, 'tables': tables }
+
+def load_store(path, entry, columns=None, memory_map=True):
+  """FilingStore from a directory written by save_store.
+  kwargs:
+  \tcolumns - filings columns to load (list), or dict of table name -> columns;
+  \t          other tables are read in full, and only when first accessed
+  \tmemory_map - memory-map the files (numeric feather columns are then zero-copy)"""
+  if columns is not None and not isinstance(columns, dict):
+    columns = { 'filings': columns }
+  columns = {} if columns is None else columns
+  def loader(name):
+    return load_table(path, entry['tables'][name], format=entry['format'], \
+                      columns=columns.get(name), memory_map=memory_map)
+  tables = _LazyTables(loader, entry['tables'])
+  #the filings table is always needed (len, iteration)
+  tables['filings']
+  return FilingStore(tables, schema=entry['schema'])
+
+def save_frame(frame, path, name, format='feather'):
+  """writes a pandas DataFrame (e.g. a LobbyLinks graph); returns its manifest entry"""
+  _require_arrow()
+  fname = os.path.join(path, name + _formats[format])
+  arrays, names, json_columns = [], [], []
+  for col in frame.columns:
+    values = frame[col].to_numpy()
+    column, encoding = _arrow_column(values.astype(object) if values.dtype.kind in 'OUSMm' \
+                                     and values.dtype != object else values)
+    if encoding == 'json': json_columns.append(str(col))
+    arrays.append(column); names.append(str(col))
+  _write_arrow(pa.Table.from_arrays(arrays, names=names), fname, format)
+  return { 'file': os.path.basename(fname), 'format': format, 'json_columns': json_columns }
+
+def load_frame(path, entry, columns=None, memory_map=True):
+  frame = _read_arrow(os.path.join(path, entry['file']), entry['format'], \
+                      columns=columns, memory_map=memory_map).to_pandas()
+  for col in entry.get('json_columns', []):
+    if col in frame:
+      frame[col] = [ json.loads(v) for v in frame[col] ]
+  return frame
+
+
+#graph builds streamed to disk (LobbyLinks.write_graph): one file per batch of
+#	filings and filing year, plus a progress file listing the completed parts
+graph_progress_file = 'graph_progress.json'
+_graph_part = re.compile(r'^part-([0-9]+)\.')
+
+def read_graph_progress(path):
+  fname = os.path.join(path, graph_progress_file)
+  if not os.path.exists(fname): return None
+  with open(fname, 'r') as f:
+    return json.load(f)
+
+def write_graph_progress(path, progress):
+  os.makedirs(path, exist_ok=True)
+  tmp_file = os.path.join(path, graph_progress_file + '.tmp')
+  with open(tmp_file, 'w') as f:
+    json.dump(progress, f, indent=1, default=str)
+  os.replace(tmp_file, os.path.join(path, graph_progress_file))
+
+def write_graph_part(frame, path, part, format='parquet'):
+  """writes the edges of one batch as path/filing_year=<year>/part-<part>.<format>;
+  returns the progress entries of the files written"""
+  entries = []
+  for year, rows in frame.groupby('filing_year', sort=True, dropna=False):
+    subdir = 'filing_year=%s' % year
+    os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    name = 'part-%09i' % part
+    rows = rows.reset_index(drop=True)
+    if format == 'csv':
+      rows.to_csv(os.path.join(path, subdir, name + '.csv'), index=False)
+      entry = { 'file': name + '.csv', 'format': 'csv', 'json_columns': [] }
+    else:
+      entry = save_frame(rows, os.path.join(path, subdir), name, format=format)
+    entry.update({ 'dir': subdir, 'part': part, 'n_rows': len(rows) })
+    entries.append(entry)
+  return entries
+
+def remove_graph_parts(path, min_part=0):
+  #deletes part files of batches starting at filing index >= min_part
+  if not os.path.isdir(path): return
+  for subdir in os.listdir(path):
+    if not subdir.startswith('filing_year=') or not os.path.isdir(os.path.join(path, subdir)):
+      continue
+    for fname in os.listdir(os.path.join(path, subdir)):
+      match = _graph_part.match(fname)
+      if match is not None and int(match.group(1)) >= min_part:
+        os.remove(os.path.join(path, subdir, fname))
+
+def load_graph_parts(path, entries, columns=None):
+  """graph DataFrame from the part files in `entries` (see write_graph_part), in filing order"""
+  load_columns = columns
+  if columns is not None and 'filing_index' not in columns:
+    load_columns = list(columns) + [ 'filing_index' ]
+  frames = []
+  for entry in entries:
+    subdir = os.path.join(path, entry['dir'])
+    if entry['format'] == 'csv':
+      frames.append(pd.read_csv(os.path.join(subdir, entry['file']), usecols=load_columns))
+    else:
+      frames.append(load_frame(subdir, entry, columns=load_columns))
+  if len(frames) == 0: return pd.DataFrame()
+  graph = pd.concat(frames, ignore_index=True)
+  if 'filing_index' in graph:
+    graph = graph.sort_values('filing_index', kind='stable').reset_index(drop=True)
+  return graph if columns is None else graph[list(columns)]
@@ -0,0 +1,135 @@
+#blocking (candidate retrieval) for legislator name matching
+#	picks a short list of plausible legislators for an extracted name before any
+#	expensive scoring (the HMNI siamese model or NameMatcher), using surname
+#	phonetic keys, character n-gram inverted lists, and the chamber/year filters
+
+import re
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from unidecode import unidecode
+from doublemetaphone import doublemetaphone
+
+_non_letters = re.compile(r'[^a-z ]+')
+_spaces = re.compile(r'\s+')
+
+def normalize(name):
+  #lowercase ascii letters and single spaces
+  name = unidecode(str(name)).lower().replace('-', ' ')
+  return _spaces.sub(' ', _non_letters.sub('', name)).strip()
+
+def ngrams(name, n=3):
+  name = ' ' + name + ' '
+  return set( name[i:i+n] for i in range(len(name) - n + 1) )
+
+def phonetic_keys(token):
+  return set( key for key in doublemetaphone(token) if key )
+
+
+class CandidateBlocker(object):
+  """inverted lists over one resources.handlers.NameIndex (a chamber, or all legislators).
+  arg:
+  \tindex - NameIndex whose names, full_names and wikinames are indexed
+  kwargs:
+  \tn - character n-gram size
+  \tmax_candidates - number of n-gram candidates kept (phonetic surname hits are always kept)
+  \tmin_overlap - minimum fraction of the query's n-grams a candidate must share"""
+  def __init__(self, index, n=3, max_candidates=25, min_overlap=.3):
+    self.n = n
+    self.max_candidates = max_candidates
+    self.min_overlap = min_overlap
+    self.start_years = index.start_years
+    self.size = len(index)
+    postings = defaultdict(set)
+    surnames = defaultdict(set)
+    for i in range(self.size):
+      variants = set( normalize(names[i]) for names in \
+                      (index.names, index.full_names, index.wikinames) )
+      variants.discard('')
+      for variant in variants:
+        for gram in ngrams(variant, n=n):
+          postings[gram].add(i)
+      #surname keys: every part of the (possibly hyphenated or compound) last name
+      for token in normalize(index.last_names[i]).split():
+        for key in phonetic_keys(token):
+          surnames[key].add(i)
+    self.postings = { gram: np.array(sorted(idx), dtype=np.int32) for gram, idx in postings.items() }
+    self.surnames = { key: np.array(sorted(idx), dtype=np.int32) for key, idx in surnames.items() }
+
+  def candidates(self, name, filing_year=None):
+    #positions (in the NameIndex) of candidate legislators for name, sorted
+    name = normalize(name)
+    if name == '':
+      return np.array([], dtype=np.int32)
+    hits = [ self.surnames[key] for token in name.split() if len(token) > 1 \
+                                for key in phonetic_keys(token) if key in self.surnames ]
+    grams = ngrams(name, n=self.n)
+    counts = np.zeros(self.size)
+    for gram in grams:
+      if gram in self.postings:
+        counts[self.postings[gram]] += 1
+    overlap = counts/max(len(grams), 1)
+    top = np.argsort(-overlap, kind='stable')[:self.max_candidates]
+    hits.append(top[overlap[top] >= self.min_overlap])
+    candidates = np.unique(np.concatenate(hits)).astype(np.int32)
+    if filing_year is not None: #chronological filter, as in best_match
+      candidates = candidates[self.start_years[candidates] <= filing_year]
+    return candidates
+
+
+#regression check: recall of the blocking stage on an exported lobby graph
+
+_title_span = re.compile(r'\b(Sen|Senator|Rep|Representative|Congressman|Congresswoman)\.?\s+'
+                         r'([^,;()]+)', flags=re.IGNORECASE)
+
+def _query_spans(source_text):
+  #(branch, name) spans following a legislator title in a covered_position text
+  spans = []
+  for title, span in _title_span.findall(str(source_text)):
+    branch = 'Sen' if title.lower().startswith('sen') else 'Rep'
+    span = span.strip()
+    if len(span) > 0: spans.append((branch, span))
+  return spans
+
+def blocking_recall(legislators, graph_file=None, id_field='bioguide', verbose=True):
+  """fraction of the links in an exported lobby graph (lobby_graph.csv by default)
+  whose legislator survives blocking, for the title-prefixed name in the link's
+  source text that refers to that legislator. Links whose legislator is not in
+  `legislators` (e.g. outside its year range) are skipped."""
+  if graph_file is None:
+    graph_file = os.path.join(os.path.dirname(os.path.dirname( \
+                              os.path.dirname(os.path.abspath(__file__)))), 'lobby_graph.csv')
+  graph = pd.read_csv(graph_file, dtype={ 'legislator_' + id_field: str })
+  graph = graph.drop_duplicates(subset=['link_source_text', 'legislator'])
+  n_found = 0; n_links = 0; n_candidates = []; misses = []
+  for row in graph.itertuples():
+    match = legislators.lookup_id(getattr(row, 'legislator_' + id_field), id_field=id_field)
+    if match is None or isinstance(match, tuple): continue
+    last_name = normalize(match.name.last)
+    spans = [ (branch, span) for branch, span in _query_spans(row.link_source_text) \
+                             if last_name in normalize(span) ]
+    if len(spans) == 0: continue
+    n_links += 1
+    found = False
+    for branch, span in spans:
+      index = legislators.index_of(branch)
+      candidates = legislators.blocker_of(branch).candidates(span, filing_year=row.filing_year)
+      n_candidates.append(len(candidates))
+      if any( index.legislators[i] is match for i in candidates ):
+        found = True
+    if found: n_found += 1
+    else: misses.append((row.legislator, spans))
+  recall = n_found/max(n_links, 1)
+  if verbose:
+    print('blocking recall: %i/%i links (%.3f), mean %.1f candidates per name' % \
+          (n_found, n_links, recall, np.mean(n_candidates) if n_candidates else 0.))
+    for legislator, spans in misses:
+      print('\tmissed', legislator, spans)
+  return recall
+
+
+if __name__ == '__main__':
+  from .handlers import Legislators
+  blocking_recall(Legislators())
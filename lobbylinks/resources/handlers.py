@@ -3,19 +3,24 @@
 #		LDA issue code names & map to human-readable
 
 #basic imports
-import signal
 import os
 import json
 import re
-from collections import defaultdict
-from .match_heuristics import whittle_name, patterns, \
+import hashlib
+import functools
+import threading
+import time
+from collections import defaultdict, OrderedDict, Counter
+from .match_heuristics import whittle_name, prime_whittle, patterns, \
                               top_level_patterns
 from datetime import datetime
-from .name_matcher import NameMatcher
-from . import probablepeople_mod as pp
+from .name_matcher import NameMatcher, ParsedNames
 from .nicknames import NickNamer
+from .blocking import CandidateBlocker
+from .timeouts import Deadline, TimedOut, TimeOutHandler #deadlines for slow steps
 
 from unidecode import unidecode
+from tqdm import tqdm
 
 #minimize tensorflow printouts
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
@@ -24,25 +29,66 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
 import pandas as pd
 import numpy as np
 
-#nlp imports
-import spacy
-from . import hmni #lstm-based fuzzy name matching
+#nlp imports (spacy, tensorflow via hmni and probablepeople's CRF taggers are
+#	slow to load, so they are imported on first use; see get_ml_matcher, _pp)
+from .hmni.scorer import SiameseScorer, BatchMatcher #batched HMNI scoring
 
 _lower = lambda l: [ unidecode(s.lower()) for s in l ]
 
-try:
-  ml_matcher = hmni.Matcher(model='latin', allow_alt_surname=False) #machine learning name matcher
-  enable_matching = True
-except:
-  print('machine learning name-matching not enabled')
-  ml_matcher = lambda x, y: 0.
-  enable_matching = False
+_ml_matcher = None
+def get_ml_matcher():
+  #(machine learning name matcher, enabled), built on first use
+  global _ml_matcher
+  if _ml_matcher is None:
+    try:
+      from . import hmni #lstm-based fuzzy name matching
+      _ml_matcher = (hmni.Matcher(model='latin', allow_alt_surname=False), True)
+    except:
+      print('machine learning name-matching not enabled')
+      _ml_matcher = (lambda x, y: 0., False)
+  return _ml_matcher
+
+_batch_matcher = None
+def get_batch_matcher():
+  #hmni.scorer.BatchMatcher over the ml_matcher (its scores, with one call per model
+  #	for all candidates of a name), or None when machine learning matching is not enabled
+  global _batch_matcher
+  if _batch_matcher is None:
+    ml_matcher, enable_matching = get_ml_matcher()
+    _batch_matcher = BatchMatcher(ml_matcher) if enable_matching else False
+  return _batch_matcher or None
+
+def _pp():
+  #probablepeople, whose taggers are loaded on first use
+  from . import probablepeople_mod
+  return probablepeople_mod
+
+def __getattr__(name):
+  #module attributes that are built on first use
+  if name == 'ml_matcher': return get_ml_matcher()[0]
+  if name == 'enable_matching': return get_ml_matcher()[1]
+  if name == 'pp': return _pp()
+  raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 
 string_matcher = NameMatcher(distfun='jaro_winkler')
-ml_matcher = ml_matcher
+_siamese_scorers = {}
+def get_siamese_scorer(backend='tensorflow'):
+  #batched siamese scorer for Legislators(siamese_threshold=...), one per backend,
+  #	shared so that the network is loaded once
+  if backend not in _siamese_scorers:
+    _siamese_scorers[backend] = SiameseScorer(backend=backend)
+  return _siamese_scorers[backend]
+
 nicknamer = NickNamer()
 
+def matcher_fingerprint(legislators=None):
+  #identifies the name-matching model in use, for caches of match results
+  scorer = legislators.siamese() if legislators is not None else None
+  if scorer is not None:
+    return 'siamese:%s:%r' % (scorer.fingerprint, legislators.siamese_threshold)
+  return 'hmni:latin' if get_ml_matcher()[1] else 'string'
+
 
 #minimize tensorflow printouts
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
@@ -83,30 +129,6 @@ manual_id_resource = os.path.join(path, 'leg_ids_manual.csv')
 
 #print(historical_leg_resource)
 
-class TimeOutHandler(object):
-  """Class to handle timeouts. Pass unexecuted function (e.g. 
-  using func_ = lambda: func) to self.wrap(func_) to
-  have function timeout after self.timeout seconds.
-  kwarg:
-  \ttimeout (in seconds)"""
-  def __init__(self, timeout=10):
-    self.timeout = timeout
-  def handler(self, signum, frame):
-    raise Exception('Timed Out')
-  def wrap(self, func):
-    def handler(signum, frame):
-      raise Exception('Timed Out')
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(10)
-    try:
-      output = func()
-      signal.alarm(0)
-      return output
-    except Exception as exc:
-      signal.alarm(0)
-      return #'timed out'
-
-
 class AttrDict(dict):
   """OOP-friendly format for dictionaries. Values addressable with obj.key format"""
   def __init__(self, *args, recursive=True, **kwargs):
@@ -175,86 +197,189 @@ def proc_hyphens(s):
     return list(set(splits))       
 
 #proc_hyphens('ros-hilena morechai-johnson')
-def match_nicknames(name, nicknamer, legislators_data):
-    parse_ = pp.tag(name, type='person')[0]
-    scores = [ ]
-    last_name = parse_.get('Surname')
-    first_name = parse_.get('GivenName')
-    first_initial = parse_.get('FirstInitial')
-    #if isinstance(last_name, str): last_name = unidecode(last_name.lower())
+@functools.lru_cache(maxsize=2**14)
+def _parse_person(name):
+  #(surname, given name, first initial) tagged by probablepeople
+  parse_ = _pp().tag(name, type='person')[0]
+  return parse_.get('Surname'), parse_.get('GivenName'), parse_.get('FirstInitial')
+
+@functools.lru_cache(maxsize=2**14)
+def nickname_set(nicknamer, name):
+  #a (lowercased) first name with its canonical names and nicknames of 3+ letters
+  name_set = nicknamer.canonicals_of(name).union(nicknamer.nicknames_of(name))
+  name_set = {name}.union(name_set)
+  return frozenset( n for n in name_set if len(n) >= 3 )
+
+class NicknameIndex(object):
+  """lookups for match_nicknames, built once per list of legislators.
+  self.surnames maps each surname variant (see proc_hyphens) to legislator
+  positions. Legislators whose first names have the same nickname_set share
+  a class id (self.class_ids), and self.classes maps each name to the ids of
+  the classes whose nickname sets contain it.
+  args:
+  \tlegislators - list of legislator AttrDicts
+  \tnicknamer - NickNamer"""
+  def __init__(self, legislators, nicknamer):
+    self.nicknamer = nicknamer
+    self.n_legislators = len(legislators)
+    self.class_ids = np.full(self.n_legislators, -1, dtype=int)
+    self.first_names = [ None ]*self.n_legislators
+    surnames, classes, set2id = defaultdict(list), defaultdict(set), {}
+    for i, l in enumerate(legislators):
+      try:
+        leg_lastname, leg_firstname = l.name.last, l.name.first
+      except AttributeError: continue
+      if not (isinstance(leg_lastname, str) and isinstance(leg_firstname, str)):
+        continue
+      # compile hyphenated last names
+      for variant in proc_hyphens(unidecode(leg_lastname).lower()):
+        surnames[variant].append(i)
+      leg_firstname = unidecode(leg_firstname).lower()
+      leg_set = nickname_set(nicknamer, leg_firstname)
+      class_id = set2id.setdefault(leg_set, len(set2id))
+      self.class_ids[i] = class_id
+      for n in leg_set: classes[n].add(class_id)
+      self.first_names[i] = leg_firstname
+    self.surnames = dict(surnames)
+    self.classes = dict(classes)
+  
+  def scores(self, name, verbose=False):
+    #1 for each legislator with the surname of name and a compatible first name
+    #	(shared nickname or, for initials, the same first initial); normalized
+    scores = np.zeros(self.n_legislators)
+    last_name, first_name, first_initial = _parse_person(name)
     if not (isinstance(last_name, str) and (isinstance(first_name, str) or \
                                             isinstance(first_initial, str))):
-        return np.zeros(len(legislators_data))
+      return scores
     
     last_name = unidecode(last_name).lower()
-    
+    compatible = set()
     if isinstance(first_name, str):
-        given_name = unidecode(first_name).lower()
-        name_set = nicknamer.canonicals_of(given_name).union(nicknamer.nicknames_of(given_name))
-        name_set = {given_name}.union(name_set)
-        name_set = { n for n in name_set if len(n) >= 3 }
-    else:
-        name_set = set()
-    
-    #print(name_set)
+      for n in nickname_set(self.nicknamer, unidecode(first_name).lower()):
+        compatible.update(self.classes.get(n, ()))
     if isinstance(first_initial, str):
-        first_initial = unidecode(first_initial).lower()[0]
+      first_initial = unidecode(first_initial).lower()[0]
     
-    for l in legislators_data:
-        found_match = False
-        try:
-            leg_lastname = l.name.last
-            leg_firstname = l.name.first
-            # compile hyphenated last names
-            #found_match = False
-            
-            if not (isinstance(leg_lastname, str) and isinstance(leg_firstname, str)):
-                #scores.append(0.)
-                continue
-            
-            leg_lastname_ = unidecode(leg_lastname).lower()
-            leg_firstname = unidecode(leg_firstname).lower()
-            leg_lastnames = proc_hyphens(leg_lastname_)
-            for leg_lastname in leg_lastnames:
-                if last_name != leg_lastname:
-                    continue
-                
-                if isinstance(first_name, str):
-                    leg_set = nicknamer.canonicals_of(leg_firstname \
-                                      ).union(nicknamer.nicknames_of(leg_firstname))
-                    leg_set = {leg_firstname}.union(leg_set)
-                    leg_set = { n for n in leg_set if len(n) >= 3 }
-                    if len(leg_set.intersection(name_set)) >= 1:
-                        #scores.append(1.)
-                        #print('othermatch', leg_set, leg_firstname, leg_lastnames)
-                        found_match = True
-                        #print(leg_set)
-                        break
-                if isinstance(first_initial, str):
-                    leg_first_initial = leg_firstname[0]
-                    if leg_first_initial == first_initial:
-                        print('matched on initials', leg_first_initial, first_initial, leg_lastname, leg_firstname, last_name)
-                        #print('using initials')
-                        found_match = True
-                        break
-            if found_match: 
-                #print('appending match', leg_firstname, leg_lastname, first_name, first_initial)
-                scores.append(1.)
-            else: scores.append(0.)
-            #print('found match?', found_match)
-        except AttributeError:
-            print('attrerror')
-            scores.append(0.)
-    scores = np.array(scores)
-    #print('nicknamer match', legislators_data[scores.argmax()])
+    for i in self.surnames.get(last_name, ()):
+      if isinstance(first_name, str) and self.class_ids[i] in compatible:
+        scores[i] = 1.
+      elif isinstance(first_initial, str) and self.first_names[i][:1] == first_initial:
+        if verbose:
+          print('matched on initials', first_initial, last_name, self.first_names[i])
+        scores[i] = 1.
     if scores.sum() > 0.:
-        return scores/scores.sum()
+      return scores/scores.sum()
+    return scores
+
+def match_nicknames(name, nicknamer, legislators_data, verbose=False):
+    #legislators_data - NameIndex (whose NicknameIndex is reused) or list of legislators
+    if isinstance(legislators_data, NameIndex):
+        index = legislators_data.nickname_index(nicknamer)
     else:
-        return scores
+        index = NicknameIndex(legislators_data, nicknamer)
+    return index.scores(name, verbose=verbose)
 
 #match_nicknames('Thomas Cotton', legislators)
 #match_nicknames('T. Cotton', legislators)
 
+_wikiname = lambda legislator: re.sub(" [\(\[].*?[\)\]]$", "", legislator.id.wikipedia) \
+                               if hasattr(legislator.id, 'wikipedia') else ''
+
+def _frozen(values, dtype=None):
+  arr = np.array(values, dtype=dtype)
+  arr.setflags(write=False)
+  return arr
+
+class NameIndex(object):
+  """frozen arrays of legislator names for one chamber (or all legislators),
+  built once by Legislators so that best_match doesn't rebuild candidate lists.
+  arg:
+  \tlegislators - list of legislator AttrDicts
+  \tpositions - position of each legislator in Legislators.legislators"""
+  def __init__(self, legislators, positions):
+    self.legislators = tuple(legislators)
+    self.positions = _frozen(positions, dtype=int)
+    self.names = _frozen([ leg.full_name for leg in legislators ], dtype=str)
+    self.full_names = _frozen([ (leg.name.official_full if hasattr(leg.name, \
+                                'official_full') else leg.full_name) \
+                                for leg in legislators ], dtype=str)
+    self.last_names = _frozen([ leg.name.last for leg in legislators ], dtype=str)
+    self.last_names_lower = _frozen(_lower(self.last_names), dtype=str)
+    self.wikinames = _frozen([ _wikiname(leg) for leg in legislators ], dtype=str)
+    self.start_years = _frozen([ int(leg.first_term_start.split('-')[0]) \
+                                 for leg in legislators ], dtype=int)
+  
+  def __len__(self):
+    return len(self.legislators)
+  
+  def nickname_index(self, nicknamer):
+    #NicknameIndex of these legislators, built on first use
+    if getattr(self, '_nicknames', None) is None or self._nicknames.nicknamer is not nicknamer:
+      self._nicknames = NicknameIndex(self.legislators, nicknamer)
+    return self._nicknames
+  
+  def parsed_names(self, field, matcher):
+    #ParsedNames of self.<field> for matcher.match_many, built on first use
+    if getattr(self, '_parsed', None) is None: self._parsed = {}
+    if (field, matcher) not in self._parsed:
+      self._parsed[(field, matcher)] = ParsedNames(matcher, getattr(self, field).tolist())
+    return self._parsed[(field, matcher)]
+
+#stages of Legislators.best_match, with the score each must exceed to decide a match
+match_stages = OrderedDict([ ('exact', .7), ('nickname', .92), ('string', .92), ('neural', .7) ])
+default_cascade = ('exact', 'nickname', 'string', 'neural') #cheapest stages first
+legacy_cascade = ('neural', 'string', 'nickname') #the order of earlier versions
+
+class CascadeStats(object):
+  """calls, matches and time spent in each stage of Legislators.best_match.
+  self.summary() tabulates hit rates and latencies, e.g. to tune the cascade"""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+  
+  def reset(self):
+    with self.lock:
+      self.calls = Counter()
+      self.hits = Counter()
+      self.seconds = Counter()
+  
+  def record(self, stage, hit, seconds):
+    with self.lock:
+      self.calls[stage] += 1
+      self.hits[stage] += int(hit)
+      self.seconds[stage] += seconds
+  
+  def stats(self):
+    #copies, e.g. to send back from a worker process
+    with self.lock:
+      return Counter(self.calls), Counter(self.hits), Counter(self.seconds)
+  
+  def add_stats(self, stats):
+    calls, hits, seconds = stats
+    with self.lock:
+      self.calls.update(calls)
+      self.hits.update(hits)
+      self.seconds.update(seconds)
+  
+  def summary(self):
+    #DataFrame of calls, hits, hit rate and mean latency (ms) per stage
+    stages = [ stage for stage in match_stages if self.calls[stage] > 0 ]
+    calls = np.array([ self.calls[stage] for stage in stages ])
+    hits = np.array([ self.hits[stage] for stage in stages ])
+    seconds = np.array([ self.seconds[stage] for stage in stages ])
+    return pd.DataFrame({ 'calls': calls, 'hits': hits, 'hit_rate': hits/np.maximum(calls, 1), \
+                          'mean_ms': 1000*seconds/np.maximum(calls, 1), 'total_s': seconds }, \
+                        index=pd.Index(stages, name='stage'))
+  
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    del state['lock']
+    return state
+  
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+
 class Legislators(object):
   """list-like object to handle legislator names, parties, details, etc\n
   by default, merges current legislators and historical legislators, house & senate"""
@@ -267,8 +392,21 @@ class Legislators(object):
                      _filter=lambda l: True, 
                      enable_matching=True,
                      validate_cand_ids=False, # for devs, when updating IDs in the CAND_ID system for linking to FEC identifiers
+                     blocking=True, # score only blocked candidates (see resources.blocking)
+                     embedding_cache=None, # directory for the legislators' siamese embeddings
+                     cascade=default_cascade, # stages of best_match, in order (see match_stages)
+                     siamese_threshold=None, # 'neural' threshold for the batched siamese scorer (off if None)
+                     siamese_backend='tensorflow', # or 'numpy', from exported weights (see hmni.numpy_siamese)
                      ):
     if type(sourcefiles) == str: sourcefiles = [ sourcefiles ]
+    self.blocking = blocking
+    self.embedding_cache = embedding_cache
+    self.siamese_threshold = siamese_threshold
+    self.siamese_backend = siamese_backend
+    self.cascade = tuple(cascade)
+    for stage in self.cascade:
+      if stage not in match_stages:
+        raise ValueError('unknown match stage %r (use %s)' % (stage, ', '.join(match_stages)))
     self.min_year = str(min_year)
     self.max_year = str(max_year)
     #self.string_matcher = NameMatcher(distfun='jaro_winkler')
@@ -408,90 +546,138 @@ class Legislators(object):
       leg['first_term_start'] = first_term_start
       
       # obtain name parses
+    
+    self._build_index()
+  
+  def _build_index(self):
+    #per-chamber name index; 'Rep' and 'Sen' hold everyone who served in that chamber
+    positions = { 'all': range(len(self.legislators)), 
+                  'Rep': [ i for i, leg in enumerate(self.legislators) if leg.was_house ],
+                  'Sen': [ i for i, leg in enumerate(self.legislators) if leg.was_senate ] }
+    self._index = { chamber: NameIndex([ self.legislators[i] for i in idx ], list(idx)) \
+                    for chamber, idx in positions.items() }
+    self._blockers = {}
+    self._embeddings = {}
+  
+  @property
+  def fingerprint(self):
+    #sha1 of the legislator list (indices, names, ids, start dates), for caches of match results
+    if getattr(self, '_fingerprint', None) is None:
+      entries = [ (leg.index, leg.full_name, leg.id.get('bioguide'), leg.first_term_start, \
+                   leg.was_house, leg.was_senate) for leg in self ]
+      self._fingerprint = hashlib.sha1(json.dumps(entries, default=str).encode('utf-8')).hexdigest()
+    return self._fingerprint
+  
+  def index_of(self, branch=None):
+    #NameIndex for branch 'Rep', 'Sen', or all legislators (any other value)
+    if not hasattr(self, '_index'): #objects pickled before the index existed
+      self._build_index()
+    return self._index[branch if branch in ('Rep', 'Sen') else 'all']
+  
+  def blocker_of(self, branch=None):
+    #CandidateBlocker over index_of(branch), built on first use
+    chamber = branch if branch in ('Rep', 'Sen') else 'all'
+    if not hasattr(self, '_blockers'): self._blockers = {}
+    if chamber not in self._blockers:
+      self._blockers[chamber] = CandidateBlocker(self.index_of(branch))
+    return self._blockers[chamber]
+  
+  def siamese(self):
+    #the batched siamese scorer, or None unless enabled with siamese_threshold (and available).
+    #	It scores 1 - the network's distance, not hmni.Matcher's meta-model probability,
+    #	so its threshold has to be calibrated separately (see hmni.scorer.calibrate_threshold)
+    if getattr(self, 'siamese_threshold', None) is None: return None
+    scorer = get_siamese_scorer(getattr(self, 'siamese_backend', 'tensorflow'))
+    return scorer if scorer.available else None
+  
+  def threshold(self, stage):
+    #score a stage of best_match must exceed to decide a match (see match_stages)
+    if stage == 'neural' and self.siamese() is not None: return self.siamese_threshold
+    return match_stages[stage]
+  
+  def embeddings_of(self, branch=None, field='names'):
+    #siamese side2 outputs for index_of(branch).<field> ('names', 'full_names' or 'wikinames'),
+    #	or None when the batched scorer is off. They are computed once for all
+    #	legislators (and cached on disk in embedding_cache, if set); chambers take rows of it
+    scorer = self.siamese()
+    if scorer is None: return None
+    if not hasattr(self, '_embeddings'): self._embeddings = {}
+    if field not in self._embeddings:
+      names = getattr(self.index_of('all'), field).tolist()
+      self._embeddings[field] = _frozen(scorer.embed_candidates(names, \
+                                        cache_dir=getattr(self, 'embedding_cache', None)))
+    embeddings = self._embeddings[field]
+    index = self.index_of(branch)
+    return embeddings if len(index) == len(embeddings) else embeddings[index.positions]
   
   @property
   def names(self):
-    return [ legislator.full_name for legislator in self.legislators ]
+    return self.index_of().names.tolist()
   
   @property
   def full_names(self):
-    return [ (legislator.name.official_full if hasattr(legislator.name, \
-                            'official_full') else legislator.full_name) \
-                                     for legislator in self.legislators ]
+    return self.index_of().full_names.tolist()
   
   @property
   def last_names(self):
-    return [ legislator.name.last for legislator in self.legislators ]
+    return self.index_of().last_names.tolist()
   
   @property
   def wikinames(self):
-    return [ re.sub(" [\(\[].*?[\)\]]$", "", legislator.id.wikipedia) if \
-                            hasattr(legislator.id, 'wikipedia') else \
-                            '' for legislator in self.legislators ]
+    return self.index_of().wikinames.tolist()
   
   @property
   def start_years(self):
-    start_date = [ leg.first_term_start for leg in self.legislators ]
-    return [ int(start_date.split('-')[0]) for start_date in start_date ]
+    return self.index_of().start_years.tolist()
   
   @property
   def house_reps(self):
-    return [ leg for leg in self.legislators if leg.was_house ]
+    return list(self.index_of('Rep').legislators)
   
   @property
   def senators(self):
-    return [ leg for leg in self.legislators if leg.was_senate ]
+    return list(self.index_of('Sen').legislators)
   
   @property
   def house_rep_names(self):
-    return [ legislator.full_name for legislator in self.house_reps ]
+    return self.index_of('Rep').names.tolist()
   
   @property
   def house_rep_last_names(self):
-   return [ legislator.name.last for legislator in self.house_reps ]
+   return self.index_of('Rep').last_names.tolist()
   
   @property
   def house_rep_full_names(self):
-    return [ (legislator.name.official_full if hasattr(legislator.name, \
-                            'official_full') else legislator.full_name) \
-                                      for legislator in self.house_reps ]
+    return self.index_of('Rep').full_names.tolist()
   
   @property
   def house_rep_start_years(self):
-    start_date = [ leg.first_term_start for leg in self.house_reps ]
-    return [ int(start_date.split('-')[0]) for start_date in start_date ]
+    return self.index_of('Rep').start_years.tolist()
   
   @property
   def senator_names(self):
-    return [ legislator.full_name for legislator in self.senators ]
+    return self.index_of('Sen').names.tolist()
   
   @property
   def senator_last_names(self):
-    return [ legislator.name.last for legislator in self.senators ]
+    return self.index_of('Sen').last_names.tolist()
   
   @property
   def senator_full_names(self):
-    return [ (legislator.name.official_full if hasattr(legislator.name, \
-                            'official_full') else legislator.full_name) \
-                                        for legislator in self.senators ]
+    return self.index_of('Sen').full_names.tolist()
   
   @property
   def senator_start_years(self):
-    start_date = [ leg.first_term_start for leg in self.senators ]
-    return [ int(start_date.split('-')[0]) for start_date in start_date ]
+    return self.index_of('Sen').start_years.tolist()
   
   
   @property
   def house_rep_wikinames(self):
-    return [ re.sub(" [\(\[].*?[\)\]]$", "", legislator.id.wikipedia) if \
-                            hasattr(legislator.id, 'wikipedia') else \
-                            '' for legislator in self.house_reps ]
+    return self.index_of('Rep').wikinames.tolist()
   
   @property
   def senator_wikinames(self):
-    return [ re.sub(" [\(\[].*?[\)\]]$", "", legislator.id.wikipedia) if \
-                            hasattr(legislator.id, 'wikipedia') else \
-                            '' for legislator in self.senators ]
+    return self.index_of('Sen').wikinames.tolist()
   
   def __len__(self):
     return len(self.legislators)
@@ -520,14 +706,30 @@ class Legislators(object):
     elif len(matches) == 1: return matches[0]
     else: return None
   
-  def score_names(self, name, target_names=None, exact=False, score_func=None):
+  def score_names(self, name, target_names=None, exact=False, score_func=None, 
+                        candidates=None, embeddings=None, batch_func=None):
+    #candidates - positions in target_names to score (from blocking); others score 0
+    #embeddings - siamese side2 outputs of target_names (see embeddings_of)
+    #batch_func - batch_func(name, positions) scores target_names[positions] in one call
     target_names = self.names if target_names is None else target_names
     
-    if score_func is None:
+    #with siamese_threshold set, score all candidates in one batched pass of the siamese network
+    scorer = self.siamese() if score_func is None and batch_func is None else None
+    if scorer is not None:
+      batch_func = lambda name_, idx: scorer.similarity(name_, \
+                             [ target_names[i] for i in idx ], \
+                             candidate_embeddings=None if embeddings is None else embeddings[idx])
+    #by default, the ml_matcher's scores, with its models run once for all candidates
+    if score_func is None and batch_func is None and get_batch_matcher() is not None:
+      batch_func = lambda name_, idx: get_batch_matcher().similarity(name_, \
+                                        [ target_names[i] for i in idx ])
+    batched = batch_func is not None
+    if score_func is None and not batched:
+      ml_matcher, enable_matching = get_ml_matcher()
       score_func = ml_matcher.similarity if enable_matching else ml_matcher
     
     #try exact match
-    scores = (name == np.array(target_names))
+    scores = (name == np.asarray(target_names))
     
     #if multiple matches, use a uniform distribution (won't meet match threshold)
     if np.any(scores): scores = scores/scores.sum()
@@ -539,14 +741,71 @@ class Legislators(object):
       #if enable_matching:
       # strip any numbers, which messes w the algorithm
       name_ = re.sub(r'[0-9]', '', name)
-      scores = [ score_func(name_, leg_name) \
-                                 for leg_name in target_names ]
+      if batched:
+        idx = np.arange(len(target_names)) if candidates is None else candidates
+        scores = np.zeros(len(target_names))
+        if len(idx) > 0: scores[idx] = batch_func(name_, idx)
+      elif candidates is None:
+        scores = [ score_func(name_, leg_name) \
+                                   for leg_name in target_names ]
+      else:
+        scores = np.zeros(len(target_names))
+        scores[candidates] = [ score_func(name_, target_names[i]) for i in candidates ]
     
     scores = np.array(scores).astype(float)
     #softmax to take into account possible uniform distributions (multimatch)
     #scores = np.exp(scores)/np.exp(scores).sum()
     return scores
   
+  def prime(self, names):
+    #batch-embeds names that will be passed to best_match (e.g. all names
+    #	extracted from a dataset), so later queries skip the network's query tower
+    scorer = self.siamese()
+    if scorer is not None:
+      scorer.prime(names)
+  
+  def _stage_scores(self, stage, name, branch, index, last_name, candidates, verbose):
+    #scores of every legislator in index for one stage of best_match;
+    #	candidates() gives the blocked candidate positions (or None)
+    if last_name:
+      #only use exact match for a 1-word name
+      return self.score_names(unidecode(name.lower()), target_names=index.last_names_lower, \
+                              exact=True)
+    names_lists = [ (index.names, 'names'), (index.full_names, 'full_names'), \
+                    (index.wikinames, 'wikinames') ]
+    if stage == 'exact':
+      scores_all_names = [ self.score_names(name, target_names=names_list, exact=True) \
+                           for names_list, _ in names_lists ]
+      return np.max(np.vstack(scores_all_names), axis=0)
+    if stage == 'nickname':
+      return match_nicknames(name, nicknamer, index, verbose=verbose)
+    if stage == 'string':
+      if verbose: print('allowing string matches')
+      # do same routine with a string-metric matcher, scoring all candidates at once
+      #	(same scores as string_matcher.match_names(m, n, speed=None))
+      batch_func = lambda field: lambda m, idx: string_matcher.match_many(m, \
+                                    index.parsed_names(field, string_matcher), positions=idx)
+      scores_all_names = [ self.score_names(name, target_names=names_list, \
+                                            exact=False, batch_func=batch_func(field), \
+                                            candidates=candidates()) \
+                                            for names_list, field in names_lists ]
+    else:
+      # NB: the machine learning matcher requires first- and last-name for efficacy
+      #all candidates are scored in one batched call (with siamese_threshold set, only
+      #	the query goes through the network; legislator embeddings are precomputed)
+      scores_all_names = [ self.score_names(name, target_names=names_list, \
+                                                  exact=False, candidates=candidates(), \
+                                                  embeddings=self.embeddings_of(branch, field)) \
+                                                  for names_list, field in names_lists ]
+    return np.max(np.vstack(scores_all_names), axis=0)
+  
+  @property
+  def cascade_stats(self):
+    #CascadeStats of best_match (objects pickled before the cascade have none)
+    if getattr(self, '_cascade_stats', None) is None:
+      self._cascade_stats = CascadeStats()
+    return self._cascade_stats
+  
   def best_match(self, name, branch=None, last_name=False,
                        verbose=False, return_score=False, 
                        filing_year=None, allow_string_matches=True):
@@ -561,110 +820,65 @@ class Legislators(object):
         #  'Invalid value for branch. Set to `Rep` for House members, `Sen` for Senate.'
     
     #get best matching legislator for a name
-    if last_name:
-      names = _lower(self.house_rep_last_names) if branch == 'Rep' else \
-                  (_lower(self.senator_last_names) if branch == 'Sen' else \
-                 _lower(self.last_names))
-    else:
-      names = self.house_rep_names if branch == 'Rep' else \
-                  (self.senator_names if branch == 'Sen' else \
-                   self.names)
-      full_names = self.house_rep_full_names if branch == 'Rep' else \
-                  (self.senator_full_names if branch == 'Sen' else \
-                   self.full_names)
-      wiki_names = self.house_rep_wikinames if branch == 'Rep' else \
-                  (self.senator_wikinames if branch == 'Sen' else \
-                   self.wikinames)
-    
-    legislators = self.house_reps if branch == 'Rep' else \
-                 (self.senators if branch == 'Sen' else \
-                  self.legislators)
+    #	candidate names come from the chamber's prebuilt NameIndex
+    index = self.index_of(branch)
+    legislators = index.legislators
     
-    leg_start_years = self.house_rep_start_years if branch == 'Rep' else \
-                     (self.senator_start_years if branch == 'Sen' else \
-                      self.start_years)
+    leg_start_years = index.start_years
     # chronological filter ensuring that legislator had 
     #		       been in office before filing year
     if filing_year is None: year_is_valid = np.ones(len(leg_start_years))
-    else: year_is_valid = filing_year >= np.array(leg_start_years)
+    else: year_is_valid = filing_year >= leg_start_years
     
     # control flow:
-    # prefer HMNI (siamese network name-matcher) when a full name is provided
-    # default to string-distance matchers ('jaro-winkler') if no match and allow_string_matches=True
-    # if last name only, require exact match
+    # the stages of self.cascade run in order, and the first whose best score passes its
+    # threshold decides the match (see match_stages):
+    #   'exact' - exact name lookup
+    #   'nickname' - surname plus a nickname of the first name (or the first initial)
+    #   'string' - string-distance matcher ('jaro-winkler')
+    #   'neural' - HMNI (siamese network name-matcher), exact matches preferred; with
+    #              siamese_threshold set, the batched siamese scorer and that threshold
+    # if last name only, require exact match ('exact' and 'neural' only)
+    # string and nickname stages only run with allow_string_matches=True
     # if a chamber is provided ('Rep' or 'Sen'), the search is constrained to legislators from that chamber
     
-    #Score names: 
-    # if it's only a 1-word name (last_name=True), only use exact match
-    # NB: the machine learning matcher requires first- and last-name for efficacy
-    if last_name: 
-      name = unidecode(name.lower())
-      scores = self.score_names(name, target_names=names, exact=last_name)
-    else:
-      scores_all_names = [ self.score_names(name, target_names=names_list, \
-                                                  exact=False) for names_list in \
-                                                  [ names, full_names, wiki_names ] ]
-      scores = np.max(np.vstack(scores_all_names), axis=0)
-    
-    scores = scores * year_is_valid 	# chronological filter
-    
-    #scores = self.score_names(name, target_names=names, exact=last_name)
-    best_score = np.max(scores)
-    best_match = legislators[np.argmax(scores)]
+    # blocking: only a short list of candidates reaches the ML/string matchers
+    blocked = []
+    def candidates():
+      if len(blocked) == 0:
+        blocked.append(self.blocker_of(branch).candidates(name, filing_year=filing_year) \
+                       if getattr(self, 'blocking', False) else None)
+      return blocked[0]
     
-    if best_score > .7: #sets a threshold for name matches
-      if return_score: 
-        return best_match, best_score
-      else:
-        return best_match
-    else:
-      if last_name or not allow_string_matches:
-        if verbose: print('no match')
-        #print(best_score, scores)
-        if return_score: return None, best_score
-        else: return None
-      else:
-        if verbose: print('allowing string matches')
-        # do same routine with a string-metric matcher
-        score_func = lambda m, n: string_matcher.match_names(m, n, speed=None)
-        scores_all_names = [ self.score_names(name, target_names=names_list, \
-                                              exact=False, score_func=score_func) \
-                                              for names_list in [ names, full_names, wiki_names ] ]
-        scores = np.max(np.vstack(scores_all_names), axis=0)
-        
-        scores = scores * year_is_valid 	# chronological filter
-        
-        #scores = self.score_names(name, target_names=names, exact=last_name)
-        best_score = np.max(scores)
+    cascade = getattr(self, 'cascade', legacy_cascade)
+    stats = self.cascade_stats
+    best_score = 0.
+    for stage in cascade:
+      if stage in ('string', 'nickname') and (last_name or not allow_string_matches):
+        continue
+      if stage == 'neural' and last_name and 'exact' in cascade:
+        continue #the same exact last-name lookup
+      start = time.perf_counter()
+      scores = self._stage_scores(stage, name, branch, index, last_name, \
+                                  candidates, verbose) * year_is_valid # chronological filter
+      stage_score = np.max(scores)
+      threshold = self.threshold(stage)
+      hit = stage_score > threshold
+      stats.record(stage, hit, time.perf_counter() - start)
+      if stage != 'nickname': best_score = stage_score
+      if hit:
+        if stage == 'string' and (scores > threshold).sum() > 1:
+          print(f'{name}: there were multiple matches')
         best_match = legislators[np.argmax(scores)]
-        
-       	#print(best_match, best_score)
-        
-        string_match_thresh = .92
-        if best_score > string_match_thresh:
-          if (scores > string_match_thresh).sum() > 1:
-              print(f'{name}: there were multiple matches')
-          if return_score: 
-            return best_match, best_score
-          else: 
-            return best_match
+        if return_score:
+          return best_match, stage_score
         else:
-          # try nicknames match
-          nickname_scores = match_nicknames(name, nicknamer, legislators) * year_is_valid
-          
-          best_nickname_score = np.max(nickname_scores)
-          best_match = legislators[np.argmax(nickname_scores)]
-          
-          if best_nickname_score > string_match_thresh:
-              if return_score:
-                  return best_match, best_nickname_score
-              else:
-                  return best_match
-          else:
-              if verbose: print('no match')
-              if return_score: return None, best_score
-              else: return None
-      
+          return best_match
+    
+    if verbose: print('no match')
+    if return_score: return None, best_score
+    else: return None
+  
       #if verbose: print('no match')
       #print(best_score, scores)
       #if return_score: return None, best_score
@@ -700,10 +914,17 @@ class Legislators(object):
     #    if return_score: return None, best_score
     #    else: return None
 
+#fixes common typos in covered positions, such as parentheses adjacent to names
+_typo_patterns = [ (re.compile(r'(\S)(\(|\)|,|\!|\?|\;|\:)'), r'\1 \2'),
+                   (re.compile(r'(\(|\)|,|\!|\?|\;|\:)(\S)'), r'\1 \2'),
+                   (re.compile(r'([A-Za-z]+)?([0-9]+)'), r'\1 \2'),
+                   (re.compile(r'([0-9]+)([A-Za-z]+)'), r'\1 \2') ]
+
 class LegislatorExtractor(object):
   """Class to extract legislator names from free text."""
   def __init__(self, spacy_model="en_core_web_trf"): 
     #self.ninja = ninja_postproc
+    import spacy #imported on first use
     self.nlp = spacy.load(spacy_model)
     self.rep_words = sorted([ 'Representative', 'Rep.', 'Rep',\
                               'Reps', 'Reps.', 
@@ -714,14 +935,27 @@ class LegislatorExtractor(object):
     self.rep_words_ = [ t.lower() for t in self.rep_words ]
     self.sen_words_ = [ t.lower() for t in self.sen_words ]
     self.leg_words_ = self.rep_words_ + self.sen_words_
-  def extract(self, sent, verbose=False):
+  def normalize(self, sent):
     # proc text to catch common typos, such as parentheses adjacent to names
-    sent = re.sub(r'(\S)(\(|\)|,|\!|\?|\;|\:)', r'\1 \2', sent)
-    sent = re.sub(r'(\(|\)|,|\!|\?|\;|\:)(\S)', r'\1 \2', sent)
-    sent = re.sub(r'([A-Za-z]+)?([0-9]+)', r'\1 \2', sent)
-    sent = re.sub(r'([0-9]+)([A-Za-z]+)', r'\1 \2', sent)
-    doc = self.nlp(sent)
-    ents = doc.ents
+    for pattern, repl in _typo_patterns:
+      sent = pattern.sub(repl, sent)
+    return sent
+  
+  def extract(self, sent, verbose=False):
+    return self.extract_from_doc(self.nlp(self.normalize(sent)), verbose=verbose)
+  
+  def extract_batch(self, sents, batch_size=64, n_process=1, verbose=False):
+    """extracts names from many texts with nlp.pipe; returns dict text -> extract(text)
+    kwargs:
+    	batch_size - texts per spaCy batch
+    	n_process - spaCy worker processes"""
+    sents = list(dict.fromkeys(sents)) #each distinct text once, in order
+    normalized = [ self.normalize(sent) for sent in sents ]
+    docs = self.nlp.pipe(normalized, batch_size=batch_size, n_process=n_process)
+    return { sent: self.extract_from_doc(doc, verbose=verbose) for sent, doc in \
+             zip(sents, tqdm(docs, total=len(sents))) }
+  
+  def extract_from_doc(self, doc, verbose=False):
     #match entities that fit the pattern [rep_word/sen_word] [person_tagged_word]+
     out = {}
     for e in doc.ents:
@@ -761,15 +995,97 @@ class LegislatorExtractor(object):
     if verbose: print(out, doc.text)
     return out
 
+_heuristics_files = [ os.path.join(os.path.dirname(os.path.abspath(__file__)), fname) for fname \
+                      in ('match_heuristics.py', 'product_category_names.txt') ]
+
+def heuristics_version(top_lvl_patterns, patterns):
+  #sha1 of the patterns and of the heuristics source (spot checks, abbreviations, product names)
+  digest = hashlib.sha1(json.dumps([ top_lvl_patterns, patterns ], default=repr).encode('utf-8'))
+  for fname in _heuristics_files:
+    if os.path.exists(fname):
+      with open(fname, 'rb') as file:
+        digest.update(file.read())
+  return digest.hexdigest()
+
 class CompanyMatcher(object):
+  """reduces company names with whittle_name, memoizing the results.
+  kwargs:
+  \ttop_lvl_patterns, patterns - see resources.match_heuristics
+  \tmemo_file - json file the memo is loaded from (if it exists) and written to by save()
+  \tmax_size - maximum number of memoized names, least recently used are dropped first;
+  \t           None keeps every name
+  The memo is keyed by raw name and is only valid for one version of the patterns
+  (self.version), so changing the patterns or match_heuristics starts a new memo."""
   def __init__(self, top_lvl_patterns=top_level_patterns, \
-                     patterns=patterns):
+                     patterns=patterns, memo_file=None, max_size=None):
     self.top_lvl_patterns = top_lvl_patterns
     self.patterns = patterns
+    self.memo_file = memo_file
+    self.max_size = max_size
+    self.memo = OrderedDict()
+    self._version = None
+    if memo_file is not None and os.path.exists(memo_file):
+      self.load(memo_file)
+  
+  @property
+  def version(self):
+    pattern_ids = (id(self.top_lvl_patterns), id(self.patterns), \
+                   len(self.top_lvl_patterns), len(self.patterns))
+    if self._version is None or self._version[0] != pattern_ids:
+      version = heuristics_version(self.top_lvl_patterns, self.patterns)
+      if self._version is not None and self._version[1] != version:
+        self.memo.clear() #patterns were replaced
+      self._version = (pattern_ids, version)
+    return self._version[1]
+  
   def reduce(self, name):
+    self.version #clears the memo if the patterns changed
+    try:
+      merged_name = self.memo[name]
+      if self.max_size is not None: self.memo.move_to_end(name)
+      return merged_name
+    except KeyError: pass
     merged_name = whittle_name(name, \
                   top_level_patterns=self.top_lvl_patterns, \
                   patterns=self.patterns, return_shortest=True)
+    self.memo[name] = merged_name
+    if self.max_size is not None and len(self.memo) > self.max_size:
+      self.memo.popitem(last=False)
     return merged_name
+  
+  def prime(self, names, batch_size=256):
+    #tags the one-word candidates of the names that are not memoized in one batch,
+    #	ahead of reducing them one at a time
+    self.version
+    names = [ name for name in dict.fromkeys(names) if name not in self.memo ]
+    if len(names) > 0:
+      prime_whittle(names, self.top_lvl_patterns, self.patterns, batch_size=batch_size)
+  
+  def save(self, fname=None):
+    #writes the memo to fname (or self.memo_file) as json
+    fname = self.memo_file if fname is None else fname
+    tmp_file = fname + '.tmp'
+    with open(tmp_file, 'w') as file:
+      json.dump({ 'version': self.version, 'merges': self.memo }, file)
+    os.replace(tmp_file, fname)
+  
+  def load(self, fname):
+    #adds the names memoized in fname, if they were reduced with the current patterns
+    with open(fname, 'r') as file:
+      saved = json.load(file)
+    if saved.get('version') != self.version:
+      print('%s was written with other patterns; not loaded' % fname)
+      return 0
+    for name, merged_name in saved['merges'].items():
+      self.memo.setdefault(name, merged_name)
+    while self.max_size is not None and len(self.memo) > self.max_size:
+      self.memo.popitem(last=False)
+    return len(saved['merges'])
+  
+  def __setstate__(self, state):
+    #matchers pickled before the memo only hold the patterns
+    self.__dict__.update({ 'memo_file': None, 'max_size': None, '_version': None })
+    self.__dict__.update(state)
+    if 'memo' not in state: self.memo = OrderedDict()
 
 
@@ -0,0 +1,130 @@
+# NumPy inference for the vendored HMNI siamese LSTM (siamese_network.py)
+# export_checkpoint converts the TensorFlow checkpoint to one .npy file per
+# variable plus a manifest.json (layer sizes, vocabulary, source fingerprint),
+# and NumpySiamese runs the towers from those arrays. TensorFlow is then only
+# needed to train or export; the arrays are memory-mapped, so worker processes
+# share one copy of the weights through the page cache.
+# usage: python -m lobbylinks.resources.hmni.numpy_siamese [model_dir] [out_dir]
+
+import os
+import re
+import sys
+import json
+
+import numpy as np
+
+weights_dirname = 'numpy'  # exported weights live in <model_dir>/numpy
+manifest_name = 'manifest.json'
+format_version = 1
+
+_variable = re.compile(r'bwside[12]/bidirectional_rnn/(fw|bw)/multi_rnn_cell/cell_\d+/lstm_cell/(kernel|bias)$')
+
+
+def export_checkpoint(model_dir=None, out_dir=None):
+    """Writes the inference variables of the `siamese` checkpoint in model_dir to
+    out_dir (default <model_dir>/numpy) and returns out_dir. The manifest is
+    written last, so a directory with a manifest holds a complete export."""
+    import tensorflow as tf
+    from .scorer import SiameseScorer, load_vocab, model_path
+    model_dir = model_path if model_dir is None else model_dir
+    out_dir = os.path.join(model_dir, weights_dirname) if out_dir is None else out_dir
+    reader = tf.compat.v1.train.load_checkpoint(os.path.join(model_dir, 'siamese'))
+    names = sorted(name for name in reader.get_variable_to_shape_map()
+                   if name == 'embedding/W' or _variable.match(name))
+    os.makedirs(out_dir, exist_ok=True)
+    arrays = {}
+    for name in names:
+        arrays[name] = name.replace('/', '.') + '.npy'
+        np.save(os.path.join(out_dir, arrays[name]), reader.get_tensor(name).astype(np.float32))
+    vocab, sequence_length = load_vocab(os.path.join(model_dir, 'vocab'))
+    kernel = 'bwside1/bidirectional_rnn/fw/multi_rnn_cell/cell_0/lstm_cell/kernel'
+    manifest = {
+        'format': format_version,
+        'fingerprint': SiameseScorer(model_dir=model_dir).fingerprint,
+        'sequence_length': sequence_length,
+        'n_layers': sum(1 for name in names if name.startswith('bwside1/bidirectional_rnn/fw/')
+                        and name.endswith('/kernel')),
+        'hidden_units': int(reader.get_variable_to_shape_map()[kernel][1] // 4),
+        'forget_bias': 1.0,
+        'vocab': vocab,
+        'arrays': arrays,
+    }
+    tmp_file = os.path.join(out_dir, manifest_name + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, os.path.join(out_dir, manifest_name))
+    return out_dir
+
+
+def has_weights(weights_dir):
+    return os.path.exists(os.path.join(weights_dir, manifest_name))
+
+
+def _sigmoid(x):
+    # tanh form; no overflow for large |x|
+    return 0.5 * (np.tanh(0.5 * x) + 1.)
+
+
+class NumpySiamese(object):
+    """
+    Towers of SiameseLSTM from exported weights (see export_checkpoint).
+    tower(ids, side) gives the same outputs as the TensorFlow network's
+    out1 (side=1) or out2 (side=2) for a batch of character ids.
+    kwargs:
+        mmap - memory-map the arrays instead of reading them into memory
+    """
+
+    def __init__(self, weights_dir, mmap=True):
+        with open(os.path.join(weights_dir, manifest_name)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format'] != format_version:
+            raise ValueError('unsupported weights format %r in %s' % (self.manifest['format'], weights_dir))
+        self.vocab = self.manifest['vocab']
+        self.sequence_length = self.manifest['sequence_length']
+        self.n_layers = self.manifest['n_layers']
+        self.hidden_units = self.manifest['hidden_units']
+        self.forget_bias = np.float32(self.manifest['forget_bias'])
+        self.arrays = {name: np.load(os.path.join(weights_dir, fname), mmap_mode='r' if mmap else None)
+                       for name, fname in self.manifest['arrays'].items()}
+
+    def _cell(self, side, direction, layer):
+        prefix = 'bwside%i/bidirectional_rnn/%s/multi_rnn_cell/cell_%i/lstm_cell/' % (side, direction, layer)
+        return self.arrays[prefix + 'kernel'], self.arrays[prefix + 'bias']
+
+    def _lstm_layer(self, x, kernel, bias):
+        # outputs of a tf LSTMCell run over x (batch x time x depth) from a zero
+        # state; gates are [x, h] . kernel + bias, split as i, j, f, o
+        depth = x.shape[2]
+        batch, steps = x.shape[:2]
+        gates_x = (x.reshape(batch * steps, depth).dot(kernel[:depth]) + bias).reshape(batch, steps, -1)
+        kernel_h = kernel[depth:]
+        h = np.zeros((batch, self.hidden_units), dtype=np.float32)
+        c = np.zeros((batch, self.hidden_units), dtype=np.float32)
+        outputs = np.empty((batch, steps, self.hidden_units), dtype=np.float32)
+        for t in range(steps):
+            i, j, f, o = np.split(gates_x[:, t] + h.dot(kernel_h), 4, axis=1)
+            c = c * _sigmoid(f + self.forget_bias) + _sigmoid(i) * np.tanh(j)
+            h = _sigmoid(o) * np.tanh(c)
+            outputs[:, t] = h
+        return outputs
+
+    def tower(self, ids, side):
+        """BiRNN output at the last position: the forward stack's last output and
+        the backward stack's output there, which is its first step (it reads
+        the sequence in reverse), concatenated."""
+        x = self.arrays['embedding/W'][np.asarray(ids)]
+        fw, bw = x, x[:, -1:]
+        for layer in range(self.n_layers):
+            fw = self._lstm_layer(fw, *self._cell(side, 'fw', layer))
+            bw = self._lstm_layer(bw, *self._cell(side, 'bw', layer))
+        return np.concatenate([fw[:, -1], bw[:, 0]], axis=1)
+
+    def distance(self, ids1, ids2):
+        """SiameseLSTM.distance of each pair of rows of ids1 (side1) and ids2 (side2)."""
+        out1, out2 = self.tower(ids1, side=1), self.tower(ids2, side=2)
+        return np.linalg.norm(out1 - out2, axis=1) \
+            / (np.linalg.norm(out1, axis=1) + np.linalg.norm(out2, axis=1))
+
+
+if __name__ == '__main__':
+    print('exported weights to', export_checkpoint(*sys.argv[1:3]))
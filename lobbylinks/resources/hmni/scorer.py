@@ -0,0 +1,401 @@
+# batched inference for the vendored HMNI siamese LSTM (siamese_network.py)
+# The two towers of the network (side1 for the query name, side2 for the
+# candidate name) are independent until the final distance, so a batch of
+# M queries against N candidates needs only M + N tower passes followed by a
+# vectorized distance computation, instead of M x N pairwise session runs.
+# Towers run in TensorFlow, or in NumPy from exported weights when
+# backend='numpy' is requested (see numpy_siamese).
+# BatchMatcher batches hmni.Matcher.similarity itself, keeping its scores.
+
+import os
+import re
+import json
+import pickle
+import hashlib
+import importlib.util
+from collections import OrderedDict
+
+import numpy as np
+
+from .numpy_siamese import NumpySiamese, has_weights, manifest_name, weights_dirname
+
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'latin')
+n_layers = 3  # as in SiameseLSTM.BiRNN
+
+
+class _Pickled(object):
+    # stand-in for the classes of the training-time `preprocess` module, which
+    # is not shipped; only the pickled attributes are needed
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+
+
+class _VocabUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == 'preprocess' or module.startswith('tensorflow'):
+            return type(name, (_Pickled,), {})
+        return super(_VocabUnpickler, self).find_class(module, name)
+
+
+def load_vocab(fname):
+    """Returns (char -> id mapping, max_document_length) of a pickled MyVocabularyProcessor."""
+    with open(fname, 'rb') as f:
+        processor = _VocabUnpickler(f).load()
+    return dict(processor.vocabulary_._mapping), int(processor.max_document_length)
+
+
+def distance_matrix(out1, out2):
+    """SiameseLSTM.distance for every pair of rows: ||o1 - o2|| / (||o1|| + ||o2||)."""
+    norm1 = np.linalg.norm(out1, axis=1)[:, None]
+    norm2 = np.linalg.norm(out2, axis=1)[None, :]
+    sq_dist = norm1**2 + norm2**2 - 2 * out1.dot(out2.T)
+    dist = np.sqrt(np.maximum(sq_dist, 0.))
+    return dist / np.maximum(norm1 + norm2, 1e-12)
+
+
+def calibrate_threshold(scores, labels, min_precision=.95):
+    """Threshold t such that the pairs scoring above t are matches with at least
+    min_precision, accepting as many pairs as possible, e.g. for
+    Legislators(siamese_threshold=t). scores are similarities of labelled
+    (name, legislator name) pairs, labels whether each pair is a match.
+    Returns None if no threshold reaches min_precision."""
+    scores, labels = np.asarray(scores, dtype=float), np.asarray(labels, dtype=bool)
+    order = np.argsort(-scores, kind='stable')
+    scores, labels = scores[order], labels[order]
+    precision = np.cumsum(labels) / np.arange(1, len(labels) + 1)
+    # cut only between distinct scores, since a tie is accepted or rejected as a whole
+    cuts = np.nonzero((precision >= min_precision) & np.append(scores[:-1] > scores[1:], True))[0]
+    if len(cuts) == 0:
+        return None
+    k = cuts[-1]
+    return float(scores[k + 1]) if k + 1 < len(scores) else float(np.nextafter(scores[k], -np.inf))
+
+
+def _sorted_pair(name_a, name_b):
+    # pair order used by hmni.Matcher (longest first, then alphabetical)
+    return tuple(sorted((name_a, name_b), key=lambda item: (-len(item), item)))
+
+
+class BatchMatcher(object):
+    """
+    Batched hmni.Matcher.similarity (prob=True). similarity(name, candidates)
+    returns the scores of [matcher.similarity(name, c) for c in candidates].
+    Each pair goes through the rules of Matcher.similarity (exact names,
+    surnames, initials, the first-name prefilter, scores of pairs seen before).
+    The first-name pairs left over are featurized once each and then scored by
+    the base model, the siamese network and the meta-model, with one call per
+    model. New scores are added to the matcher's seen_pairs, as
+    Matcher.similarity does.
+    kwargs:
+        batch_size - pairs per siamese session run
+    """
+
+    def __init__(self, matcher, batch_size=512):
+        self.matcher = matcher
+        self.batch_size = batch_size
+
+    def _rules(self, name_a, name_b, surname_first=False):
+        # Matcher.similarity up to its models: (score, None) when a rule decides the
+        # pair, else (None, (first-name pair, initial_lname, missing_component))
+        m = self.matcher
+        if len(m.user_scores) != 0:
+            score = m.seen_set(_sorted_pair(name_a.lower().strip(), name_b.lower().strip()),
+                               m.user_scores)
+            if score is not None:
+                return score, None
+        if len(name_a) < 2 or len(name_b) < 2:
+            return 0, None
+        if name_a == name_b:
+            return 1, None
+        name_a, name_b = m.preprocess(name_a), m.preprocess(name_b)
+        if len(name_a) == 0 or len(name_b) == 0:
+            return 0, None
+        missing_component = False
+        one_component = False
+        if len(name_a) == 1 and len(name_b) == 1:
+            one_component = True
+        elif len(name_a) == 1 or len(name_b) == 1:
+            if not m.allow_missing_components:
+                return 0, None
+            missing_component = True
+        if surname_first:
+            fname_a, lname_a, fname_b, lname_b = name_a[-1], name_a[0], name_b[-1], name_b[0]
+        else:
+            fname_a, lname_a, fname_b, lname_b = name_a[0], name_a[-1], name_b[0], name_b[-1]
+        if not m.allow_initials and any(len(x) == 1 for x in [fname_a, lname_a, fname_b, lname_b]):
+            return 0, None
+        initial_lname = False
+        if len(lname_a) == 1 or len(lname_b) == 1:
+            if lname_a[0] != lname_b[0] and not missing_component:
+                return 0, None
+            initial_lname = True
+        elif not one_component:
+            if m.allow_alt_surname:
+                if m.pshp_soundex_last.encode(lname_a) != m.pshp_soundex_last.encode(lname_b):
+                    if not missing_component:
+                        return 0, None
+                elif missing_component:
+                    return 0.5, None
+            elif lname_a != lname_b and not missing_component:
+                return 0, None
+            elif missing_component:
+                return 0.5, None
+        if len(fname_a) == 1 or len(fname_b) == 1:
+            return (0.5 if fname_a[0] == fname_b[0] else 0), None
+        if fname_a == fname_b:
+            return (1 if not missing_component and not initial_lname else 0.5), None
+        pair = _sorted_pair(fname_a, fname_b)
+        if m.prefilter and not missing_component and pair[0][0] != pair[1][0]:
+            encoded1 = set(m.refined_soundex.get(c) for c in set(pair[0][1:]))
+            encoded2 = set(m.refined_soundex.get(c) for c in set(pair[1][1:]))
+            encoded1.discard(None)
+            encoded2.discard(None)
+            if encoded1.isdisjoint(encoded2):
+                return 0, None
+        return None, (pair, initial_lname, missing_component)
+
+    def _siamese(self, pairs):
+        # 1 - siamese distance of each pair, as Matcher.siamese_inf, in batched session runs
+        m = self.matcher
+        sims = []
+        for i in range(0, len(pairs), self.batch_size):
+            batch = pairs[i:i + self.batch_size]
+            x1 = np.asarray(list(m.vocab.transform(np.asarray([pair[0] for pair in batch]))))
+            x2 = np.asarray(list(m.vocab.transform(np.asarray([pair[1] for pair in batch]))))
+            distance = m.sess.run(m.prediction, {m.input_x1: x1, m.input_x2: x2,
+                                                 m.dropout_keep_prob: 1.0})
+            sims.append(1 - distance)
+        return np.concatenate(sims)
+
+    def _model_scores(self, pairs):
+        # Matcher.meta_inf of each pair, with one call per model
+        m = self.matcher
+        features = np.vstack([m.featurize(pair) for pair in pairs])
+        meta_features = np.zeros((len(pairs), 5))
+        meta_features[:, 0] = m.baseModel.predict_proba(features)[:, 1]
+        meta_features[:, 1] = self._siamese(pairs)
+        meta_features[:, 2] = features[:, 2]  # tkn_set
+        meta_features[:, 3] = features[:, 5]  # iterativesubstring
+        meta_features[:, 4] = features[:, 11]  # strcmp95
+        return m.metaModel.predict_proba(meta_features)[:, 1]
+
+    def similarity(self, name, candidates, surname_first=False):
+        """scores of name against each candidate, as an array"""
+        m = self.matcher
+        scores = np.zeros(len(candidates))
+        pending = []  # (position, pair, initial_lname, missing_component)
+        for i, candidate in enumerate(candidates):
+            score, model_input = self._rules(name, candidate, surname_first=surname_first)
+            if model_input is None:
+                scores[i] = score
+            else:
+                pending.append((i,) + model_input)
+        new_pairs = list(OrderedDict.fromkeys(pair for _, pair, _, _ in pending
+                                              if m.seen_set(pair, m.seen_pairs) is None))
+        new_scores = dict(zip(new_pairs, self._model_scores(new_pairs))) if len(new_pairs) > 0 else {}
+        for i, pair, initial_lname, missing_component in pending:
+            sim = new_scores[pair] if pair in new_scores else m.seen_set(pair, m.seen_pairs)
+            if not missing_component:
+                m.seen_pairs[hash(pair)] = sim
+            scores[i] = min(0.5, sim) if initial_lname else sim
+        return scores
+
+
+class SiameseScorer(object):
+    """
+    Batched name similarity with the HMNI siamese network.
+    similarity(query, candidates) scores one name against N candidates, and
+    similarity(queries, candidates) returns an M x N matrix. Similarity is
+    1 - SiameseLSTM.distance on the whole (lowercased) names, which is not the
+    probability hmni.Matcher.similarity returns from its meta-model, so
+    thresholds have to be calibrated for it (see calibrate_threshold). The
+    network is built and restored lazily, on the first call.
+    kwargs:
+        model_dir - directory holding the `siamese` checkpoint and `vocab`
+        weights_dir - exported NumPy weights, for backend='numpy'
+                      (default <model_dir>/numpy)
+        backend - 'tensorflow' (the checkpoint) or 'numpy' (exported weights)
+        batch_size - names per forward pass
+        cache_size - number of query embeddings kept in memory
+    """
+
+    def __init__(self, model_dir=model_path, weights_dir=None, batch_size=512, cache_size=100000,
+                 backend='tensorflow'):
+        if backend not in ('tensorflow', 'numpy'):
+            raise ValueError("unknown backend %r (use 'tensorflow' or 'numpy')" % (backend,))
+        self.model_dir = model_dir
+        self.requested_backend = backend
+        self.weights_dir = os.path.join(model_dir, weights_dirname) if weights_dir is None else weights_dir
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.checkpoint = os.path.join(model_dir, 'siamese')
+        self._tower = None
+        self._backend = None
+        self._available = None
+        self._fingerprint = None
+        self._query_cache = OrderedDict()
+
+    @property
+    def backend(self):
+        """the requested backend if its files (exported weights for 'numpy', the
+        checkpoint and tensorflow for 'tensorflow') are available, else None"""
+        if self._backend is None:
+            self._backend = self._find_backend()
+        return self._backend or None
+
+    def _find_backend(self):
+        if self.requested_backend == 'numpy':
+            return 'numpy' if has_weights(self.weights_dir) else ''
+        # checkpoint data, vocab and tensorflow are all needed
+        data_files = [f for f in os.listdir(self.model_dir) if f.startswith('siamese.data')] \
+                     if os.path.isdir(self.model_dir) else []
+        if len(data_files) > 0 \
+                and os.path.exists(self.checkpoint + '.index') \
+                and os.path.exists(os.path.join(self.model_dir, 'vocab')) \
+                and importlib.util.find_spec('tensorflow') is not None:
+            return 'tensorflow'
+        return ''
+
+    @property
+    def available(self):
+        if self._available is None:
+            self._available = self.backend is not None
+        return self._available
+
+    @property
+    def fingerprint(self):
+        """sha1 of the checkpoint and vocab files; identifies the model in on-disk caches.
+        Exported weights carry the fingerprint of the checkpoint they came from."""
+        if self._fingerprint is None and self.backend == 'numpy':
+            with open(os.path.join(self.weights_dir, manifest_name)) as f:
+                self._fingerprint = json.load(f)['fingerprint']
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for fname in sorted(os.listdir(self.model_dir)):
+                if fname.startswith('siamese') or fname == 'vocab':
+                    digest.update(fname.encode('utf-8'))
+                    with open(os.path.join(self.model_dir, fname), 'rb') as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b''):
+                            digest.update(chunk)
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def load(self):
+        if self._tower is not None:
+            return
+        if self.backend == 'numpy':
+            model = NumpySiamese(self.weights_dir)
+            self.vocab, self.sequence_length = model.vocab, model.sequence_length
+            self._tower = model.tower
+            return
+        import tensorflow as tf
+        tf1 = tf.compat.v1
+        self.vocab, self.sequence_length = load_vocab(os.path.join(self.model_dir, 'vocab'))
+        # layer sizes are read from the checkpoint rather than assumed
+        reader = tf1.train.load_checkpoint(self.checkpoint)
+        vocab_size, embedding_size = reader.get_variable_to_shape_map()['embedding/W']
+        kernel = 'bwside1/bidirectional_rnn/fw/multi_rnn_cell/cell_0/lstm_cell/kernel'
+        hidden_units = reader.get_variable_to_shape_map()[kernel][1] // 4
+
+        graph = tf1.Graph()
+        with graph.as_default():
+            self._inputs, self._outputs = {}, {}
+            with tf1.name_scope('embedding'):
+                W = tf1.Variable(tf1.zeros([vocab_size, embedding_size]), name='W')
+            with tf1.name_scope('output'):
+                for side in (1, 2):
+                    x = tf1.placeholder(tf.int32, [None, self.sequence_length],
+                                        name='input_x%i' % side)
+                    self._inputs[side] = x
+                    self._outputs[side] = self._birnn(tf1, tf1.nn.embedding_lookup(W, x),
+                                                      'side%i' % side, hidden_units)
+            saver = tf1.train.Saver(tf1.global_variables())
+            self._session = tf1.Session(graph=graph)
+            saver.restore(self._session, self.checkpoint)
+        self._tower = lambda ids, side: self._session.run(self._outputs[side], {self._inputs[side]: ids})
+
+    def _birnn(self, tf1, x, scope, hidden_units):
+        # inference-time SiameseLSTM.BiRNN (no dropout); variable names match the checkpoint
+        x = tf1.unstack(tf1.transpose(x, perm=[1, 0, 2]))
+        cells = {}
+        for direction in ('fw', 'bw'):
+            cells[direction] = tf1.nn.rnn_cell.MultiRNNCell(
+                [tf1.nn.rnn_cell.LSTMCell(hidden_units, forget_bias=1.0, state_is_tuple=True)
+                 for _ in range(n_layers)], state_is_tuple=True)
+        with tf1.name_scope('bw' + scope):
+            with tf1.variable_scope('bw' + scope):
+                (outputs, _, _) = tf1.nn.static_bidirectional_rnn(cells['fw'], cells['bw'], x,
+                                                                  dtype=tf1.float32)
+        return outputs[-1]
+
+    def transform(self, names):
+        """Character ids of each (lowercased) name, padded/truncated to the model length."""
+        ids = np.zeros((len(names), self.sequence_length), dtype=np.int32)
+        for i, name in enumerate(names):
+            for j, char in enumerate(name.lower()[:self.sequence_length]):
+                ids[i, j] = self.vocab.get(char, 0)
+        return ids
+
+    def embed(self, names, side=2, batch_size=None):
+        """Tower outputs for a list of names; side=1 for queries, side=2 for candidates."""
+        self.load()
+        batch_size = self.batch_size if batch_size is None else batch_size
+        ids = self.transform(names)
+        out = [self._tower(ids[i:i + batch_size], side) for i in range(0, len(ids), batch_size)]
+        return np.concatenate(out) if len(out) > 0 else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_candidates(self, names, cache_dir=None, batch_size=None):
+        """side2 outputs for a fixed list of names (e.g. all legislators). With cache_dir,
+        they are read from / written to a .npy file keyed by the model fingerprint and a
+        hash of the names, so they are computed once per model and name list."""
+        names = list(names)
+        if cache_dir is None:
+            return self.embed(names, side=2, batch_size=batch_size)
+        names_hash = hashlib.sha1('\n'.join(names).encode('utf-8')).hexdigest()
+        fname = os.path.join(cache_dir, 'siamese-%s-%s.npy' % (self.fingerprint[:16], names_hash[:16]))
+        if os.path.exists(fname):
+            embeddings = np.load(fname)
+            if len(embeddings) == len(names):
+                return embeddings
+        embeddings = self.embed(names, side=2, batch_size=batch_size)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = fname[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_file, embeddings)
+        os.replace(tmp_file, fname)
+        return embeddings
+
+    def embed_queries(self, names, batch_size=None):
+        """side1 outputs, memoized per name (see prime)."""
+        missing = list(OrderedDict.fromkeys(n for n in names if n not in self._query_cache))
+        vectors = {}
+        if len(missing) > 0:
+            vectors = dict(zip(missing, self.embed(missing, side=1, batch_size=batch_size)))
+            self._query_cache.update(vectors)
+            while len(self._query_cache) > self.cache_size:
+                self._query_cache.popitem(last=False)
+        return np.vstack([vectors[n] if n in vectors else self._query_cache[n] for n in names])
+
+    def prime(self, names, batch_size=None):
+        # embeds many query names in batched passes ahead of scoring
+        names = [re.sub(r'[0-9]', '', n) for n in names]
+        if len(names) > 0:
+            self.embed_queries(names, batch_size=batch_size)
+
+    def similarity(self, queries, candidates, batch_size=None, candidate_embeddings=None):
+        """similarity of one query (str) to N candidates -> array of N, or of M queries
+        (list) to N candidates -> M x N array. candidate_embeddings (side2 outputs of
+        the candidates) can be passed to skip the candidate tower."""
+        single = isinstance(queries, str)
+        queries = [queries] if single else list(queries)
+        if len(queries) == 0 or len(candidates) == 0:
+            scores = np.zeros((len(queries), len(candidates)))
+        else:
+            out1 = self.embed_queries(queries, batch_size=batch_size)
+            out2 = self.embed(list(candidates), side=2, batch_size=batch_size) \
+                if candidate_embeddings is None else candidate_embeddings
+            scores = 1. - distance_matrix(out1, out2)
+        return scores[0] if single else scores
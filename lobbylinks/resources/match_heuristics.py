@@ -4,15 +4,14 @@
 ##################################################
 
 import re
-import spacy
-from pywordsegment import WordSegmenter as seg
-from pluralizer import Pluralizer
+import functools
 import os.path as op
 import os
 import pandas as pd
-from wordfreq import zipf_frequency
 #from locationtagger import find_locations
 import string
+#	spacy, wordfreq, pywordsegment and pluralizer are slow to import, and are
+#	imported where they are first used
 
 import sys
 path = os.path.dirname(os.path.abspath(__file__))
@@ -21,19 +20,30 @@ path = os.path.dirname(os.path.abspath(__file__))
 punct_trans = str.maketrans(string.punctuation, ' '*len(string.punctuation))
 strip_punct = lambda s: ' '.join(s.translate(punct_trans).split())
 
-# import product category names
-with open(op.join(path, 'product_category_names.txt'), 'r') as file:
-  products = [ s.strip().upper().replace(' ', r'\s+') for s in file.readlines() if len(s.strip()) > 0 ] 
-
-pluralizer = Pluralizer()
-for product in set(products):
-    products.append(pluralizer.pluralize(product))
+@functools.lru_cache(maxsize=None)
+def get_products():
+  #(product category names, their regexes), loaded and compiled on first use
+  from pluralizer import Pluralizer
+  # import product category names
+  with open(op.join(path, 'product_category_names.txt'), 'r') as file:
+    products = [ s.strip().upper().replace(' ', r'\s+') for s in file.readlines() if len(s.strip()) > 0 ] 
+  
+  pluralizer = Pluralizer()
+  for product in set(products):
+      products.append(pluralizer.pluralize(product))
+  
+  products = sorted(list(set(products)), key=len)[::-1] # sort longest to shortest
+  product_regexes = [ re.compile(r'\b'+word+r'\b', re.IGNORECASE) for word in products ]
+  return products, product_regexes
 
-products = sorted(list(set(products)), key=len)[::-1] # sort longest to shortest
-product_regexes = [ re.compile(r'\b'+word+r'\b', re.IGNORECASE) for word in products ]
+def __getattr__(name):
+  #module attributes that are built on first use
+  if name == 'products': return get_products()[0]
+  if name == 'product_regexes': return get_products()[1]
+  raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def extract_product(s):
-  for regex in product_regexes:
+  for regex in get_products()[1]:
       match = regex.search(s)
       if match is not None:
           prod = match[0]
@@ -43,7 +53,15 @@ def extract_product(s):
           return minus_prod, prod
   return s, None
 
-_nlp = spacy.load('en_core_web_trf')
+#	part-of-speech tagger for the one-word filter of whittle_name, loaded on first use
+tagger_model = 'en_core_web_trf'
+_nlp = None
+def tagger():
+  global _nlp
+  if _nlp is None:
+    import spacy
+    _nlp = spacy.load(tagger_model, disable=['parser', 'ner', 'lemmatizer'])
+  return _nlp
 
 #	lightly preprocess by replacing dashes with spaces 
 #	and removing extra whitespace
@@ -79,7 +97,12 @@ base_string = '(.+?)(,){0,1}'
 
 #	basic utilities for matching regexes
 make_pattern = lambda regex: regex % base_string
-getnames = lambda regex, target: re.search(make_pattern(regex), target, re.IGNORECASE)
+getnames = lambda regex, target: compile_pattern(regex).search(target)
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(regex):
+  #make_pattern(regex), compiled once per pattern string
+  return re.compile(make_pattern(regex), re.IGNORECASE)
 
 # format for a pattern: tuple( PATTERN, GROUP )
 #	GROUP is the index in the re.search call to retrieve
@@ -233,12 +256,65 @@ def apply_pattern(pattern, group_id, name):
       return None
   else: return None
 
+#	patterns of the form '^%s SUFFIX$' or '^%s\s+(?<!OF )SUFFIX$', with a literal SUFFIX
+suffix_form = re.compile(r"^\^%s(?: |\\s\+(?:\(\?<!OF \))?)((?:[A-Za-z0-9&'_ ]|\\\.)+)\$$")
+
+class PatternSet(object):
+  """compiled pattern list (e.g. patterns, top_level_patterns). A suffix pattern
+  (see suffix_form) can only match a name whose last word is the last word of
+  its suffix, so suffix patterns are bucketed by that word and only tried on the
+  names that end with it. self.results(name) is memoized.
+  kwargs:
+  \tcache_size - number of names whose results are kept"""
+  def __init__(self, patterns, cache_size=2**16):
+    self.patterns = list(patterns)
+    self.general = []	#(index, pattern, group_id), tried on every name
+    self.suffixes = {}	#lowercase last word -> [ (index, pattern, group_id) ]
+    for i, (pattern, group_id) in enumerate(self.patterns):
+      compile_pattern(pattern)
+      suffix = suffix_form.match(pattern)
+      if suffix is None:
+        self.general.append((i, pattern, group_id))
+      else:
+        last_word = suffix.group(1).replace('\\.', '.').split()[-1].lower()
+        self.suffixes.setdefault(last_word, []).append((i, pattern, group_id))
+    self.results = functools.lru_cache(maxsize=cache_size)(self._results)
+  
+  def candidates(self, name):
+    #patterns that can match name, in their original order
+    words = name.split()
+    if len(words) == 0 or not name.isascii():
+      #(case-insensitive matching of non-ascii text does not follow str.lower)
+      return self.patterns
+    bucket = self.suffixes.get(words[-1].lower())
+    if bucket is None:
+      return [ (pattern, group_id) for i, pattern, group_id in self.general ]
+    return [ (pattern, group_id) for i, pattern, group_id in \
+                                 sorted(self.general + bucket) ]
+  
+  def _results(self, name):
+    #apply_pattern results of every pattern that matched name, in pattern order
+    results = []
+    for pattern, group_id in self.candidates(name):
+      result = apply_pattern(pattern, group_id, name)
+      if result is not None:
+        results.append(result)
+    return tuple(results)
+
+_pattern_sets = {}
+def compile_patterns(patterns):
+  #PatternSet of a pattern list, built once per distinct list
+  key = tuple(patterns)
+  try:
+    return _pattern_sets[key]
+  except KeyError:
+    pattern_set = _pattern_sets[key] = PatternSet(key)
+    return pattern_set
+
 def apply_patterns(patterns, name, recursive=False):
   new_names = set([name])
-  for pattern, group_id in patterns:
-    result = apply_pattern(pattern, group_id, name)
-    if result is not None:
-      new_names.add(result)
+  for result in compile_patterns(patterns).results(name):
+    new_names.add(result)
   #print(new_names)
   if recursive:
     if len(new_names) > 0:
@@ -278,7 +354,63 @@ punct_ = str.maketrans('', '', string.punctuation)
 remove_punct = lambda s: s.translate(punct_)
 
 strip_punct = lambda s: s.strip(' &%*-.!-_+=,;:"\'')
-zipf_ = lambda s: zipf_frequency(strip_punct(s.split()[0]), 'en')
+
+@functools.lru_cache(maxsize=2**16)
+def zipf_(s):
+  from wordfreq import zipf_frequency
+  return zipf_frequency(strip_punct(s.split()[0]), 'en')
+
+#	tag of the first token of each lowercased one-word name (None if it has no tokens)
+_tags = {}
+def prime_tags(words, batch_size=256):
+  #tags the words that are not in the tag table in one nlp.pipe pass
+  words = [ word for word in dict.fromkeys(word.lower() for word in words) \
+                 if word not in _tags ]
+  if len(words) > 0:
+    for word, parse in zip(words, tagger().pipe(words, batch_size=batch_size)):
+      _tags[word] = parse[0].tag_ if len(parse) >= 1 else None
+
+def first_tag(word):
+  word = word.lower()
+  if word not in _tags:
+    prime_tags([ word ])
+  return _tags[word]
+
+def needs_tag(name):
+  #only the one-word names of middling frequency are decided by their tag
+  return 1 <= zipf_(name) < 3.8
+
+def keep_single_word(name):
+  #accept a one-word name if it is very infrequent, or a proper noun that is not common
+  if len(name.split()) == 0: return False
+  zipf = zipf_(name)
+  if zipf < 1: return True
+  if zipf >= 3.8: return False
+  return first_tag(name) in ['NNP']
+
+def candidate_names(name, top_level_patterns, patterns):
+  #names the patterns extract from a preprocessed name
+  #apply top-level patterns
+  names = apply_patterns(top_level_patterns, name, recursive=True)
+  names = { name for name in names if filter_from_toplevel_(name) }
+  #recursively extract names
+  if len(names) == 0:
+    names = apply_patterns(patterns, name, recursive=True)
+  else:
+    for name_ in names:
+      names = names.union(apply_patterns(patterns, name_, recursive=True))
+  return names
+
+def prime_whittle(names, top_level_patterns, patterns, batch_size=256):
+  #tags the one-word candidates that whittle_name will check for names,
+  #	batched in one nlp.pipe pass instead of one parse per candidate
+  words = []
+  for name in names:
+    name = expand_abbrevs(preproc(name))
+    if any( func(name) for func, out_name in spot_checks): continue
+    words.extend( name_ for name_ in candidate_names(name, top_level_patterns, patterns) \
+                        if len(name_.split()) == 1 and needs_tag(name_) )
+  prime_tags(words, batch_size=batch_size)
 
 def whittle_name(name, top_level_patterns, patterns, return_shortest=True, word_segment=False):
   name = preproc(name)	# light preprocessing
@@ -289,36 +421,15 @@ def whittle_name(name, top_level_patterns, patterns, return_shortest=True, word_
     valid_names = set([ out_name for func, out_name \
                                  in spot_checks if func(name) ])
   else:
-    #apply top-level patterns
-    names = apply_patterns(top_level_patterns, name, recursive=True)
-    #print(0, names)
-    names = { name for name in names if filter_from_toplevel_(name) }
-    #print(1, names)
-    #print('toplev', names)
-    #print(names)
-    #recursively extract names
-    if len(names) == 0:
-      names = apply_patterns(patterns, name, recursive=True)
-    else:
-      for name_ in names:
-        names = names.union(apply_patterns(patterns, name_, recursive=True))
+    names = candidate_names(name, top_level_patterns, patterns)
     
-    #print(2, names)
     #filter names that are 1-word that is not a proper noun
     #	e.g. "TESLA MOTORS" should reduce to "TESLA" 
     #          but "GENERAL MOTORS" should not reduce to "GENERAL"
     valid_names = set()
     for name in names:
-      if len(name.split()) > 1:
+      if len(name.split()) > 1 or keep_single_word(name):
         valid_names.add(name)
-      else:
-        parse = _nlp(name.lower())
-        if len(parse) >= 1:
-            #print('checking tag', parse, parse[0].tag_, parse[0].tag_ in ['NNP'])
-            # if word is a proper noun or very infrequent, accept
-            if (parse[0].tag_ in ['NNP'] and zipf_(name) < 3.8) or\
-               zipf_(name) < 1:
-                valid_names.add(name)
     
     #valid_names = set([ name for name in names if (len(name.split()) > 1 \
     #                             or _nlp(name.lower())[0].tag_ in ['NNP']) ])
@@ -337,6 +448,7 @@ def whittle_name(name, top_level_patterns, patterns, return_shortest=True, word_
      valid_names = valid_names_
   
   if word_segment: # experimental feature: add word segmentation
+    from pywordsegment import WordSegmenter as seg
     seg_names = { ' '.join(seg.segment(name)) for name in valid_names }
     valid_names = valid_names.union(seg_names)
   
@@ -3,6 +3,8 @@
 # -----------------------------------------------------------------------------
 # Class included: NameMatcher
 # Public methods: match_names(name1, name2)
+#                 match_parsed(name_dict1, name_dict2)
+#                 match_many(name, candidates)
 #                 parse_name(name)
 #                 find_closest_names(target_names, other_names)
 # -----------------------------------------------------------------------------
@@ -12,18 +14,102 @@
 import re
 import csv
 import numpy as np
+import heapq
 from math import log
 from statistics import mean
 from bisect import bisect_left
-from nltk.metrics import edit_distance
+from concurrent.futures import ProcessPoolExecutor
 try:
     from jellyfish import jaro_winkler
+    winkler_boost = True
 except:
     from jellyfish import jaro_similarity as jaro_winkler
+    winkler_boost = False
 
 def jaro_distfun(str1, str2):
 	return 1 - jaro_winkler(str1, str2)
 
+def edit_distance(str1, str2):
+	# nltk takes a while to import, so it is imported on first use
+	from nltk.metrics import edit_distance as nltk_edit_distance
+	return nltk_edit_distance(str1, str2)
+
+# Vectorized kernels: the same scores as jaro_winkler and edit_distance, for many
+# pairs of strings at once. Strings are padded arrays of code points (one row per
+# pair), and the loops run over character positions instead of pairs.
+
+def _codepoints(strs):
+	lengths = np.array([len(s) for s in strs], dtype=int)
+	width = max(lengths.max(initial=0), 1)
+	points = np.full((len(strs), width), -1, dtype=np.int64)
+	points[np.arange(width) < lengths[:,None]] = \
+		np.frombuffer(''.join(strs).encode('utf-32-le'), dtype=np.uint32)
+	return points, lengths
+
+def jaro_many(strs1, strs2, winkler=winkler_boost):
+	# jaro_winkler(strs1[k], strs2[k]) for each k (plain Jaro if not winkler)
+	if len(strs1) == 0: return np.zeros(0)
+	s1, len1 = _codepoints(strs1)
+	s2, len2 = _codepoints(strs2)
+	search_range = np.maximum(np.maximum(len1, len2) // 2 - 1, 0)
+	# equal characters within the search range of each other
+	pos1, pos2 = np.arange(s1.shape[1])[:,None], np.arange(s2.shape[1])
+	matchable = (s1[:,:,None] == s2[:,None,:]) \
+				& (np.abs(pos1 - pos2) <= search_range[:,None,None]) \
+				& (pos1 < len1[:,None,None]) & (pos2 < len2[:,None,None])
+	# flag matching characters: each character of str1 takes the first
+	# unflagged matchable character of str2
+	rows = np.arange(len(s1))
+	flags1 = np.zeros(s1.shape, dtype=bool)
+	flags2 = np.zeros(s2.shape, dtype=bool)
+	for i in range(s1.shape[1]):
+		open_ = matchable[:,i] & ~flags2
+		j = open_.argmax(axis=1)
+		flags1[:,i] = open_[rows, j]
+		flags2[rows[flags1[:,i]], j[flags1[:,i]]] = True
+	common = flags1.sum(axis=1)
+	# transpositions: the k-th matched characters of the two strings differ
+	matched1 = np.full(s1.shape, -1, dtype=np.int64)
+	matched2 = np.full(s1.shape, -2, dtype=np.int64)
+	r, c = np.nonzero(flags1)
+	matched1[r, (np.cumsum(flags1, axis=1) - 1)[r, c]] = s1[r, c]
+	r, c = np.nonzero(flags2)
+	matched2[r, (np.cumsum(flags2, axis=1) - 1)[r, c]] = s2[r, c]
+	trans = ((matched1 != matched2) & (np.arange(s1.shape[1]) < common[:,None])).sum(axis=1) // 2
+	with np.errstate(divide='ignore', invalid='ignore'):
+		weight = common / len1 + common / len2
+		weight += (common - trans) / common
+		weight /= 3
+	weight[common == 0] = 0.
+	if not winkler: return weight
+	# boost for a common prefix of up to 4 characters
+	prefix_len = np.minimum(np.minimum(len1, len2), 4)
+	width = min(s1.shape[1], s2.shape[1], 4)
+	same = (s1[:,:width] == s2[:,:width]) & (np.arange(width) < prefix_len[:,None])
+	prefix = np.cumprod(same, axis=1).sum(axis=1)
+	boost = (weight > 0.7) & (prefix > 0)
+	weight[boost] += prefix[boost] * 0.1 * (1.0 - weight[boost])
+	return weight
+
+def levenshtein_many(strs1, strs2):
+	# edit_distance(strs1[k], strs2[k]) for each k
+	if len(strs1) == 0: return np.zeros(0, dtype=int)
+	s1, len1 = _codepoints(strs1)
+	s2, len2 = _codepoints(strs2)
+	rows = np.arange(len(s1))
+	prev = np.tile(np.arange(s2.shape[1] + 1), (len(s1), 1))
+	edits = prev[rows, len2]
+	for i in range(1, s1.shape[1] + 1):
+		cur = np.empty_like(prev)
+		cur[:,0] = i
+		for j in range(1, s2.shape[1] + 1):
+			cur[:,j] = np.minimum(np.minimum(prev[:,j] + 1, cur[:,j-1] + 1),
+								  prev[:,j-1] + (s1[:,i-1] != s2[:,j-1]))
+		done = len1 == i
+		edits[done] = cur[rows[done], len2[done]]
+		prev = cur
+	return edits
+
 class NameMatcher:
 	suffixes = {'junior', 'jr', 'senior', 'sr', 'ii', 'iii', 'iv'}
 	weight_order = ['first_names', 'last_name', 'suffix']
@@ -54,8 +140,11 @@ class NameMatcher:
 		return log_edits
 
 	def match_names(self, name1, name2, speed='fast', min_last_sim=0.8):
-		name_dict1 = self.parse_name(name1.lower())
-		name_dict2 = self.parse_name(name2.lower())
+		return self.match_parsed(self.parse_name(name1.lower()), self.parse_name(name2.lower()),
+								 speed=speed, min_last_sim=min_last_sim)
+
+	def match_parsed(self, name_dict1, name_dict2, speed='fast', min_last_sim=0.8):
+		# match_names of two names already parsed (lowercase) by parse_name
 		sims = {}
 		sims['suffix'] = self._suffix_sim(name_dict1['suffix'], name_dict2['suffix'])
 		sims['last_name'] = 1 - self.distfun(name_dict1['last_name'], name_dict2['last_name'])
@@ -75,6 +164,86 @@ class NameMatcher:
 			sims['first_names'] *= self.params['disc_missing_nickname']
 		return self._weighted_sum(sims)
 
+	def match_many(self, name, candidates, positions=None):
+		# match_names(name, candidate, speed=None) for many candidates in one pass:
+		# distinct last names, suffixes and first-name tokens of the candidates are
+		# scored once, with the string distances vectorized (see jaro_many).
+		# candidates - list of names, or ParsedNames to parse them only once
+		# positions - indices of the candidates to score (default all)
+		if not isinstance(candidates, ParsedNames):
+			candidates = ParsedNames(self, candidates)
+		positions = range(len(candidates)) if positions is None else list(positions)
+		if len(positions) == 0: return np.zeros(0)
+		name_dict = self.parse_name(name.lower())
+		last_names = list(dict.fromkeys(candidates.last_names[p] for p in positions))
+		last_sims = dict(zip(last_names, 1 - self._dist_many([name_dict['last_name']]*len(last_names),
+															  last_names)))
+		suffix_sims = {suffix:self._suffix_sim(name_dict['suffix'], suffix) for suffix \
+					   in set(candidates.suffixes[p] for p in positions)}
+		# first-name sims are kept between calls, e.g. for the same name scored
+		# against several lists of candidates
+		memo = self._first_sims_memo()
+		query = (tuple(name_dict['first_names']), tuple(name_dict['nicknames']),
+				 self._suffix_acron_letter(name_dict['suffix']))
+		first_keys = [key for key in dict.fromkeys(candidates.first_keys[p] for p in positions)
+					  if (query, key) not in memo]
+		# token pairs that _max_subseq_sim may compare, in either order
+		tokens1 = {tok for fnames in query[:2] for tok in fnames if len(tok) > 1}
+		tokens2 = {tok for key in first_keys for fnames in key[:2] for tok in fnames if len(tok) > 1}
+		pairs = [(tok1, tok2) for tok1 in tokens1 for tok2 in tokens2]
+		pairs += [(tok2, tok1) for tok1, tok2 in pairs]
+		substr_sims = dict(zip(pairs, self._max_substr_sims(pairs)))
+		for key in first_keys:
+			sim = max(self._max_subseq_sim(fnames1, fnames2, query[2], key[2],
+										   substr_sim=lambda *pair: substr_sims[pair])
+					  for fnames1 in query[:2] for fnames2 in key[:2])
+			if bool(query[1]) != bool(key[1]):
+				sim *= self.params['disc_missing_nickname']
+			memo[(query, key)] = sim
+		weights = self.params['weights']
+		return np.array([memo[(query, candidates.first_keys[p])] for p in positions]) * weights[0] \
+			 + np.array([last_sims[candidates.last_names[p]] for p in positions]) * weights[1] \
+			 + np.array([suffix_sims[candidates.suffixes[p]] for p in positions]) * weights[2]
+
+	def _first_sims_memo(self, max_size=2**16):
+		# (query, candidate) first-name keys -> sim for match_many; emptied when the
+		# params change or it holds max_size entries
+		params = repr(self.params)
+		if getattr(self, '_memo_params', None) != params or len(self._first_sims) >= max_size:
+			self._first_sims, self._memo_params = {}, params
+		return self._first_sims
+
+	def _dist_many(self, strs1, strs2):
+		# self.distfun of each pair, vectorized for the built-in distance functions
+		if self.distfun is jaro_distfun:
+			return 1 - jaro_many(strs1, strs2)
+		if self.distfun == self._levenshtein_log:
+			edits = levenshtein_many(strs1, strs2)
+			longest = np.maximum([len(s) for s in strs1], [len(s) for s in strs2])
+			return 1 - np.log(longest - edits + 1) / np.log(longest + 1)
+		return np.array([self.distfun(str1, str2) for str1, str2 in zip(strs1, strs2)], dtype=float)
+
+	def _max_substr_sims(self, pairs):
+		# _max_substr_sim of each (str1, str2) pair, all windows scored in one pass
+		if not pairs: return []
+		shorters, windows, owners = [], [], []
+		for k, (str1, str2) in enumerate(pairs):
+			(shorter, longer) = sorted([str1, str2], key=lambda x:len(x))
+			for i in range(len(longer) - len(shorter) + 1):
+				shorters.append(shorter)
+				windows.append(longer[i:i+len(shorter)])
+				owners.append(k)
+		subsims = 1 - self._dist_many(shorters, windows)
+		owners = np.array(owners)
+		starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+		sims = np.maximum.reduceat(subsims, starts)
+		# position of the (first) best window of each pair
+		offsets = np.arange(len(owners)) - starts[owners]
+		best = np.minimum.reduceat(np.where(subsims == sims[owners], offsets, len(owners)), starts)
+		sims[[len(str1) != len(str2) for str1, str2 in pairs]] *= self.params['disc_abbrev']
+		sims[best > 0] *= self.params['disc_abbrev_notstart']
+		return sims.tolist()
+
 	def parse_name(self, name):
 		name_dict = {'first_names':[], 'last_name':'', 'nicknames':[]}
 		last_tok = re.split('[\s,]', name)[-1]
@@ -113,7 +282,8 @@ class NameMatcher:
 			return 'j'
 		return ''
 
-	def _max_subseq_sim(self, fnames1, fnames2, jr1='', jr2=''):
+	def _max_subseq_sim(self, fnames1, fnames2, jr1='', jr2='', substr_sim=None):
+		if substr_sim is None: substr_sim = self._max_substr_sim
 		name_order = sorted([(fnames1, jr1), (fnames2, jr2)], key=lambda x:len(x[0]))
 		(shorter, jrshort), (longer, jrlong) = name_order
 		if not shorter: return 0
@@ -138,18 +308,18 @@ class NameMatcher:
 						else: token_sims.append(self.params['disc_initial_mismatch'])
 						last_initial_match = False
 				else:
-					substr_sim = self._max_substr_sim(shorter[t], longer[s+t])
+					token_sim = substr_sim(shorter[t], longer[s+t])
 					if len(shorter[t])==2 and shorter[t][0] == longer[s+t][0] \
 					and ((s+t+1 < len(longer) and shorter[t][1] == longer[s+t+1][0]) \
 					or shorter[t][1] == jrlong):
-						if self.params['disc_acronym'] > substr_sim:
-							substr_sim = self.params['disc_acronym']
+						if self.params['disc_acronym'] > token_sim:
+							token_sim = self.params['disc_acronym']
 					elif len(longer[s+t])==2 and longer[s+t][0] == shorter[t][0] \
 					and ((t+1 < len(shorter) and longer[s+t][1] == shorter[t+1][0]) \
 					or longer[s+t][1] == jrshort):
-						if self.params['disc_acronym'] > substr_sim:
-							substr_sim = self.params['disc_acronym']
-					token_sims.append(substr_sim)
+						if self.params['disc_acronym'] > token_sim:
+							token_sim = self.params['disc_acronym']
+					token_sims.append(token_sim)
 					last_initial_match = False
 			if token_sims: sequence_sims.append(mean(token_sims))
 		sim = max(sequence_sims)
@@ -179,52 +349,114 @@ class NameMatcher:
 		sims_weighted = np.multiply(sims_list, self.params['weights'])
 		return sum(sims_weighted)
 
-	def find_closest_names(self, target_names, other_names):
-		targets_dicts = [self.parse_name(name) for name in target_names]
-		others_dicts = [self.parse_name(name) for name in other_names]
-		others_enum = [(self._name_string_std(name_dict), name_dict, i) \
-						for i,name_dict in enumerate(others_dicts)]
-		others_sorted = sorted(others_enum)
-		matches = []
-		for target_dict in targets_dicts:
-			target_std = self._name_string_std(target_dict)
-			i = bisect_left(others_sorted, (target_std,))
-			best_sim, best_i = 0, i
-			if i == len(others_sorted): best_i = i - 1
-			j = i - 1
-			cont_left = i > 0
-			cont_right = j < len(others_sorted) - 1
-			while cont_left or cont_right:
-				if cont_left and i > 0:
-					i -= 1
-					sims = {'suffix':self._suffix_sim(target_dict['suffix'], others_sorted[i][1]['suffix']),
-							'last_name':1 - self.distfun(target_dict['last_name'], others_sorted[i][1]['last_name']),
-							'first_names':1}
-					if self._weighted_sum(sims) < best_sim:
-					 	cont_left = False
-					else:
-					 	sim = self.match_names(target_std, others_sorted[j][0], speed='slow')
-					 	if sim > best_sim:
-					 		best_sim, best_i = sim, i
-				else: cont_left = False
-				if cont_right and j < len(others_sorted) - 1:
-					j += 1
-					sims = {'suffix':self._suffix_sim(target_dict['suffix'], others_sorted[j][1]['suffix']),
-							'last_name':1 - self.distfun(target_dict['last_name'], others_sorted[j][1]['last_name']),
-							'first_names':1}		
-					if self._weighted_sum(sims) < best_sim:
-					 	cont_right = False
-					else:
-					 	sim = self.match_names(target_std, others_sorted[j][0], speed='slow')
-					 	if sim > best_sim:
-					 		best_sim, best_i = sim, j
-				else: cont_right = False
-			best_i_orig = others_sorted[best_i][2]
-			matches.append((other_names[best_i_orig], best_i_orig, best_sim))
+	def find_closest_names(self, target_names, other_names, sort_keys=('surname',),
+						   top_k=None, window=2, n_jobs=1, chunk_size=500):
+		# Sorted-neighborhood matching of each target name to other_names: the other
+		# names are sorted by each sort key, and each target is scored against its
+		# neighbors on either side of its own position in that order. A side stops
+		# after `window` neighbors once a neighbor's best possible score (its last
+		# name and suffix with a perfect first name match) is below the k-th best.
+		# sort_keys - 'surname', 'metaphone' (of the surname), 'first_name', or
+		#	functions of a parse_name dict; candidates from all keys are pooled
+		# top_k - number of matches per target (None: only the best one)
+		# n_jobs - processes matching chunks of chunk_size targets
+		# Returns (other_name, index, sim) of the best match of each target, or
+		# a list of top_k such tuples, best first, if top_k is given.
+		targets_dicts = [self.parse_name(name.lower()) for name in target_names]
+		others_dicts = [self.parse_name(name.lower()) for name in other_names]
+		neighborhoods = []
+		for sort_key in sort_keys:
+			key_fun = self._sort_key_fun(sort_key)
+			others_sorted = sorted((key_fun(name_dict), i) for i,name_dict in enumerate(others_dicts))
+			neighborhoods.append((key_fun, [key for key, _ in others_sorted], [i for _, i in others_sorted]))
+		k = 1 if top_k is None else top_k
+		if n_jobs > 1 and len(targets_dicts) > chunk_size:
+			chunks = [targets_dicts[i:i+chunk_size] for i in range(0, len(targets_dicts), chunk_size)]
+			with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_closest,
+									 initargs=(self, others_dicts, neighborhoods)) as pool:
+				closest = [top for tops in pool.map(_closest_chunk, [(chunk, k, window) for chunk in chunks])
+						   for top in tops]
+		else:
+			closest = [self._closest(target_dict, others_dicts, neighborhoods, k, window)
+					   for target_dict in targets_dicts]
+		matches = [[(other_names[i], i, sim) for sim, i in top] for top in closest]
+		if top_k is None:
+			return [top[0] if top else (None, None, 0) for top in matches]
 		return matches
 
+	def _closest(self, target_dict, others_dicts, neighborhoods, k, window):
+		# [(sim, index)] of the k best others found in the neighborhoods of target_dict
+		scored, best = set(), []	# best is a min-heap of the k best (sim, -index)
+		for key_fun, keys, order in neighborhoods:
+			pos = bisect_left(keys, key_fun(target_dict))
+			sides = [iter(range(pos - 1, -1, -1)), iter(range(pos, len(keys)))]
+			steps = 0
+			while sides:
+				steps += 1
+				for side in list(sides):
+					j = next(side, None)
+					if j is None:
+						sides.remove(side)
+						continue
+					i = order[j]
+					if i in scored: continue
+					other_dict = others_dicts[i]
+					if steps > window and len(best) == k:
+						bound = self._weighted_sum({'first_names':1,
+							'last_name':1 - self.distfun(target_dict['last_name'], other_dict['last_name']),
+							'suffix':self._suffix_sim(target_dict['suffix'], other_dict['suffix'])})
+						if bound < best[0][0]:
+							sides.remove(side)
+							continue
+					scored.add(i)
+					sim = self.match_parsed(target_dict, other_dict, speed=None)
+					if len(best) < k: heapq.heappush(best, (sim, -i))
+					elif (sim, -i) > best[0]: heapq.heapreplace(best, (sim, -i))
+		return [(sim, -i) for sim, i in sorted(best, reverse=True)]
+
+	def _sort_key_fun(self, sort_key):
+		if callable(sort_key): return sort_key
+		return {'surname':self._name_string_std, 'metaphone':_metaphone_key,
+				'first_name':_first_name_key}[sort_key]
+
 	def _name_string_std(self, name_dict):
 		return (name_dict['last_name'] + ', ' \
 				+ ' '.join(name_dict['first_names']) + ' ' \
 				+ name_dict['suffix']).strip()
 
+
+def _metaphone_key(name_dict):
+	from jellyfish import metaphone
+	last_name = metaphone(name_dict['last_name']) if name_dict['last_name'] else ''
+	return (last_name + ', ' + ' '.join(name_dict['first_names'])).strip()
+
+def _first_name_key(name_dict):
+	return (' '.join(name_dict['first_names'] or name_dict['nicknames']) + ', ' \
+			+ name_dict['last_name']).strip()
+
+# find_closest_names worker processes (n_jobs > 1)
+_closest_state = None
+
+def _init_closest(matcher, others_dicts, neighborhoods):
+	global _closest_state
+	_closest_state = (matcher, others_dicts, neighborhoods)
+
+def _closest_chunk(task):
+	targets_dicts, k, window = task
+	matcher, others_dicts, neighborhoods = _closest_state
+	return [matcher._closest(target_dict, others_dicts, neighborhoods, k, window)
+			for target_dict in targets_dicts]
+
+
+class ParsedNames:
+	# names parsed once, to be scored against many names by NameMatcher.match_many
+	def __init__(self, matcher, names):
+		self.names = list(names)
+		name_dicts = [matcher.parse_name(name.lower()) for name in self.names]
+		self.last_names = [name_dict['last_name'] for name_dict in name_dicts]
+		self.suffixes = [name_dict['suffix'] for name_dict in name_dicts]
+		self.first_keys = [(tuple(name_dict['first_names']), tuple(name_dict['nicknames']),
+							matcher._suffix_acron_letter(name_dict['suffix'])) for name_dict in name_dicts]
+
+	def __len__(self):
+		return len(self.names)
@@ -67,14 +67,23 @@ def _loadTagger(model_type) :
 
     return tagger
 
-TAGGERS = {model_type : _loadTagger(model_type) for model_type in MODEL_FILES}
+# taggers are opened on first use (see get_tagger)
+TAGGERS = {}
 
-TAGGER = _loadTagger('generic')
+def get_tagger(model_type) :
+    if model_type not in TAGGERS :
+        TAGGERS[model_type] = _loadTagger(model_type)
+    return TAGGERS[model_type]
+
+def __getattr__(name) :
+    if name == 'TAGGER' :
+        return get_tagger('generic')
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def parse(raw_string, type=None):
     if type is None:
         type='generic'
-    tagger = TAGGERS[type]
+    tagger = get_tagger(type)
     if not tagger:
         raise IOError('\nMISSING MODEL FILE: %s\nYou must train the model before you can use the parse and tag methods\nTo train the model annd create the model file, run:\nparserator train [traindata] [modulename]' % MODEL_FILES[type])
 
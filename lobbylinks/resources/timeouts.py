@@ -0,0 +1,160 @@
+#deadlines for slow steps of the graph build (proc_name, best_match, wordninja splits)
+#	In the main thread of a platform with SIGALRM, a call is interrupted by an
+#	interval timer when its deadline passes. Elsewhere (other threads, Windows)
+#	the call runs in a daemon thread that is abandoned at the deadline. Timeouts
+#	and errors are counted separately, and the inputs that timed out are kept
+#	so that slow inputs can be found (and cached as failures).
+
+import signal
+import threading
+from collections import Counter
+
+
+class TimedOut(Exception):
+  """raised by Deadline.run when a call passes its deadline"""
+
+
+_state = threading.local()	#depth of nested Deadline.run calls in this thread
+
+def _signals_usable():
+  return hasattr(signal, 'setitimer') and \
+         threading.current_thread() is threading.main_thread()
+
+
+class Deadline(object):
+  """Runs functions under a time limit. Pass an unexecuted function (e.g.
+  func_ = lambda: func(x)) to self.wrap(func_) or self.run(func_).
+  kwargs:
+  \ttimeout - seconds; None disables the limit
+  \tuse_signals - interrupt with SIGALRM when called from the main thread (otherwise
+  \t              a watcher thread is used, and a timed-out call is abandoned)
+  \traise_errors - let exceptions other than timeouts propagate from wrap
+  self.counts holds the number of 'ok', 'timeout' and 'error' calls, and
+  self.timed_out the labels of the calls that timed out."""
+  def __init__(self, timeout=10, use_signals=True, raise_errors=False):
+    self.timeout = timeout
+    self.use_signals = use_signals
+    self.raise_errors = raise_errors
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.counts = Counter()
+      self.timed_out = Counter()	#label -> number of timeouts
+      self.errors = []	#(label, repr of exception)
+
+  def run(self, func, label=None):
+    """func(), raising TimedOut if it does not return within self.timeout seconds"""
+    try:
+      output = self._call(func)
+    except TimedOut:
+      self._record('timeout', label)
+      raise
+    except Exception as exc:
+      self._record('error', label, exc)
+      raise
+    self._record('ok', label)
+    return output
+
+  def wrap(self, func, label=None):
+    """func(), or None if it timed out or raised (see raise_errors)"""
+    try:
+      return self.run(func, label=label)
+    except TimedOut:
+      return None
+    except Exception:
+      if self.raise_errors: raise
+      return None
+
+  def _record(self, status, label, exc=None):
+    with self.lock:
+      self.counts[status] += 1
+      if status == 'timeout': self.timed_out[label] += 1
+      elif status == 'error': self.errors.append((label, repr(exc)))
+
+  def _call(self, func):
+    depth = getattr(_state, 'depth', 0)
+    if self.timeout is None or depth > 0:
+      #no limit, or already inside a deadline of this thread
+      return func()
+    _state.depth = depth + 1
+    try:
+      if self.use_signals and _signals_usable():
+        return self._call_with_signal(func)
+      return self._call_in_thread(func)
+    finally:
+      _state.depth = depth
+
+  def _call_with_signal(self, func):
+    def handler(signum, frame):
+      raise TimedOut()
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, self.timeout)
+    try:
+      return func()
+    finally:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+      signal.signal(signal.SIGALRM, previous)
+
+  def _call_in_thread(self, func):
+    output, error = [], []
+    def target():
+      try: output.append(func())
+      except BaseException as exc: error.append(exc)
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(self.timeout)
+    if thread.is_alive(): raise TimedOut()
+    if len(error) > 0: raise error[0]
+    return output[0]
+
+  def stats(self):
+    #(counts, timed_out) copies, e.g. to send back from a worker process
+    with self.lock:
+      return Counter(self.counts), Counter(self.timed_out)
+
+  def add_stats(self, stats):
+    counts, timed_out = stats
+    with self.lock:
+      self.counts.update(counts)
+      self.timed_out.update(timed_out)
+
+  def summary(self):
+    return '%i calls timed out and %i raised errors (of %i)' % \
+           (self.counts['timeout'], self.counts['error'], sum(self.counts.values()))
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    del state['lock']
+    return state
+
+  def __setstate__(self, state):
+    #objects pickled before deadlines only hold `timeout`
+    self.__dict__.update({ 'use_signals': True, 'raise_errors': False })
+    self.__dict__.update(state)
+    self.lock = threading.Lock()
+    if 'counts' not in state: self.reset()
+
+
+class TimeOutHandler(Deadline):
+  """Deadline under its former name. Pass unexecuted function (e.g.
+  using func_ = lambda: func) to self.wrap(func_) to
+  have function timeout after self.timeout seconds.
+  kwarg:
+  \ttimeout (in seconds)"""
+
+
+class ThreadTimeout(Deadline):
+  """Deadline that always uses a watcher thread (never SIGALRM), e.g. for worker
+  processes or threads"""
+  def __init__(self, timeout=10, raise_errors=False):
+    super(ThreadTimeout, self).__init__(timeout=timeout, use_signals=False, \
+                                        raise_errors=raise_errors)
+
+
+class DummyTimeout(object):
+  def wrap(self, f, label=None):
+    return f()
+  def run(self, f, label=None):
+    return f()
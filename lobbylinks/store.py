@@ -0,0 +1,560 @@
+#columnar storage for LDA filings
+#	filings, lobbying activities, lobbyists and covered positions are held in
+#	separate column-oriented tables joined by integer row keys, instead of one
+#	recursively copied AttrDict per filing. RecordView gives the same attribute
+#	access as before (filing.client.name, activity.lobbyists, ...) by reading
+#	the columns lazily.
+
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+from .resources.handlers import AttrDict
+
+#table layouts: list-of-dict fields stored as child tables, and free-text fields
+#	stored once in a lookup table and referenced by integer id
+lobby_schema = { 'children': { 'filings': { 'lobbying_activities': 'activities' },
+                               'activities': { 'lobbyists': 'lobbyists' } },
+                 'text_fields': { 'lobbyists': { 'covered_position': 'covered_positions' } } }
+
+contributions_schema = { 'children': { 'filings': { 'contribution_items': 'contributions' } },
+                         'text_fields': {} }
+
+_missing = object()	#marks keys absent from a record (distinct from None)
+_sep = '.'
+_keys = ('_parent', '_filing')	#row keys of child tables, not part of the records
+
+
+class ColumnsNotLoaded(LookupError):
+  """raised when reading columns that were saved but left out of a partial load
+  (LobbyData.load(..., columns=[...])); not a KeyError, so it is not taken for
+  a key that is absent from a record"""
+  def __init__(self, table_name, names, action=None):
+    self.table_name = table_name
+    self.names = sorted(names)
+    super(ColumnsNotLoaded, self).__init__('%s%s columns %s were not loaded (load without columns=)' \
+                                           % ('' if action is None else 'cannot %s: ' % action, 
+                                              table_name, ', '.join(self.names)))
+
+
+def _as_attr(value):
+  #json-decoded lists/dicts get the attribute access AttrDict used to provide
+  if isinstance(value, dict):
+    return AttrDict(value)
+  if isinstance(value, list):
+    out = []
+    for v in value:
+      out.append(AttrDict(v) if isinstance(v, dict) else v)
+    return out
+  return value
+
+def _to_array(values):
+  #typed numpy array when every value shares a simple type, else an object array
+  #	of interned strings (repeated names, codes, etc. share one object)
+  types = set(type(v) for v in values)
+  if len(values) > 0 and len(types) == 1:
+    type_ = types.pop()
+    if type_ is bool: return np.array(values, dtype=bool)
+    if type_ is int:
+      try: return np.array(values, dtype=np.int64)
+      except OverflowError: pass
+    if type_ is float: return np.array(values, dtype=np.float64)
+  arr = np.empty(len(values), dtype=object)
+  for i, v in enumerate(values):
+    arr[i] = sys.intern(v) if type(v) is str else v
+  return arr
+
+def _fits(arr, value):
+  if arr.dtype == object: return True
+  if arr.dtype == bool: return type(value) is bool
+  if arr.dtype == np.int64: return type(value) is int
+  if arr.dtype == np.float64: return type(value) is float
+  return False
+
+
+class Table(object):
+  """column-oriented table: a dict of numpy arrays plus, for columns that are
+  not present in every row, a boolean mask of rows where the key is absent.
+  `unloaded` names saved columns that a partial load left out."""
+  unloaded = frozenset()
+  def __init__(self, columns=None, absent=None, n_rows=0, json_columns=None):
+    self.columns = {} if columns is None else columns
+    self.absent = {} if absent is None else absent
+    self.json_columns = set() if json_columns is None else set(json_columns)
+    self.n_rows = n_rows
+    self._nested = None
+
+  @classmethod
+  def from_rows(cls, rows, json_columns=()):
+    names = {}
+    for row in rows:
+      for name in row:
+        names[name] = None
+    table = cls(n_rows=len(rows), json_columns=json_columns)
+    for name in names:
+      values = [ row.get(name, _missing) for row in rows ]
+      absent = np.array([ v is _missing for v in values ], dtype=bool)
+      if absent.any():
+        values = [ None if v is _missing else v for v in values ]
+        table.absent[name] = absent
+      table.columns[name] = _to_array(values)
+    return table
+
+  def __len__(self):
+    return self.n_rows
+
+  @property
+  def nested(self):
+    #dotted prefix -> columns underneath it, for nested record views
+    if self._nested is None:
+      nested = {}
+      for name in self.columns:
+        parts = name.split(_sep)
+        for i in range(1, len(parts)):
+          nested.setdefault(_sep.join(parts[:i]) + _sep, []).append(name)
+      self._nested = nested
+    return self._nested
+
+  def has(self, name, row):
+    if name not in self.columns: return False
+    absent = self.absent.get(name)
+    return absent is None or not absent[row]
+
+  def get(self, name, row, wrap=True):
+    if not self.has(name, row): raise KeyError(name)
+    value = self.columns[name][row]
+    if isinstance(value, np.generic): value = value.item()
+    if name in self.json_columns and isinstance(value, str):
+      value = json.loads(value)
+      if wrap: value = _as_attr(value)
+    return value
+
+  def set(self, name, row, value):
+    if isinstance(value, (list, tuple, dict)):
+      value = json.dumps(value); self.json_columns.add(name)
+    if name not in self.columns:
+      self.columns[name] = np.full(self.n_rows, None, dtype=object)
+      self.absent[name] = np.ones(self.n_rows, dtype=bool)
+      self._nested = None
+    arr = self.columns[name]
+    if not _fits(arr, value):
+      arr = self.columns[name] = arr.astype(object)
+    elif not arr.flags.writeable: #memory-mapped column
+      arr = self.columns[name] = arr.copy()
+    arr[row] = sys.intern(value) if type(value) is str else value
+    if name in self.absent:
+      self.absent[name][row] = False
+
+  def delete(self, name, row):
+    if not self.has(name, row): raise KeyError(name)
+    if name not in self.absent:
+      self.absent[name] = np.zeros(self.n_rows, dtype=bool)
+    self.absent[name][row] = True
+
+  def take(self, rows):
+    table = Table({ name: arr[rows] for name, arr in self.columns.items() },
+                  { name: mask[rows] for name, mask in self.absent.items() },
+                  n_rows=len(rows), json_columns=self.json_columns)
+    table.unloaded = self.unloaded
+    return table
+
+  @classmethod
+  def concat(cls, tables):
+    names = {}
+    for table in tables:
+      for name in table.columns: names[name] = None
+    out = cls(n_rows=sum(len(t) for t in tables))
+    for table in tables: out.json_columns.update(table.json_columns)
+    out.unloaded = frozenset().union(*[ table.unloaded for table in tables ])
+    for name in names:
+      arrs, masks = [], []
+      for table in tables:
+        if name in table.columns:
+          arrs.append(table.columns[name])
+          masks.append(table.absent.get(name, np.zeros(len(table), dtype=bool)))
+        else:
+          arrs.append(np.full(len(table), None, dtype=object))
+          masks.append(np.ones(len(table), dtype=bool))
+      if len(set(arr.dtype for arr in arrs)) > 1:
+        arrs = [ arr.astype(object) for arr in arrs ]
+      out.columns[name] = np.concatenate(arrs) if len(arrs) > 0 else np.array([], dtype=object)
+      mask = np.concatenate(masks)
+      if mask.any(): out.absent[name] = mask
+    return out
+
+  def to_frame(self, columns=None):
+    #pandas view of the table; absent values become None/NaN
+    columns = list(self.columns) if columns is None else columns
+    data = {}
+    for name in columns:
+      arr = self.columns[name]
+      if name in self.absent and self.absent[name].any():
+        arr = arr.astype(object) if arr.dtype != np.float64 else arr.copy()
+        arr[self.absent[name]] = None if arr.dtype == object else np.nan
+      data[name] = arr
+    return pd.DataFrame(data, index=pd.RangeIndex(self.n_rows))
+
+
+class RecordView(object):
+  """lazy, dict-like view of one row of a FilingStore table.
+  Nested dicts are addressed by dotted column prefixes and list fields
+  stored as child tables are returned as lists of RecordViews, so that
+  existing code like filing.client.name or activity.lobbyists works unchanged."""
+  __slots__ = ('_store', '_table', '_row', '_prefix')
+
+  def __init__(self, store, table, row, prefix=''):
+    object.__setattr__(self, '_store', store)
+    object.__setattr__(self, '_table', table)
+    object.__setattr__(self, '_row', row)
+    object.__setattr__(self, '_prefix', prefix)
+
+  def _children(self):
+    if self._prefix != '': return {}
+    return self._store.schema['children'].get(self._table, {})
+
+  def _text_fields(self):
+    if self._prefix != '': return {}
+    return self._store.schema['text_fields'].get(self._table, {})
+
+  def __getitem__(self, key):
+    return self._lookup(key)
+
+  def _lookup(self, key, wrap=True):
+    table = self._store.tables[self._table]
+    name = self._prefix + key
+    if table.has(name, self._row):
+      value = table.get(name, self._row, wrap=wrap)
+      text_table = self._text_fields().get(key)
+      if text_table is not None:
+        value = None if value < 0 else self._store.tables[text_table].columns['text'][value]
+      return value
+    prefix = name + _sep
+    if any( table.has(col, self._row) for col in table.nested.get(prefix, ()) ):
+      return RecordView(self._store, self._table, self._row, prefix)
+    child_table = self._children().get(key)
+    if child_table is not None:
+      return [ RecordView(self._store, child_table, i) for i in \
+                          self._store.child_rows(child_table, self._row) ]
+    unloaded = [ col for col in table.unloaded if col == name or col.startswith(prefix) ]
+    if len(unloaded) > 0: raise ColumnsNotLoaded(self._table, unloaded)
+    raise KeyError(key)
+
+  def __getattr__(self, key):
+    try:
+      return self[key]
+    except KeyError:
+      raise AttributeError(key)
+
+  def __setitem__(self, key, value):
+    table = self._store.tables[self._table]
+    text_table = self._text_fields().get(key)
+    if text_table is not None:
+      value = self._store.text_id(text_table, value)
+    elif key in self._children():
+      raise TypeError('%s is stored as a child table and cannot be assigned' % key)
+    table.set(self._prefix + key, self._row, value)
+    self._store.version += 1
+
+  __setattr__ = __setitem__
+
+  def __delitem__(self, key):
+    self._store.tables[self._table].delete(self._prefix + key, self._row)
+    self._store.version += 1
+
+  def __delattr__(self, key):
+    try:
+      del self[key]
+    except KeyError:
+      raise AttributeError(key)
+
+  def keys(self):
+    table = self._store.tables[self._table]
+    keys = {}
+    n = len(self._prefix)
+    for name in table.columns:
+      if name in _keys: continue
+      if name.startswith(self._prefix) and table.has(name, self._row):
+        keys[name[n:].split(_sep, 1)[0]] = None
+    for key in self._children():
+      keys[key] = None
+    return list(keys)
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __contains__(self, key):
+    try:
+      self[key]; return True
+    except KeyError:
+      return False
+
+  def __len__(self):
+    return len(self.keys())
+
+  def get(self, key, default=None):
+    try: return self[key]
+    except KeyError: return default
+
+  def items(self):
+    return [ (key, self[key]) for key in self.keys() ]
+
+  def values(self):
+    return [ self[key] for key in self.keys() ]
+
+  def to_dict(self):
+    #rebuild the nested record (as plain dicts/lists)
+    out = {}
+    for key in self.keys():
+      value = self._lookup(key, wrap=False)
+      if isinstance(value, RecordView):
+        value = value.to_dict()
+      elif isinstance(value, list):
+        value = [ v.to_dict() if isinstance(v, RecordView) else v for v in value ]
+      out[key] = value
+    return out
+
+  def __eq__(self, other):
+    if isinstance(other, RecordView):
+      return self.to_dict() == other.to_dict()
+    return self.to_dict() == other
+
+  def __repr__(self):
+    return repr(self.to_dict())
+
+
+class FilingStore(object):
+  """columnar, list-like container of LDA filings.
+  Tables: `filings` plus one table per child list in the schema (for LDA
+  filings: `activities`, `lobbyists`) and one per text field (`covered_positions`).
+  Child tables carry `_parent` (row in the parent table) and `_filing` (row in
+  `filings`) integer keys and are kept sorted by `_parent`.
+  Indexing returns RecordViews; slicing and take() return new stores.
+  self.version is incremented on every write through a view, so that derived
+  tables (e.g. LobbyData.summary) can tell when they are stale."""
+  def __init__(self, tables=None, schema=lobby_schema):
+    self.schema = schema
+    self.version = 0
+    self.tables = {} if tables is None else tables
+    self._text_index = {}
+    for table_name in self.table_names:
+      if table_name not in self.tables:
+        self.tables[table_name] = Table()
+    for text_table in self._text_tables():
+      if 'text' not in self.tables[text_table].columns:
+        self.tables[text_table].columns['text'] = np.array([], dtype=object)
+
+  @property
+  def table_names(self):
+    names = ['filings']
+    for parent, children in self.schema['children'].items():
+      names += [ child for child in children.values() if child not in names ]
+    return names + [ t for t in self._text_tables() if t not in names ]
+
+  def _text_tables(self):
+    return [ text_table for fields in self.schema['text_fields'].values() \
+                        for text_table in fields.values() ]
+
+  def _parent_of(self, table_name):
+    for parent, children in self.schema['children'].items():
+      if table_name in children.values(): return parent
+    return None
+
+  def _child_order(self):
+    #child tables, parents before children
+    order = []
+    queue = ['filings']
+    while len(queue) > 0:
+      parent = queue.pop(0)
+      for child in self.schema['children'].get(parent, {}).values():
+        order.append(child); queue.append(child)
+    return order
+
+  @classmethod
+  def from_records(cls, records, schema=lobby_schema):
+    """builds a store from raw API filings (dicts, AttrDicts or RecordViews)"""
+    if isinstance(records, FilingStore):
+      return records
+    store = cls(schema=schema)
+    rows = { name: [] for name in store.table_names }
+    parents = { name: [] for name in store.table_names }
+    filing_rows = { name: [] for name in store.table_names }
+    json_columns = { name: set() for name in store.table_names }
+    texts = { name: {} for name in store._text_tables() }
+
+    def flatten(record, table_name, parent, filing_row):
+      children = schema['children'].get(table_name, {})
+      text_fields = schema['text_fields'].get(table_name, {})
+      row = {}
+      row_idx = len(rows[table_name])
+      rows[table_name].append(row)
+      parents[table_name].append(parent)
+      filing_rows[table_name].append(row_idx if table_name == 'filings' else filing_row)
+      if table_name == 'filings': filing_row = row_idx
+      def add(value, name):
+        if isinstance(value, dict) and len(value) > 0:
+          for key, val in value.items():
+            add(val, name + _sep + key)
+        elif isinstance(value, (list, tuple, dict)):
+          row[name] = json.dumps(value)
+          json_columns[table_name].add(name)
+        else:
+          row[name] = value
+      for key, value in record.items():
+        if isinstance(value, RecordView):
+          value = value.to_dict()
+        if key in children:
+          for child in (value or []):
+            flatten(child, children[key], row_idx, filing_row)
+        elif key in text_fields:
+          index = texts[text_fields[key]]
+          row[key] = -1 if value is None else index.setdefault(value, len(index))
+        else:
+          add(value, key)
+
+    for record in records:
+      flatten(record, 'filings', -1, -1)
+    for name in store.table_names:
+      if name in texts:
+        store.tables[name] = Table({ 'text': _to_array(list(texts[name])) }, n_rows=len(texts[name]))
+        continue
+      table = Table.from_rows(rows[name], json_columns=json_columns[name])
+      if name != 'filings':
+        table.columns['_parent'] = np.array(parents[name], dtype=np.int64)
+        table.columns['_filing'] = np.array(filing_rows[name], dtype=np.int64)
+      store.tables[name] = table
+    return store
+
+  def __len__(self):
+    return len(self.tables['filings'])
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return self.take(np.arange(len(self))[i])
+    if i < 0: i += len(self)
+    if i < 0 or i >= len(self): raise IndexError('filing index out of range')
+    return RecordView(self, 'filings', i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield RecordView(self, 'filings', i)
+
+  def child_rows(self, table_name, parent_row):
+    parents = self.tables[table_name].columns['_parent']
+    return range(np.searchsorted(parents, parent_row, side='left'),
+                 np.searchsorted(parents, parent_row, side='right'))
+
+  def text_id(self, text_table, text):
+    if text is None: return -1
+    if text_table not in self._text_index:
+      self._text_index[text_table] = { t: i for i, t in \
+                  enumerate(self.tables[text_table].columns['text']) }
+    index = self._text_index[text_table]
+    if text not in index:
+      table = self.tables[text_table]
+      table.columns['text'] = np.append(table.columns['text'].astype(object), text)
+      table.n_rows += 1
+      index[text] = len(index)
+    return index[text]
+
+  def texts(self, text_table='covered_positions'):
+    return list(self.tables[text_table].columns['text'])
+
+  def take(self, rows):
+    """new store with the filings at positions `rows` (and their children)"""
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(np.unique(rows)) != len(rows):
+      store = FilingStore.from_records([ self[i] for i in rows ], schema=self.schema)
+      for name in store.table_names:
+        store.tables[name].unloaded = self.tables[name].unloaded
+      return store
+    tables = { 'filings': self.tables['filings'].take(rows) }
+    remap = { 'filings': np.full(len(self), -1, dtype=np.int64) }
+    remap['filings'][rows] = np.arange(len(rows))
+    for name in self._child_order():
+      table = self.tables[name]
+      parent_remap = remap[self._parent_of(name)]
+      new_parent = parent_remap[table.columns['_parent']] if len(table) > 0 \
+                                                          else np.array([], dtype=np.int64)
+      keep = np.nonzero(new_parent >= 0)[0]
+      idx = keep[np.argsort(new_parent[keep], kind='stable')]
+      new_table = table.take(idx)
+      new_table.columns['_parent'] = new_parent[idx]
+      new_table.columns['_filing'] = remap['filings'][table.columns['_filing'][idx]]
+      remap[name] = np.full(len(table), -1, dtype=np.int64)
+      remap[name][idx] = np.arange(len(idx))
+      tables[name] = new_table
+    for text_table in self._text_tables():
+      tables[text_table] = self.tables[text_table]
+    return FilingStore(tables, schema=self.schema)
+
+  @classmethod
+  def concat(cls, stores, schema=lobby_schema):
+    stores = [ FilingStore.from_records(s, schema=schema) for s in stores ]
+    if len(stores) == 0: return cls(schema=schema)
+    schema = stores[0].schema
+    out = cls(schema=schema)
+    #remap text ids into one shared lookup table per text field
+    text_maps = []
+    for store in stores:
+      maps = {}
+      for text_table in out._text_tables():
+        maps[text_table] = np.array([ out.text_id(text_table, t) for t in \
+                     store.tables[text_table].columns['text'] ], dtype=np.int64)
+      text_maps.append(maps)
+    offsets = { name: 0 for name in out.table_names }
+    parts = { name: [] for name in out.table_names }
+    for store, maps in zip(stores, text_maps):
+      for name in ['filings'] + out._child_order():
+        table = store.tables[name]
+        table = table.take(np.arange(len(table)))
+        if name != 'filings':
+          table.columns['_parent'] = table.columns['_parent'] + offsets[out._parent_of(name)]
+          table.columns['_filing'] = table.columns['_filing'] + offsets['filings']
+        for field, text_table in schema['text_fields'].get(name, {}).items():
+          if field in table.columns:
+            ids = table.columns[field].astype(np.int64)
+            mapped = np.full(len(ids), -1, dtype=np.int64)
+            mapped[ids >= 0] = maps[text_table][ids[ids >= 0]]
+            table.columns[field] = mapped
+        parts[name].append(table)
+      for name in ['filings'] + out._child_order():
+        offsets[name] += len(store.tables[name])
+    for name in ['filings'] + out._child_order():
+      out.tables[name] = Table.concat(parts[name])
+    return out
+
+  def __add__(self, other):
+    return FilingStore.concat([self, other], schema=self.schema)
+
+  def __iadd__(self, other):
+    return FilingStore.concat([self, other], schema=self.schema)
+
+  def extend(self, records):
+    merged = FilingStore.concat([self, records], schema=self.schema)
+    self.tables = merged.tables
+    self._text_index = {}
+    self.version += 1
+
+  def unloaded(self):
+    #table name -> saved columns left out of a partial load (see ColumnsNotLoaded)
+    return { name: sorted(self.tables[name].unloaded) for name in self.table_names \
+                   if len(self.tables[name].unloaded) > 0 }
+
+  def require(self, table_name, names):
+    #raises ColumnsNotLoaded if any of the columns `names` of a table were not loaded
+    unloaded = self.tables[table_name].unloaded.intersection(names)
+    if len(unloaded) > 0: raise ColumnsNotLoaded(table_name, unloaded)
+
+  def frame(self, table_name='filings', columns=None):
+    """pandas DataFrame of one table (dotted column names)"""
+    return self.tables[table_name].to_frame(columns=columns)
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._text_index = {}
+
+  def __getstate__(self):
+    state = dict(self.__dict__)
+    state['_text_index'] = {}
+    return state
@@ -1,9 +1,15 @@
-import signal
 import inspect
 from itertools import product
 import re	#regular expression for string matching
+import json
+import numpy as np
+import pandas as pd
 from .resources.handlers import AttrDict
+from .resources.timeouts import Deadline, TimedOut, TimeOutHandler, ThreadTimeout, \
+                                 DummyTimeout
+from .store import RecordView
 import string
+from datetime import datetime
 
 strip_punct = lambda s: s.strip(string.punctuation)
 
@@ -14,33 +20,6 @@ class defaultValueDict(dict):
         return self.default_value
 
 
-class TimeOutHandler(object):
-  """Class to handle timeouts. Pass unexecuted function (e.g. 
-  using func_ = lambda: func) to self.wrap(func_) to
-  have function timeout after self.timeout seconds.
-  kwarg:
-  \ttimeout (in seconds)"""
-  def __init__(self, timeout=10):
-    self.timeout = timeout
-  def handler(self, signum, frame):
-    raise Exception('Timed Out')
-  def wrap(self, func):
-    def handler(signum, frame):
-      raise Exception('Timed Out')
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(10)
-    try:
-      output = func()
-      signal.alarm(0)
-      return output
-    except Exception as exc:
-      signal.alarm(0)
-      return #'timed out'
-
-class DummyTimeout(object):
-  def wrap(self, f):
-    return f()
-
 def varname(var):
   """
   Gets the name of var. Does it from the out most frame inner-wards.
@@ -73,6 +52,17 @@ def build_queries(q_args):
     q_dicts.append(q)
   return q_dicts
 
+def watermark_key(q_args):
+  """Key for a single query dict (from build_queries) that ignores pagination,
+  ordering and the dt_posted lower bound added by incremental syncs."""
+  ignore = { 'page', 'page_size', 'ordering', 'filing_dt_posted_after' }
+  return tuple(sorted( (key, str(val)) for key, val in q_args.items() \
+                                       if key not in ignore ))
+
+def parse_dt(dt_posted):
+  #LDA timestamps are ISO 8601 with a UTC offset (e.g. 2024-01-19T12:14:12-05:00)
+  return datetime.fromisoformat(dt_posted.replace('Z', '+00:00'))
+
 def _find_exact_searches(str_):
   #assert type(str_) == str
   str_ = str(str_)
@@ -183,7 +173,7 @@ def fuzzy_company_match(company_list):
 
 
 def get_filing_summary(filing):
-  assert type(filing) == AttrDict
+  assert isinstance(filing, (AttrDict, RecordView))
   summary_data = {}
   income = float(filing.income) if filing.income is not None else 0
   expenses = float(filing.expenses) if filing.expenses is not None else 0
@@ -218,7 +208,7 @@ def get_filing_summary(filing):
   return summary_data
 
 def get_activity_summary(activity):
-  assert type(activity) == AttrDict
+  assert isinstance(activity, (AttrDict, RecordView))
   summary_data = {}
   #target_keys: 'general_issue_code', 'general_issue_code_display', 
   #             'government_entities', 'foreign_entity_issues', 
@@ -235,7 +225,7 @@ def get_activity_summary(activity):
 
 
 def get_feca_filing_summary(filing):
-  assert type(filing) == AttrDict
+  assert isinstance(filing, (AttrDict, RecordView))
   summary_data = {}
   #income = float(filing.income) if filing.income is not None else 0
   #expenses = float(filing.expenses) if filing.expenses is not None else 0
@@ -266,7 +256,7 @@ def get_feca_filing_summary(filing):
 
 
 def get_contribution_summary(contribution):
-  assert type(contribution) == AttrDict
+  assert isinstance(contribution, (AttrDict, RecordView))
   summary_data = {}
   summary_data['contribution_type_'] = contribution.contribution_type
   summary_data['contribution_type'] = contribution.contribution_type_display
@@ -283,3 +273,221 @@ def get_contribution_summary(contribution):
 
 
 
+
+
+#vectorized versions of the summaries above, built directly from the columns
+#	of a store.FilingStore rather than filing-by-filing
+
+_period_codes = { 'first_quarter': 'Q1', 'second_quarter': 'Q2', 'mid_year': 'Q2', 
+                  'third_quarter': 'Q3', 'fourth_quarter': 'Q4', 'year_end': 'Q4' }
+_feca_period_codes = { 'mid_year': 'Q2', 'year_end': 'Q4' }
+
+def _column(frame, name):
+  #column of a store table frame, or all-None if no record has the key
+  if name in frame: return frame[name]
+  return pd.Series([None]*len(frame), index=frame.index, dtype=object)
+
+def _as_float(column):
+  return pd.to_numeric(column, errors='raise').astype(float).fillna(0.)
+
+def _json_names(column):
+  #tuple of the `name` entries of each json-encoded list (parsed once per distinct value)
+  parsed = {}
+  out = []
+  for val in column:
+    if val not in parsed:
+      parsed[val] = tuple( entry['name'] for entry in json.loads(val) ) \
+                    if isinstance(val, str) else ()
+    out.append(parsed[val])
+  return out
+
+def _json_tuples(column):
+  parsed = {}
+  out = []
+  for val in column:
+    if val not in parsed:
+      parsed[val] = tuple(json.loads(val)) if isinstance(val, str) else ()
+    out.append(parsed[val])
+  return out
+
+def _year_and_period(years, periods):
+  periods = periods.astype(object).where(periods.notna(), None).map(str)
+  return years.astype(str) + ' (' + periods + ')'
+
+def _amount(column):
+  #float(value), or 0 for None, as in get_filing_summary: a column with no
+  #	amounts at all holds int zeros, as it did when built from those values
+  if column.isna().all(): return pd.Series(np.zeros(len(column), dtype=np.int64), index=column.index)
+  return _as_float(column)
+
+def _taken(column, rows):
+  #values of a column (of a store table or a summary frame) at rows, as python objects
+  return column.to_numpy(dtype=object)[rows]
+
+def _record_frame(columns):
+  #DataFrame of python values, so that dtypes (None vs NaN, int vs float) are
+  #	inferred as for the lists of get_*_summary values it replaces
+  return pd.DataFrame({ name: values.tolist() if hasattr(values, 'tolist') else list(values) \
+                        for name, values in columns.items() })
+
+#store columns each summary is built from; a partially loaded store must hold
+#	them (see store.ColumnsNotLoaded)
+_filing_summary_fields = ('income', 'expenses', 'filing_period', 'registrant.id', 'filing_year', 
+                          'client.name', 'client.name__merged_from_', 
+                          'client.general_description', 'registrant.name', 
+                          'filing_type_display', 'filing_uuid', 'client.state', 
+                          'client.country', 'registrant.zip')
+_activity_summary_fields = ('general_issue_code', 'general_issue_code_display', 
+                            'foreign_entity_issues', 'description', 'government_entities')
+_feca_filing_summary_fields = ('registrant.id', 'filing_year', 'filing_period', 'registrant.name', 
+                               'registrant.description', 'pacs', 'filing_type_display', 
+                               'filing_uuid')
+_contributions_summary_fields = ('amount', 'contribution_type', 'contribution_type_display', 
+                                 'contributor_name', 'payee_name', 'honoree_name', 'date')
+
+def _filing_summary_columns(filings, rows):
+  #get_filing_summary columns of filings at rows
+  column = lambda name: pd.Series(_taken(_column(filings, name), rows))
+  income = _amount(column('income'))
+  expenses = _amount(column('expenses'))
+  raw_period = column('filing_period')
+  filing_period = raw_period.map(_period_codes).where(raw_period.isin(_period_codes), raw_period)
+  summary = {}
+  summary['registrant_id'] = column('registrant.id')
+  summary['filing_year'] = column('filing_year')
+  summary['client'] = column('client.name')
+  if 'client.name__merged_from_' in filings:
+    summary['client_name_merged_from_'] = column('client.name__merged_from_')
+  summary['client_industry'] = column('client.general_description')
+  summary['lobbyist_income'] = income
+  summary['lobbyist_expenses'] = expenses
+  summary['total_spend'] = income + expenses
+  summary['lobby_entity'] = column('registrant.name')
+  summary['filing_period'] = filing_period
+  summary['year_and_period'] = _year_and_period(summary['filing_year'], filing_period)
+  summary['filing_type'] = column('filing_type_display')
+  summary['filing_id'] = column('filing_uuid')
+  summary['client_state'] = column('client.state')
+  summary['client_country'] = column('client.country')
+  summary['registrant_zip'] = column('registrant.zip')
+  return summary
+
+def filing_summary_frame(store):
+  #same columns as get_filing_summary, for every filing in the store
+  store.require('filings', _filing_summary_fields)
+  filings = store.frame('filings')
+  return _record_frame(_filing_summary_columns(filings, np.arange(len(filings))))
+
+def activity_summary_frame(store):
+  #filing summary columns repeated for each lobbying activity, plus get_activity_summary columns
+  store.require('filings', _filing_summary_fields)
+  store.require('activities', _activity_summary_fields)
+  activities = store.frame('activities')
+  parents = activities['_parent'].values if len(activities) > 0 else np.zeros(0, dtype=int)
+  n_lobbyists = np.bincount(store.tables['lobbyists'].columns['_parent'], \
+                            minlength=len(activities)) if len(activities) > 0 else []
+  summary = _filing_summary_columns(store.frame('filings'), parents)
+  summary['general_issue_code'] = _column(activities, 'general_issue_code')
+  summary['general_issue'] = _column(activities, 'general_issue_code_display')
+  summary['foreign_entity_issues'] = _column(activities, 'foreign_entity_issues')
+  summary['description'] = _column(activities, 'description')
+  summary['num_lobbyists'] = n_lobbyists
+  summary['government_entities'] = _json_names(_column(activities, 'government_entities'))
+  return _record_frame(summary)
+
+def feca_filing_summary_frame(store):
+  #same columns as get_feca_filing_summary, for every filing in the store
+  store.require('filings', _feca_filing_summary_fields)
+  store.require('contributions', ('amount',))
+  filings = store.frame('filings')
+  contributions = store.frame('contributions')
+  amounts = _as_float(_column(contributions, 'amount')).values
+  #sum() of no contributions is int 0
+  total_spend = np.bincount(contributions['_parent'].values, weights=amounts, \
+                            minlength=len(filings)) if len(contributions) > 0 \
+                                                    else np.zeros(len(filings), dtype=np.int64)
+  raw_period = _column(filings, 'filing_period')
+  filing_period = raw_period.map(_feca_period_codes)
+  summary = {}
+  summary['registrant_id'] = _column(filings, 'registrant.id')
+  summary['total_spend'] = total_spend
+  summary['filing_year'] = _column(filings, 'filing_year')
+  summary['filing_period'] = raw_period
+  summary['year_and_period'] = _year_and_period(summary['filing_year'], filing_period)
+  summary['registrant'] = _column(filings, 'registrant.name')
+  summary['registrant_industry'] = _column(filings, 'registrant.description')
+  summary['PACs'] = _json_tuples(_column(filings, 'pacs'))
+  summary['filing_type'] = _column(filings, 'filing_type_display')
+  summary['filing_id'] = _column(filings, 'filing_uuid')
+  return _record_frame(summary)
+
+def contributions_summary_frame(store, filing_summary=None):
+  #FECA filing summary columns repeated for each contribution item
+  store.require('contributions', _contributions_summary_fields)
+  if filing_summary is None:
+    filing_summary = feca_filing_summary_frame(store)
+  contributions = store.frame('contributions')
+  parents = contributions['_parent'].values if len(contributions) > 0 else np.zeros(0, dtype=int)
+  summary = { name: _taken(filing_summary[name], parents) for name in filing_summary.columns }
+  summary['contribution_type_'] = _column(contributions, 'contribution_type')
+  summary['contribution_type'] = _column(contributions, 'contribution_type_display')
+  summary['contributor'] = _column(contributions, 'contributor_name')
+  summary['recipient'] = _column(contributions, 'payee_name')
+  summary['honoree'] = _column(contributions, 'honoree_name')
+  summary['amount'] = _as_float(_column(contributions, 'amount'))
+  summary['date'] = _column(contributions, 'date')
+  return _record_frame(summary)
+
+def lobbyist_frame(store, issue_codes, incl_codes=None):
+  #one row per lobbyist with a covered position, in (filing, activity, lobbyist) order,
+  #	with the filing/activity columns of a LobbyLinks graph; used by LobbyLinks.make_graph
+  store.require('filings', ('client.name', 'client.name__merged_from_', 'income', 
+                            'client.general_description', 'filing_year', 'registrant.id'))
+  store.require('activities', ('general_issue_code', 'description'))
+  store.require('lobbyists', ('lobbyist.id', 'lobbyist.first_name', 'lobbyist.middle_name', 
+                              'lobbyist.last_name', 'covered_position'))
+  filings = store.frame('filings')
+  activities = store.frame('activities')
+  lobbyists = store.frame('lobbyists')
+  if len(lobbyists) == 0:
+    lobbyists = pd.DataFrame({ '_parent': np.zeros(0, dtype=int), '_filing': np.zeros(0, dtype=int), 
+                               'covered_position': np.zeros(0, dtype=int) })
+  filing_idx = lobbyists['_filing'].values
+  activity_idx = lobbyists['_parent'].values
+  frame = pd.DataFrame({ '_row': np.arange(len(lobbyists)), 'filing_index': filing_idx })
+  
+  client_names = _column(filings, 'client.name')
+  unmerged_names = _column(filings, 'client.name__merged_from_')
+  contract_value = _as_float(_column(filings, 'income'))
+  filing_columns = { 'client_name': client_names,
+                     'client_industry': _column(filings, 'client.general_description').map(str),
+                     'contract_value': contract_value,
+                     'filing_year': _column(filings, 'filing_year'),
+                     'registrant_id': _column(filings, 'registrant.id'),
+                     'client_name_unmerged_': unmerged_names.where(unmerged_names.notna(), client_names) }
+  for name, column in filing_columns.items():
+    frame[name] = column.values[filing_idx]
+  
+  codes = _column(activities, 'general_issue_code')
+  code2name = { code: issue_codes.code2name.get(code) for code in set(codes) }
+  frame['issue_name'] = np.array([ code2name[code] for code in codes ], dtype=object)[activity_idx]
+  frame['issue_description'] = _column(activities, 'description').values[activity_idx]
+  frame['issue_code'] = codes.values[activity_idx]
+  
+  frame['lobbyist_id'] = _column(lobbyists, 'lobbyist.id').values
+  name_parts = [ _column(lobbyists, 'lobbyist.' + key) for key in ('first_name', 'middle_name', 'last_name') ]
+  frame['lobbyist_name'] = [ ' '.join( part for part in parts if part is not None ) \
+                             for parts in zip(*name_parts) ]
+  #contract value split among the distinct lobbyists of each activity
+  n_lobbyists = lobbyists.groupby('_parent')['lobbyist.id'].nunique(dropna=False) \
+                if 'lobbyist.id' in lobbyists else pd.Series(dtype=float)
+  frame['income_per_lobbyist'] = frame['contract_value'].values / \
+                                 n_lobbyists.reindex(activity_idx).values
+  
+  texts = np.array(store.texts('covered_positions') + [ None ], dtype=object)
+  covered_position = lobbyists['covered_position'].values
+  frame['link_source_text'] = texts[np.where(covered_position >= 0, covered_position, -1)]
+  keep = covered_position >= 0
+  if incl_codes is not None:
+    keep &= frame['issue_code'].isin(incl_codes).values
+  return frame[keep].reset_index(drop=True)